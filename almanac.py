@@ -3,16 +3,22 @@
 # Holds the logic for generating Barovian Alamanac entries for a given date as Discord embeds,
 # including information on weather, moon phase, calendar, etc.
 
+import calendar
 import logging
+import metrics
+import sheet_cache
+import tracing
 
-from datetime import datetime, timezone, time
+from datetime import datetime, timedelta, timezone, time
 from discord import Embed
-from utils import random_preset_colour, load_google_sheet
+from scheduler import Daily
+from utils import random_preset_colour, pack_embeds
 
 log = logging.getLogger('app.almanac')
 
 # The Almanac reading is posted daily at midnight UTC.
 REFRESH_TIME = time()
+SCHEDULE = Daily(REFRESH_TIME)
 
 # CSV field names, taken verbatim from the Google Sheet header cells
 DAY_OF_YEAR = 'Real World Day of year'
@@ -28,12 +34,54 @@ PRECIPITATION = ':droplet: Precipitation'
 SUNRISE = ':sunrise_over_mountains: Sunrise'
 SUNSET = ':sunrise_over_mountains: Sunset '
 
-def generate_embed(sheet_id, timestamp=datetime.now(timezone.utc)):
+# The longest multi-day forecast that can be requested at once
+MAX_RANGE_DAYS = 31
+
+# Month abbreviations as they appear in the sheet's date column, e.g. 'Jan' -> 1
+_MONTHS = {abbr: number for number, abbr in enumerate(calendar.month_abbr) if abbr}
+
+@metrics.timed('generate')
+async def generate_embed(sheet_id, timestamp=None):
     """
-    Lookup alamanac data and return an Embed for the given date.
+    Lookup alamanac data and return an Embed for the given date (default today, UTC).
     """
-    entry = _fetch_data(sheet_id, timestamp)
+    if timestamp is None:
+        timestamp = datetime.now(timezone.utc)
+
+    with tracing.span('fetch', sheet=sheet_id):
+        entry = await _fetch_data(sheet_id, timestamp)
+    with tracing.span('build'):
+        return _make_embed(entry, timestamp)
 
+@metrics.timed('generate')
+async def generate_embeds(sheet_id, start, end):
+    """
+    Lookup alamanac data for every date from 'start' to 'end' inclusive and return a list of Embeds,
+    one per day. Days missing from the sheet are skipped.
+    """
+    if end < start:
+        raise ValueError(f'End date {end.date()} is before start date {start.date()}')
+    if (end - start).days >= MAX_RANGE_DAYS:
+        raise ValueError(f'Date range is longer than {MAX_RANGE_DAYS} days')
+
+    index = await _fetch_index(sheet_id)
+
+    embeds = []
+    day = start
+    while day <= end:
+        entry = index.get((day.month, day.day))
+        if entry:
+            embeds.append(_make_embed(entry, day))
+        else:
+            log.error(f'Did not find almanac entry for {day.date()} in Google Sheet data')
+        day += timedelta(days=1)
+
+    return embeds
+
+def _make_embed(entry, timestamp):
+    """
+    Format a row of almanac data as an Embed.
+    """
     embed = Embed(
         title=':calendar_spiral: Barovian Almanac',
         description='Daily forecast for the Town of Vallaki. Higher elevations are cooler and more likely to have snow.',
@@ -79,22 +127,54 @@ async def post_entry(entry, channel):
     Send a message consisting of the Embed entry to the specified channel.
     Return the message that was sent.
     """
-    return await channel.send(embed=entry)
+    with tracing.span('send'):
+        return await channel.send(embed=entry)
+
+async def post_entries(entries, channel):
+    """
+    Send the Embed entries to the specified channel, packing as many into each message as Discord
+    allows. Return the list of messages that were sent.
+    """
+    sent = []
+    for number, page in enumerate(pack_embeds(entries), 1):
+        with tracing.span('send', message=number, embeds=len(page)):
+            sent.append(await channel.send(embeds=page))
+    return sent
 
-# TODO: Make this async
-def _fetch_data(sheet_id, timestamp):
+async def _fetch_data(sheet_id, timestamp):
     """
-    Read the almanac data from the Google Spreadsheet and return the entry for the given date as a dictionary.
+    Read the almanac data from the cached Google Spreadsheet snapshot and return the entry for the
+    given date as a dictionary.
     """
-    almanac_data = load_google_sheet(sheet_id)
-    log.info(f'Retrieved {len(almanac_data)} entries of almanac data from Google Sheets')
+    index = await _fetch_index(sheet_id)
 
-    formatted_date = timestamp.strftime('%d-%b').lstrip('0')  # e.g. 7-Jan
+    entry = index.get((timestamp.month, timestamp.day))
+    if entry:
+        log.info(f'Found almanac entry for {timestamp.date()}')
+        log.debug('Almanac entry for %s: %s', timestamp.date(), entry)
+    else:
+        log.error(f'Did not find almanac entry for {timestamp.date()} in Google Sheet data')
 
-    for datum in almanac_data:
-        if datum[DATE] == formatted_date:
-            log.info(f'Found almanac entry for {formatted_date}: {datum}')
-            return datum
+    return entry
 
-    log.error(f'Did not find almanac entry for {formatted_date} in Google Sheet data')
-    return None
+async def _fetch_index(sheet_id):
+    """
+    Return the almanac data indexed by (month, day). The index is built once per sheet snapshot.
+    """
+    snapshot = await sheet_cache.get_snapshot(sheet_id)
+    return snapshot.derive('almanac_index', _build_index)
+
+def _build_index(almanac_data):
+    """
+    Index the rows of almanac data by the (month, day) in their date column, e.g. '7-Jan' -> (1, 7).
+    """
+    index = {}
+    for datum in almanac_data:
+        try:
+            day, month = datum[DATE].strip().split('-')
+            index[(_MONTHS[month], int(day))] = datum
+        except (KeyError, ValueError):
+            log.warning(f'Skipping almanac row with unrecognized date: {datum.get(DATE)!r}')
+
+    log.info(f'Indexed {len(index)} of {len(almanac_data)} entries of almanac data')
+    return index
@@ -2,35 +2,46 @@
 #
 # The main entrypoint to the Pidlwick Discord bot for the Enter Ravenloft server.
 # Sets up the periodic background tasks to refresh shop inventory and registers
-# a handler for all bot commands.
+# a handler for all bot commands. With JOB_WORKERS set, this process only talks to Discord
+# and the heavy work is done by that many job worker processes (see jobs.py).
 
 import discord
+import jobs
+import log_pipeline
 import os
-import yaml
-import logging
-import logging.config
 
 from client import Client
 from dotenv import load_dotenv
 
- # Read environment variables from .env (does not overwrite existing value)
-load_dotenv() 
+def main():
+    # Read environment variables from .env (does not overwrite existing value)
+    load_dotenv() 
 
-# Configure logging for the app and discord.py library
-with open('logging.yml', 'r') as f:
-    logging_config = yaml.safe_load(f)
+    # Configure logging for the app and discord.py library. Records are written out by a
+    # background thread, which is stopped at the end to flush whatever is still queued.
+    log_listener = log_pipeline.configure('logging.yml')
 
-logging.config.dictConfig(logging_config)
+    # Configure intents AKA Discord API capabilities
+    intents = discord.Intents.default()
+    intents.message_content = True  # For reacting to messages
+    intents.members = True  # For member events and iterating over (or fetching) guild members
+    client = Client(intents=intents)
 
-# Configure intents AKA Discord API capabilities
-intents = discord.Intents.default()
-intents.message_content = True  # For reacting to messages
-intents.members = True  # For iterating over guild.members
-client = Client(intents=intents)
+    # Start the job worker processes, if any, before connecting so that they're ready in time
+    if jobs.JOB_WORKERS:
+        jobs.start_workers()
 
-# Start the bot
-bot_token = os.environ['DISCORD_BOT_TOKEN']
-if bot_token:
-    client.run(bot_token, log_handler=None)
-else:
-    raise RuntimeError('The DISCORD_BOT_TOKEN environment variable must be set (try .env for local development)')
+    # Start the bot
+    bot_token = os.environ['DISCORD_BOT_TOKEN']
+    try:
+        if bot_token:
+            client.run(bot_token, log_handler=None)
+        else:
+            raise RuntimeError('The DISCORD_BOT_TOKEN environment variable must be set (try .env for local development)')
+    finally:
+        jobs.stop_workers()
+        log_listener.stop()
+
+# The generator and job worker processes re-import this module, so only start the bot when run as a script
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+# asset_cache.py
+#
+# A cache for the bot's static media (e.g. the cakeday image). Each asset is read from disk once and
+# kept in memory, uploaded to Discord the first time it's needed, and from then on referenced by the
+# CDN URL of that upload, e.g. as an Embed image, instead of being uploaded again with every post.
+# The URLs are persisted so they survive a restart, and an asset is only uploaded again if its file
+# changes or its URL stops working.
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+
+from discord import File
+from http_client import head
+from io import BytesIO
+
+# How long a URL that was checked is trusted before it is checked again, in seconds
+VERIFY_INTERVAL = 60 * 60
+
+INDEX_PATH = os.path.join(os.environ.get('PIDLWICK_CACHE_DIR', '.cache'), 'assets.json')
+
+log = logging.getLogger('app.asset_cache')
+
+class AssetCache:
+    """
+    Static assets by path. 'upload_channel' is where assets are uploaded to get their URLs, ideally a
+    staff channel; until it is set, `url` returns None and callers fall back to `file`.
+    """
+
+    def __init__(self, upload_channel=None, index_path=INDEX_PATH):
+        self.upload_channel = upload_channel
+        self.index_path = index_path
+
+        self._data = {}  # path -> bytes
+        self._uploads = self._load_index()  # path -> {'sha256': ..., 'url': ...}
+        self._verified = {}  # path -> time.monotonic() of the last successful check
+        self._lock = asyncio.Lock()
+
+    async def data(self, path):
+        """
+        Return the content of the asset, reading it from disk only the first time.
+        """
+        data = self._data.get(path)
+        if data is None:
+            data = self._data[path] = await asyncio.to_thread(_read, path)
+        return data
+
+    async def file(self, path):
+        """
+        Return a discord.File for uploading the asset from memory.
+        """
+        return File(BytesIO(await self.data(path)), filename=os.path.basename(path))
+
+    async def url(self, path):
+        """
+        Return a working CDN URL for the asset, uploading it if it has never been uploaded, has
+        changed since, or its URL no longer works. Returns None if there's no URL and the upload
+        isn't possible (no channel) or fails.
+        """
+        async with self._lock:
+            try:
+                digest = hashlib.sha256(await self.data(path)).hexdigest()
+
+                upload = self._uploads.get(path)
+                if upload and upload['sha256'] == digest:
+                    if await self._still_works(path, upload['url']):
+                        return upload['url']
+                    log.warning(f'The uploaded {path} at {upload["url"]} no longer works, uploading it again')
+
+                return await self._upload(path, digest)
+            except Exception as e:
+                log.error(f'Unable to get a URL for {path}: {e!r}')
+                return None
+
+    async def _still_works(self, path, url):
+        checked = self._verified.get(path)
+        if checked is not None and time.monotonic() - checked < VERIFY_INTERVAL:
+            return True
+
+        try:
+            status = await head(url)
+        except Exception as e:
+            log.warning(f'Unable to check {url}: {e!r}')
+            return False
+
+        if status >= 400:
+            return False
+
+        self._verified[path] = time.monotonic()
+        return True
+
+    async def _upload(self, path, digest):
+        if not self.upload_channel:
+            return None
+
+        message = await self.upload_channel.send(f'Uploading `{path}` for reuse', file=await self.file(path))
+        url = message.attachments[0].url
+
+        self._uploads[path] = {'sha256': digest, 'url': url}
+        self._verified[path] = time.monotonic()
+        await asyncio.to_thread(self._save_index)
+
+        log.info(f'Uploaded {path} to {url}')
+        return url
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            log.warning(f'Ignoring unreadable asset index {self.index_path}: {e!r}')
+            return {}
+
+    def _save_index(self):
+        try:
+            os.makedirs(os.path.dirname(self.index_path) or '.', exist_ok=True)
+            temp_path = f'{self.index_path}.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(self._uploads, f)
+            os.replace(temp_path, self.index_path)
+        except OSError as e:
+            log.warning(f'Unable to save asset index to {self.index_path}: {e!r}')
+
+def _read(path):
+    with open(path, 'rb') as f:
+        return f.read()
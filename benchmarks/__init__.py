@@ -0,0 +1,3 @@
+# benchmarks
+#
+# Offline benchmarks of the bot's hot paths - see run.py.
@@ -0,0 +1,129 @@
+# benchmarks/fakes.py
+#
+# Stand-ins for the parts of discord.py that the benchmarked code touches, so that it can run
+# without a connection to Discord: a guild full of synthetic members, a channel that records what
+# is sent to it instead of sending it, and the messages, roles and authors that commands need.
+
+import random
+import string
+
+from datetime import datetime, timedelta, timezone
+
+# The synthetic server opened on this date and grew from there
+FOUNDED = datetime(2020, 10, 31, 18, tzinfo=timezone.utc)
+
+# Fraction of members that are bots
+BOT_FRACTION = 0.01
+
+# Fraction of members that joined during a recruiting event rather than through steady growth
+EVENT_FRACTION = 0.25
+
+class FakeMember:
+    """
+    A member with the attributes the bot reads.
+    """
+
+    __slots__ = ('id', 'joined_at', 'display_name', 'bot', 'roles')
+
+    def __init__(self, id, joined_at, display_name, bot=False, roles=()):
+        self.id = id
+        self.joined_at = joined_at
+        self.display_name = display_name
+        self.bot = bot
+        self.roles = roles
+
+    def get_role(self, role_id):
+        return next((role for role in self.roles if role.id == role_id), None)
+
+class FakeRole:
+    def __init__(self, id, name):
+        self.id = id
+        self.name = name
+
+class FakeGuild:
+    """
+    A guild with a member cache, like discord.Guild with every member chunked.
+    """
+
+    def __init__(self, members, name='Benchmark Server', id=1):
+        self.id = id
+        self.name = name
+        self._members = {member.id: member for member in members}
+
+    @property
+    def members(self):
+        return list(self._members.values())  # discord.py builds a new list on every access too
+
+    def get_member(self, member_id):
+        return self._members.get(member_id)
+
+class FakeMessage:
+    def __init__(self, channel, content=None, author=None, guild=None, id=0):
+        self.channel = channel
+        self.content = content
+        self.author = author
+        self.guild = guild
+        self.id = id
+
+    @property
+    def jump_url(self):
+        return f'https://discord.com/channels/{self.guild.id if self.guild else "@me"}/{self.channel.id}/{self.id}'
+
+class RecordingChannel:
+    """
+    A text channel that counts what is sent to it instead of sending it.
+    """
+
+    def __init__(self, name='benchmark', id=2, guild=None):
+        self.name = name
+        self.id = id
+        self.guild = guild
+        self.reset()
+
+    def reset(self):
+        self.sends = 0
+        self.characters = 0
+        self.embeds = 0
+        self.files = 0
+
+    async def send(self, content=None, *, embed=None, embeds=None, file=None, files=None, **kwargs):
+        self.sends += 1
+        self.characters += len(content) if content else 0
+        self.embeds += (embed is not None) + len(embeds or ())
+        self.files += (file is not None) + len(files or ())
+        return FakeMessage(self, content, guild=self.guild, id=self.sends)
+
+class FakeAssets:
+    """
+    An AssetCache whose images are always already uploaded.
+    """
+
+    async def url(self, path):
+        return f'https://cdn.discordapp.com/attachments/0/0/{path.rsplit("/", 1)[-1]}'
+
+def make_members(count, seed=0, now=None):
+    """
+    Return 'count' synthetic members with a realistic spread of join dates: steady growth that
+    speeds up over time since FOUNDED, plus bursts around a few recruiting events, and a few bots.
+    """
+    rng = random.Random(seed)
+    now = now or datetime(2024, 6, 1, tzinfo=timezone.utc)
+    lifetime = (now - FOUNDED).total_seconds()
+
+    events = [rng.uniform(0.1, 0.95) * lifetime for _ in range(6)]
+
+    members = []
+    for member_id in range(10**17, 10**17 + count):
+        if rng.random() < EVENT_FRACTION:
+            offset = rng.gauss(rng.choice(events), 3 * 86400)
+        else:
+            offset = lifetime * rng.random() ** 0.5  # Joins get more frequent as the server grows
+        offset = min(max(offset, 0.0), lifetime)
+
+        name = ''.join(rng.choices(string.ascii_letters, k=rng.randint(4, 16)))
+        members.append(FakeMember(member_id, FOUNDED + timedelta(seconds=offset), name, bot=rng.random() < BOT_FRACTION))
+
+    return members
+
+def make_guild(count, seed=0):
+    return FakeGuild(make_members(count, seed))
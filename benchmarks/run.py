@@ -0,0 +1,339 @@
+# benchmarks/run.py
+#
+# Offline benchmarks of the bot's hot paths, run against the fakes in fakes.py and the CSV fixture
+# in fixtures/ instead of Discord and Google Sheets. Each benchmark reports its latency (best, p50,
+# p95), its throughput in items per second, the peak memory allocated by one run and what one run
+# sent to its channel. Results can be saved as a baseline and later runs compared against it, e.g.
+#
+#   python -m benchmarks.run --save before
+#   ... make a change ...
+#   python -m benchmarks.run --compare before
+#
+# Run it from the repository root so that the bot's modules can be imported.
+
+import argparse
+import asyncio
+import gc
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import almanac
+import cakeday
+import commands
+import sheet_cache
+import utils
+
+from benchmarks.fakes import FakeAssets, FakeMember, FakeMessage, FakeRole, RecordingChannel, make_guild
+from utils import parse_csv
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), 'fixtures')
+BASELINES_DIR = os.path.join(os.path.dirname(__file__), 'baselines')
+
+# Member counts of the synthetic guilds, unless given on the command line
+MEMBER_COUNTS = (10_000, 100_000)
+
+# Each benchmark runs at least MIN_RUNS times, then until TIME_BUDGET seconds or MAX_RUNS runs
+MIN_RUNS = 5
+MAX_RUNS = 1000
+TIME_BUDGET = 2.0
+
+# A benchmark whose best latency or peak allocation grew by more than this is reported as a
+# regression. The best (minimum) latency is compared since it's the least affected by noise.
+REGRESSION_THRESHOLD = 0.10
+
+# The date the cakeday benchmarks look up
+NOW = datetime(2025, 3, 15, 20, tzinfo=timezone.utc)
+
+# The almanac fixture stands in for this sheet
+SHEET_ID = 'benchmark'
+
+class Benchmark:
+    """
+    A coroutine function to measure, the number of items one call processes, and the channel it
+    sends to, if any.
+    """
+
+    def __init__(self, name, func, items=1, channel=None):
+        self.name = name
+        self.func = func
+        self.items = items
+        self.channel = channel
+
+async def measure(benchmark):
+    """
+    Time the benchmark, then run it once more under tracemalloc, and return the results as a dict.
+    """
+    await benchmark.func()  # Warm up, e.g. the sheet index and the regex caches
+
+    # Like timeit, keep the garbage collector from landing in the middle of some of the runs
+    latencies = []
+    gc.collect()
+    gc.disable()
+    try:
+        started = time.perf_counter()
+        while len(latencies) < MIN_RUNS or (len(latencies) < MAX_RUNS and time.perf_counter() - started < TIME_BUDGET):
+            run_started = time.perf_counter()
+            await benchmark.func()
+            latencies.append(time.perf_counter() - run_started)
+    finally:
+        gc.enable()
+
+    if benchmark.channel:
+        benchmark.channel.reset()
+
+    tracemalloc.start()
+    try:
+        baseline = tracemalloc.get_traced_memory()[0]
+        await benchmark.func()
+        peak = tracemalloc.get_traced_memory()[1] - baseline
+    finally:
+        tracemalloc.stop()
+
+    mean = statistics.fmean(latencies)
+    return {
+        'runs': len(latencies),
+        'min_ms': min(latencies) * 1000,
+        'mean_ms': mean * 1000,
+        'p50_ms': statistics.median(latencies) * 1000,
+        'p95_ms': _percentile(latencies, 0.95) * 1000,
+        'items_per_second': benchmark.items / mean if mean else 0.0,
+        'peak_kib': peak / 1024,
+        'sends': benchmark.channel.sends if benchmark.channel else 0,
+        'characters': benchmark.channel.characters if benchmark.channel else 0,
+    }
+
+def _percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+# The benchmarks. Setup (building guilds, reading fixtures) happens here, outside of the timing.
+
+def cakeday_benchmarks(member_count):
+    guild = make_guild(member_count)
+    index = cakeday.AnniversaryIndex()
+    index.build(guild)
+
+    async def scan():
+        cakeday.get_members(guild, now=NOW)
+
+    async def build_index():
+        cakeday.AnniversaryIndex().build(guild)
+
+    async def indexed():
+        cakeday.get_members(guild, now=NOW, index=index)
+
+    async def month():
+        cakeday.get_members_in_range(guild, datetime(2025, 3, 1), datetime(2025, 3, 31))
+
+    return [
+        Benchmark(f'cakeday.get_members scan [{member_count}]', scan, member_count),
+        Benchmark(f'cakeday.AnniversaryIndex.build [{member_count}]', build_index, member_count),
+        Benchmark(f'cakeday.get_members indexed [{member_count}]', indexed),
+        Benchmark(f'cakeday.get_members_in_range 31d [{member_count}]', month, member_count),
+    ]
+
+def announcement_benchmarks():
+    channel = RecordingChannel('cakeday-announcements')
+    assets = FakeAssets()
+    members = [(member, max(NOW.year - member.joined_at.year, 1)) for member in make_guild(150).members]
+
+    async def announce():
+        await cakeday.make_announcement(members, channel, assets)
+
+    return [Benchmark('cakeday.make_announcement [150]', announce, len(members), channel)]
+
+def almanac_benchmarks():
+    with open(os.path.join(FIXTURES_DIR, 'almanac.csv'), 'r', encoding='utf-8') as f:
+        csv_data = f.read()
+
+    rows = parse_csv(csv_data)
+    sheet_cache._snapshots[SHEET_ID] = sheet_cache.Snapshot(rows, fetched_at=time.time())
+
+    async def index():
+        almanac._build_index(parse_csv(csv_data))
+
+    async def entry():
+        await almanac.generate_embed(SHEET_ID, timestamp=NOW)
+
+    async def forecast():
+        await almanac.generate_embeds(SHEET_ID, datetime(2025, 3, 1), datetime(2025, 3, 31))
+
+    return [
+        Benchmark('almanac parse + index', index, len(rows)),
+        Benchmark('almanac.generate_embed', entry),
+        Benchmark('almanac.generate_embeds 31d', forecast, 31),
+    ]
+
+def chunk_benchmarks():
+    role = FakeRole(3, 'Players')
+    text = _inventory_text()
+
+    async def inventory():
+        utils.pack_inventory(text, role)
+
+    return [
+        Benchmark(f'utils.pack_inventory [{len(text)} chars]', inventory, len(text)),
+    ]
+
+def command_benchmarks(member_count):
+    guild = make_guild(member_count)
+    index = cakeday.AnniversaryIndex()
+    index.build(guild)
+
+    staff = FakeRole(4, 'Staff')
+    author = FakeMember(1, NOW, 'Benchmarker', roles=(staff,))
+    channel = RecordingChannel('bot-commands', guild=guild)
+
+    client = SimpleNamespace()
+    members_ready = asyncio.Event()
+    members_ready.set()
+    context = SimpleNamespace(
+        staff_role=staff, member_source=guild, members_ready=members_ready, cakeday_index=index, almanac_gsheet_id=SHEET_ID,
+    )
+
+    def command(text):
+        message = FakeMessage(channel, commands.PREFIX + text, author=author, guild=guild)
+        return lambda: commands.handle(client, context, message)
+
+    return [
+        Benchmark('commands.handle hello', command('hello'), channel=channel),
+        Benchmark('commands.handle unknown', command('nonsense'), channel=channel),
+        Benchmark(f'commands.handle cakeday [{member_count}]', command(f'cakeday {NOW.date()}'), channel=channel),
+        Benchmark('commands.handle almanac', command(f'almanac {NOW.date()}'), channel=channel),
+    ]
+
+def _inventory_text(seed=0):
+    """
+    A shop inventory shaped like marketGenerator.py's output: a heading, sections of priced items
+    separated by blank lines, and a mention of @Players.
+    """
+    rng = random.Random(seed)
+    words = ['cursed', 'silver', 'dagger', 'amulet', 'potion', 'healing', 'vial', 'holy', 'water',
+             'lantern', 'hooded', 'cloak', 'tarokka', 'deck', 'wolfsbane', 'garlic', 'stake', 'mirror']
+
+    paragraphs = ['**The Vistani Market is open!** @Players']
+    for section in range(12):
+        lines = [f'__**Wagon {section + 1}**__']
+        for _ in range(rng.randint(5, 15)):
+            name = ' '.join(rng.choice(words) for _ in range(rng.randint(2, 5))).title()
+            lines.append(f'* {name} - {rng.randint(1, 500)} gp')
+        paragraphs.append('\n'.join(lines))
+    paragraphs.append('*The wagons leave in three days.*')
+
+    return '\n\n'.join(paragraphs)
+
+def all_benchmarks(member_counts):
+    benchmarks = []
+    for member_count in member_counts:
+        benchmarks += cakeday_benchmarks(member_count)
+    benchmarks += announcement_benchmarks()
+    benchmarks += almanac_benchmarks()
+    benchmarks += chunk_benchmarks()
+    benchmarks += command_benchmarks(member_counts[0])
+    return benchmarks
+
+# Reporting
+
+def format_results(results, baseline=None, threshold=REGRESSION_THRESHOLD):
+    """
+    Return the lines of a table of results, with the change from 'baseline' if given, and the names
+    of the benchmarks that regressed.
+    """
+    lines = [f'{"benchmark":<52} {"runs":>5} {"best ms":>10} {"p50 ms":>10} {"p95 ms":>10} {"items/s":>12} {"peak KiB":>10} {"sends":>6} {"chars":>7}']
+    regressions = []
+
+    for name, result in results.items():
+        line = (
+            f'{name:<52} {result["runs"]:>5} {result["min_ms"]:>10.3f} {result["p50_ms"]:>10.3f} {result["p95_ms"]:>10.3f} '
+            f'{result["items_per_second"]:>12,.0f} {result["peak_kib"]:>10.1f} {result["sends"]:>6} {result["characters"]:>7}'
+        )
+
+        before = baseline.get(name) if baseline else None
+        if before:
+            latency = _change(before['min_ms'], result['min_ms'])
+            memory = _change(before['peak_kib'], result['peak_kib'])
+            line += f'  best {latency:+.0%} peak {memory:+.0%}'
+            if latency > threshold or memory > threshold:
+                line += '  REGRESSION'
+                regressions.append(name)
+
+        lines.append(line)
+
+    return lines, regressions
+
+def _change(before, after):
+    return (after - before) / before if before else 0.0
+
+def save_baseline(label, results, member_counts):
+    os.makedirs(BASELINES_DIR, exist_ok=True)
+    path = os.path.join(BASELINES_DIR, f'{label}.json')
+
+    data = {
+        'label': label,
+        'commit': _git_commit(),
+        'python': sys.version.split()[0],
+        'created_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'member_counts': list(member_counts),
+        'results': results,
+    }
+
+    temp_path = f'{path}.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=2)
+    os.replace(temp_path, path)
+    return path
+
+def load_baseline(label):
+    with open(os.path.join(BASELINES_DIR, f'{label}.json'), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+async def main(args):
+    baseline = load_baseline(args.compare) if args.compare else None
+    if baseline:
+        print(f'Comparing against {args.compare} (commit {baseline["commit"]}, {baseline["created_at"]})')
+
+    results = {}
+    for benchmark in all_benchmarks(args.members):
+        if args.filter and args.filter not in benchmark.name:
+            continue
+        results[benchmark.name] = await measure(benchmark)
+        print(f'  {benchmark.name}: {results[benchmark.name]["p50_ms"]:.3f} ms', file=sys.stderr)
+
+    lines, regressions = format_results(results, baseline['results'] if baseline else None, args.threshold)
+    print('\n'.join(lines))
+
+    if args.save is not None:
+        label = args.save or _git_commit() or 'latest'
+        print(f'Saved baseline to {save_baseline(label, results, args.members)}')
+
+    if regressions:
+        print(f'{len(regressions)} regression(s) of more than {args.threshold:.0%}')
+        return 1
+    return 0
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Run the offline benchmarks.')
+    parser.add_argument('--members', type=int, nargs='+', default=list(MEMBER_COUNTS), help='member counts of the synthetic guilds')
+    parser.add_argument('--filter', help='only run the benchmarks whose name contains this')
+    parser.add_argument('--save', nargs='?', const='', help='save the results as a baseline with this label (default: the current commit)')
+    parser.add_argument('--compare', help='compare the results with the baseline saved with this label')
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD, help='the relative growth reported as a regression (default: %(default)s)')
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main(parse_args())))
@@ -3,45 +3,189 @@
 # Holds the logic for finding users with a given Cakeday (AKA anniversary of them joining the server)
 # and congratulating them with a special announcement.
 
+import asyncio
 import logging
+import tracing
 
-from discord import File
-from datetime import datetime, time, timezone
-from utils import embed_role_mention, embed_nickname_mention, partition
+from collections import namedtuple
+from discord import DiscordServerError, Embed, File, HTTPException
+from datetime import datetime, time, timedelta, timezone
+from scheduler import Daily
+from utils import embed_role_mention, embed_nickname_mention, pack_messages
 
 # The Cakeday Announcement task checks every day at 8pm UTC
 CHECK_TIME = time(hour=20)
+SCHEDULE = Daily(CHECK_TIME)
+
+# The longest date range that can be reported on at once
+MAX_RANGE_DAYS = 366
+
+# Adding the Year 1 Player role is done for several members at once, retrying transient failures.
+# All of these requests share one rate limit bucket, which discord.py tracks for us, so there is no
+# point in making many more concurrent requests than the bucket allows.
+ROLE_CONCURRENCY = 5
+ROLE_RETRIES = 3
+ROLE_RETRY_BACKOFF = 1.0  # Seconds, doubled after each retry
 
 # Relative path to the image for the public announcement
 IMAGE_PATH = 'images/cake.png'
 
 log = logging.getLogger('app.cakeday')
 
-def get_members(guild, now=datetime.now(timezone.utc)):
+# The outcome of adding the Year 1 Player role to one member. 'error' is None on success.
+RoleResult = namedtuple('RoleResult', ['member', 'years', 'error'])
+
+def get_members(guild, now=None, index=None):
     """
     Get a list of all server members having their cakeday on the same date as 'now' as tuples
     of (member, years). The list is sorted by years ASC primary, name ASC secondary.
+
+    If an AnniversaryIndex for the guild is given, only the members in the bucket for that date
+    are considered; otherwise every member of the guild is checked.
     """
-    cakeday_members = []
+    if now is None:
+        now = datetime.now(timezone.utc)
 
-    for member in guild.members:
-        if member.bot:
-            continue # Cake is for humans
+    if index is not None:
+        candidates = index.lookup(guild, now.month, now.day)
+    else:
+        candidates = (member for member in guild.members if not member.bot)  # Cake is for humans
+
+    cakeday_members = []
 
+    for member in candidates:
         joined_at = member.joined_at
         if joined_at.month == now.month and joined_at.day == now.day and joined_at.year < now.year:
-            log.debug(f'Server {guild.name} member ({member.display_name}, {member.joined_at}) has their cakeday on {now.date()}')
             years = now.year - joined_at.year
             cakeday_members.append((member, years))
 
+    log.debug('Server %s has %d members with their cakeday on %s', guild.name, len(cakeday_members), now.date())
+
+    _sort_members(cakeday_members)
+    return cakeday_members
+
+def get_members_in_range(guild, start, end, index=None):
+    """
+    Get the cakeday members for every date from 'start' to 'end' inclusive as a dictionary of
+    date -> list of (member, years), each list sorted as in get_members. Dates without any cakeday
+    members are omitted. The members (or index buckets) are only visited once for the whole range.
+    """
+    if isinstance(start, datetime):
+        start = start.date()
+    if isinstance(end, datetime):
+        end = end.date()
+
+    if end < start:
+        raise ValueError(f'End date {end} is before start date {start}')
+    if (end - start).days >= MAX_RANGE_DAYS:
+        raise ValueError(f'Date range is longer than {MAX_RANGE_DAYS} days')
+
+    # (month, day) -> the dates in range falling on it (more than one if the range spans years)
+    dates_by_day = {}
+    day = start
+    while day <= end:
+        dates_by_day.setdefault((day.month, day.day), []).append(day)
+        day += timedelta(days=1)
+
+    if index is not None:
+        candidates = (member for month, day in dates_by_day for member in index.lookup(guild, month, day))
+    else:
+        candidates = (member for member in guild.members if not member.bot)  # Cake is for humans
+
+    cakeday_members = {}
+
+    for member in candidates:
+        joined_at = member.joined_at
+        for day in dates_by_day.get((joined_at.month, joined_at.day), ()):
+            if joined_at.year < day.year:
+                cakeday_members.setdefault(day, []).append((member, day.year - joined_at.year))
+
+    for members in cakeday_members.values():
+        _sort_members(members)
+
+    return dict(sorted(cakeday_members.items()))
+
+def _sort_members(cakeday_members):
+    """
+    Sort a list of (member, years) in place by years ASC primary, name ASC secondary.
+    """
     cakeday_members.sort(key=lambda x: x[0].display_name) # secondary sort by name ASC
     cakeday_members.sort(key=lambda x: x[1]) # primary sort by years ASC
 
-    return cakeday_members
+class AnniversaryIndex:
+    """
+    An index of server members by the (month, day) they joined, so that finding the members having
+    their cakeday on a given date doesn't require scanning the entire member list. The index is
+    built once with `build` and then kept current from the Client's member events.
+    """
 
-async def make_announcement(members, channel):
+    def __init__(self):
+        self._buckets = {}  # (month, day) -> set of member IDs
+        self._dates = {}  # member ID -> (month, day), for removals and updates
+
+    def __len__(self):
+        return len(self._dates)
+
+    def build(self, guild):
+        """
+        (Re)build the index from every member of the guild.
+        """
+        self._buckets.clear()
+        self._dates.clear()
+
+        for member in guild.members:
+            self.add(member)
+
+        log.info(f'Indexed join dates of {len(self)} members of server {guild.name}')
+
+    def add(self, member):
+        """
+        Add (or re-add) a member to the index. Bots and members without a join date are ignored.
+        """
+        self.remove(member)
+
+        if member.bot or member.joined_at is None:
+            return
+
+        key = (member.joined_at.month, member.joined_at.day)
+        self._buckets.setdefault(key, set()).add(member.id)
+        self._dates[member.id] = key
+
+    def remove(self, member):
+        """
+        Remove a member from the index, if present.
+        """
+        key = self._dates.pop(member.id, None)
+        if key is None:
+            return
+
+        bucket = self._buckets[key]
+        bucket.discard(member.id)
+        if not bucket:
+            del self._buckets[key]
+
+    def update(self, before, after):
+        """
+        Re-index a member if anything we index on has changed.
+        """
+        if before.joined_at != after.joined_at or before.bot != after.bot:
+            self.add(after)
+
+    def lookup(self, guild, month, day):
+        """
+        Return the guild members who joined on the given month and day of any year.
+        """
+        members = []
+        for member_id in self._buckets.get((month, day), ()):
+            member = guild.get_member(member_id)
+            if member:
+                members.append(member)
+        return members
+
+async def make_announcement(members, channel, assets=None):
     """
-    Make a public announcement to the playerbase congratulating cakeday members.
+    Make a public announcement to the playerbase congratulating cakeday members. If an AssetCache
+    is given, the cake image is shown from its uploaded URL instead of being uploaded again.
     """
     if not members:
         log.warn('make_announcement called with no members - likely a bug')
@@ -73,70 +217,96 @@ async def make_announcement(members, channel):
     epilogue = '*Players who achieve anniversaries in Enter Ravenloft will be recognised for '
     epilogue += 'their commitment to the server with a special ⭐ (optional) alongside their name.*'
 
-    if len(callouts) <= 10:
-        return await _announce_compact(channel, preface, callouts, thanks, epilogue)
-    else:
-        return await _announce_split(channel, preface, callouts, thanks, epilogue)
+    return await _announce(channel, preface, callouts, thanks, epilogue, assets)
 
-async def _announce_compact(channel, preface, callouts, thanks, epilogue):
+async def _announce(channel, preface, callouts, thanks, epilogue, assets=None):
     """
-    Make the public announcement in a single message (+ epilogue). Return the
-    primary message that was sent.
+    Make the public announcement in as few messages as possible (+ epilogue), splitting member
+    mentions across messages only when needed to stay below Discord's 2000 character limit.
+    Return the first message that was sent.
     """
-    output = preface
-    for callout in callouts:
-        output += callout
-    output += '\n'
-    output += thanks
+    with tracing.span('chunk', callouts=len(callouts)):
+        messages = pack_messages([preface, *callouts, '\n' + thanks], separator='')
 
-    image = None
-    with open(IMAGE_PATH, 'rb') as f:
-        image = File(f)
+    sent = []
+    for number, message in enumerate(messages[:-1], 1):
+        with tracing.span('send', message=number, length=len(message)):
+            sent.append(await channel.send(message))
 
-    sent = await channel.send(content=output, file=image)
+    with tracing.span('image_url'):
+        image_url = await assets.url(IMAGE_PATH) if assets else None
 
-    # The epilogue text is sent as a separate message so that the image attachment appears
-    # visually just below "Happy Cake Day".
-    await channel.send(epilogue)
+    with tracing.span('send', message=len(messages), length=len(messages[-1]), uploaded=image_url is None):
+        if image_url:
+            sent.append(await channel.send(content=messages[-1], embed=Embed().set_image(url=image_url)))
+        else:
+            # No reusable URL, so upload the image with the message
+            file = await assets.file(IMAGE_PATH) if assets else File(IMAGE_PATH)
+            sent.append(await channel.send(content=messages[-1], file=file))
 
-    return sent
+    # The epilogue text is sent as a separate message so that the image appears visually just
+    # below "Happy Cake Day".
+    with tracing.span('send', message='epilogue'):
+        await channel.send(epilogue)
 
-async def _announce_split(channel, preface, callouts, thanks, epilogue):
+    return sent[0]
+
+async def add_role(members, year_one_player_role):
     """
-    Make the public announcement by splitting member mentions into multiple messages.
-    This is to stay below Discord's 2000 character limit for large numbers of members.
-    Returns the first "preface" message that was sent.
+    Adds the Year 1 Player role to the specified members, a few at a time, and returns a list of
+    RoleResult in the same order as 'members'. A failure for one member doesn't stop the others.
     """
-    sent = await channel.send(preface)
+    if not year_one_player_role:
+        log.error(f'year_one_player_role is None, cannot add role to {len(members)} members')
+        return [RoleResult(member, years, 'role not found') for member, years in members]
 
-    for batch in partition(callouts, 10):
-        await channel.send(batch.join(''))
+    semaphore = asyncio.Semaphore(ROLE_CONCURRENCY)
 
-    image = None
-    with open(IMAGE_PATH, 'rb') as f:
-        image = File(f)
+    async def add_one(member, years):
+        async with semaphore:
+            with tracing.span('add_role', member=member.id) as span:
+                error = await _add_role_to_member(member, year_one_player_role)
+                if span and error:
+                    span.error = error
+            return RoleResult(member, years, error)
 
-    await channel.send(content=thanks, file=image)
+    with tracing.span('add_roles', members=len(members)):
+        results = await asyncio.gather(*(add_one(member, years) for member, years in members))
 
-    await channel.send(epilogue)
+    failures = sum(1 for result in results if result.error)
+    log.info(f'Added {year_one_player_role.name} role to {len(results) - failures} of {len(results)} members')
 
-    return sent
+    return results
 
-async def add_role(members, year_one_player_role):
+async def _add_role_to_member(member, role):
     """
-    Adds the Year 1 Player role to the specified members.
+    Add the role to a single member, retrying server errors with exponential backoff. Returns None
+    on success or a short description of the error.
     """
-    if year_one_player_role:
-        for member, years in members:
-            await member.add_roles(year_one_player_role, reason='Cakeday')
-        return True
-    else:
-        log.error(f'year_one_player_role is None, cannot add role to {len(members)} members')
-        return False
-
-async def notify_staff(members, channel, role, message_url, success):
+    if member.get_role(role.id):
+        return None  # Nothing to do
+
+    for attempt in range(ROLE_RETRIES + 1):
+        try:
+            await member.add_roles(role, reason='Cakeday')
+            return None
+        except (DiscordServerError, asyncio.TimeoutError) as e:
+            if attempt == ROLE_RETRIES:
+                log.error(f'Giving up adding {role.name} role to {member.display_name}: {e!r}')
+                return str(e) or type(e).__name__
+
+            delay = ROLE_RETRY_BACKOFF * (2 ** attempt)
+            log.warning(f'Transient error adding {role.name} role to {member.display_name}, retrying in {delay}s: {e!r}')
+            await asyncio.sleep(delay)
+        except HTTPException as e:
+            # Includes Forbidden and NotFound (e.g. the member left), which won't succeed on retry
+            log.error(f'Unable to add {role.name} role to {member.display_name}: {e}')
+            return str(e)
+
+async def notify_staff(members, channel, role, message_url, role_results):
     """
     Make a private announcement so that staff can add a special role to cakeday members.
+    'role_results' is the list of RoleResult returned by add_role.
     """
     if not members:
         log.warn('notify_staff called with no members - likely a bug')
@@ -144,6 +314,9 @@ async def notify_staff(members, channel, role, message_url, success):
 
     log.info(f'Notifying mods about {len(members)} members having cakedays today')
 
+    failures = [result for result in role_results if result.error]
+    success = bool(role_results) and not failures
+
     mods = embed_role_mention(role.id) if role and not success else 'Mods'
     member_words = 'member is' if len(members) == 1 else 'members are'
     output = f'{mods} - {len(members)} {member_words} celebrating their cakeday today ({message_url}):\n'
@@ -156,7 +329,12 @@ async def notify_staff(members, channel, role, message_url, success):
         output += 'The `Year 1 Player` role was added automatically - nothing for you to do!\n'
         output += '...*UNLESS* one of these users was a Staff member. Then you\'ll need to add the '
         output += 'appropriate additional role(s) yourself (Year 1 Helper, etc).'
+    elif len(failures) < len(role_results):
+        output += 'The `Year 1 Player` role was added automatically, except to these members - please add it when you can:\n'
+        for result in failures:
+            output += f'\t{result.member.display_name} ({result.error})\n'
     else:
         output += 'The `Year 1 Player` role was **NOT** added automatically - please add it when you can.'
 
-    await channel.send(output)
+    with tracing.span('send', message='staff'):
+        await channel.send(output)
@@ -1,202 +1,346 @@
 # client.py
 #
 # This module holds the code for the Client class, which our connection to the Discord API.
-# Code in this class is responsible for looking up server entities and bootstrapping any
-# background tasks.
+# Code in this class is responsible for looking up server entities and scheduling any
+# background jobs. One Client can serve several servers (see guild_config.py); each background
+# job runs for every server that has its feature enabled.
 
+import asyncio
 import discord
 import logging
-import os
 
 import almanac
+import asset_cache
 import cakeday
 import commands
+import dispatcher
+import generator_pool
+import guild_config
+import http_client
+import jobs
+import loop_monitor
+import member_store
+import metrics
+import pregen
+import scheduler
 import staffxp_reminder
+import tracing
 import tattoo_parlor
 import vistani_market
 
-from discord.ext import tasks
+from datetime import timedelta
+from guild_context import GuildContext
 from utils import notify_maintainer
 
-class Client(discord.Client):
+# How many servers a job works on at once
+GUILD_CONCURRENCY = 5
+
+class Client(discord.AutoShardedClient):
     """
     The Client class leverages the Discord APIs to connect the bot to Discord.
     """
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, low_memory=member_store.LOW_MEMORY, guild_configs=None, **kwargs):
+        if low_memory:
+            # Don't cache or chunk members at all - see member_store.py
+            kwargs.setdefault('member_cache_flags', discord.MemberCacheFlags.none())
+            kwargs.setdefault('chunk_guilds_at_startup', False)
         super().__init__(*args, **kwargs)
 
         self.log = logging.getLogger('app.Client')
 
+        self.low_memory = low_memory
+        self.guild_configs = guild_configs if guild_configs is not None else guild_config.load()
+        self.contexts = {}  # guild ID -> GuildContext, in config order
+        self.assets = asset_cache.AssetCache()
+        self.dispatcher = dispatcher.Dispatcher()
+        self.pregenerated = pregen.PregenQueue()
+        self.loop_monitor = loop_monitor.LoopMonitor(on_block=self.on_loop_blocked)
+        self.scheduler = scheduler.Scheduler(before=self.wait_until_ready, on_error=self.on_task_error)
+        self.metrics_server = None  # Started by setup_hook if METRICS_PORT is set
+        self.upload_task = None  # Uploading the assets ahead of time, once ready
+
     async def setup_hook(self) -> None:
-        self.refresh_vistani_market.start()
-        self.refresh_tattoo_parlor.start()
-        self.announce_cakedays.start()
-        self.refresh_almanac.start()
-        self.heartbeat.start()
-        self.remind_staffxp.start()
+        await http_client.open_session()
+        self.loop_monitor.start()
+        self.metrics_server = await metrics.start_server()
+        self.dispatcher.start()
+        if not jobs.using_workers():
+            generator_pool.start()  # Warm up the worker early instead of at midnight
+
+        for name, rule, func, catch_up in self.job_rules():
+            self.scheduler.add(name, rule, func, catch_up=catch_up)
+        self.scheduler.start()
+
+    def job_rules(self):
+        """
+        Return every background job as (name, rule, func, catch_up). The rules are read from the
+        feature modules each time, so `$pw reload` can reschedule the jobs after reloading them.
+        """
+        # To add a new background job, give it a rule here. Jobs are called with the (UTC) time
+        # they were scheduled for; catch_up makes up a run missed while the bot was down.
+        lead = pregen.LEAD_TIME
+        return [
+            ('refresh_vistani_market', vistani_market.SCHEDULE, self.refresh_vistani_market, True),
+            ('refresh_tattoo_parlor', tattoo_parlor.SCHEDULE, self.refresh_tattoo_parlor, True),
+            ('announce_cakedays', cakeday.SCHEDULE, self.announce_cakedays, True),
+            ('refresh_almanac', almanac.SCHEDULE, self.refresh_almanac, True),
+            ('pregenerate_vistani_market', scheduler.Lead(vistani_market.SCHEDULE, lead), self.pregenerate_vistani_market, False),
+            ('pregenerate_tattoo_parlor', scheduler.Lead(tattoo_parlor.SCHEDULE, lead), self.pregenerate_tattoo_parlor, False),
+            ('pregenerate_almanac', scheduler.Lead(almanac.SCHEDULE, lead), self.pregenerate_almanac, False),
+            ('log_loop_lag', scheduler.Interval(timedelta(hours=1)), self.log_loop_lag, False),
+            ('remind_staffxp', staffxp_reminder.SCHEDULE, self.remind_staffxp, True),
+        ]
+
+    async def close(self):
+        await self.scheduler.stop()
+        await self.dispatcher.stop()
+        await super().close()
+        await http_client.close_session()
+        await generator_pool.shutdown()
+        await self.loop_monitor.stop()
+        if self.metrics_server:
+            await self.metrics_server.cleanup()
 
     async def on_ready(self):
-        self.log.info(f'Logged in as {self.user} (ID: {self.user.id})')
+        self.log.info(f'Logged in as {self.user} (ID: {self.user.id}) with {self.shard_count} shard(s)')
         self.log.info('------')
 
         # Sets the silly 'Watching you…' status
         await self.change_presence(activity=discord.Activity(type=discord.ActivityType.watching, name='you…'))
 
-        log_result = lambda x, subject: self.log.info(f'Found {subject} = {x.name}') if x else self.log.error(f'Unable to find {subject}')
-        log_nameless = lambda x, subject: self.log.info(f'Found {subject} = {x}') if x else self.log.error(f'Unable to find {subject}')
-
-        self.guild = self.get_guild(int(os.environ['SERVER']))
-        log_result(self.guild, 'server')
-    
-        self.maintainer = self.guild.get_member(int(os.environ['MAINTAINER']))
-        log_result(self.maintainer, 'maintainer')
-
-        # Channels
-        self.vistani_inventory_channel = self.guild.get_channel(int(os.environ['VISTANI_INVENTORY_CHANNEL']))
-        log_result(self.vistani_inventory_channel, 'Vistani Market inventory channel')
-
-        self.tattoo_inventory_channel = self.guild.get_channel(int(os.environ['TATTOO_INVENTORY_CHANNEL']))
-        log_result(self.tattoo_inventory_channel, 'Tattoo Parlor inventory channel')
-
-        self.cakeday_announcement_channel = self.guild.get_channel(int(os.environ['CAKEDAY_ANNOUNCEMENT_CHANNEL']))
-        log_result(self.cakeday_announcement_channel, 'cakeday announcement channel')
-
-        self.almanac_channel = self.guild.get_channel(int(os.environ['ALMANAC_CHANNEL']))
-        log_result(self.almanac_channel, 'Barovian Almanac channel')
-
-        self.bot_notification_channel = self.guild.get_channel(int(os.environ['BOT_NOTIFICATION_CHANNEL']))
-        log_result(self.bot_notification_channel, 'bot notification channel')
-
-        self.bot_development_channel = self.guild.get_channel(int(os.environ['BOT_DEVELOPMENT_CHANNEL']))
-        log_result(self.bot_development_channel, 'bot development channel')
-
-        self.staffxp_reminder_channel = self.guild.get_channel(int(os.environ['STAFFXP_REMINDER_CHANNEL']))
-        log_result(self.staffxp_reminder_channel, 'Staff XP reminder channel')
-
-        # Roles
-        self.players_role = self.guild.get_role(int(os.environ['PLAYERS_ROLE']))
-        log_result(self.players_role, 'Players role')
-
-        self.staff_role = self.guild.get_role(int(os.environ['STAFF_ROLE']))
-        log_result(self.staff_role, 'Staff role')
-
-        self.mods_role = self.guild.get_role(int(os.environ['MODS_ROLE']))
-        log_result(self.mods_role, 'Mods role')
-
-        self.year_one_player_role = self.guild.get_role(int(os.environ['YEAR_ONE_PLAYER_ROLE']))
-        log_result(self.year_one_player_role, 'Year 1 Player role')
+        self.use_contexts(await self.resolve_contexts(self.guild_configs))
+        await asyncio.gather(*(context.load_members() for context in self.contexts.values()))
 
-        self.helper_role = self.guild.get_role(int(os.environ['HELPER_ROLE']))
-        log_result(self.helper_role, 'Helper role')
+        # Make sure the cakeday image has a working URL well before it's needed
+        self.upload_task = asyncio.create_task(self.assets.url(cakeday.IMAGE_PATH), name='upload_assets')
+        self.upload_task.add_done_callback(self._log_upload)
 
-        # Google Sheets
-        self.almanac_gsheet_id = os.environ['ALMANAC_GSHEET_ID']
-        log_nameless(self.almanac_gsheet_id, 'Almanac Google Sheet ID')
+    def _log_upload(self, task):
+        if task.cancelled():
+            return
+        if task.exception():
+            self.log.error(f'Uploading {cakeday.IMAGE_PATH} failed: {task.exception()!r}')
+        elif task.result() is None:
+            self.log.warning(f'No URL for {cakeday.IMAGE_PATH} yet, it will be uploaded when first needed')
+
+    async def resolve_contexts(self, configs, previous=None):
+        """
+        Return a GuildContext for each configured server, keyed by guild ID. Servers the bot isn't in
+        are logged and left out. The member index of a server in 'previous' is carried over rather
+        than needing to be loaded again.
+        """
+        contexts = {}
+        for config in configs:
+            guild = self.get_guild(config.server)
+            if guild is None:
+                self.log.error(f'Unable to find server {config.name} ({config.server})')
+                continue
+
+            self.log.info(f'Found server = {guild.name}')
+            context = GuildContext(config, guild, self.low_memory)
+            await context.resolve(self)
+            if previous and guild.id in previous:
+                context.adopt_members(previous[guild.id])
+            contexts[guild.id] = context
+        return contexts
+
+    def use_contexts(self, contexts):
+        """
+        Switch every job, command and event over to the given GuildContexts.
+        """
+        self.contexts = contexts
+
+        # Static images are uploaded to the first server's development channel once, then reused by URL
+        if self.primary:
+            self.assets.upload_channel = self.primary.bot_development_channel
+
+    @property
+    def primary(self):
+        """
+        The first configured server, which gets the reports that don't belong to any one server.
+        """
+        return next(iter(self.contexts.values()), None)
+
+    def context_for(self, guild):
+        """
+        Return the GuildContext of a server we serve, or None (e.g. for a DM).
+        """
+        return self.contexts.get(guild.id) if guild else None
+
+    def serving(self, feature):
+        """
+        Return the GuildContexts of the servers that have 'feature' enabled.
+        """
+        return [context for context in self.contexts.values() if context.enabled(feature)]
+
+    async def fan_out(self, feature, func):
+        """
+        Await func(context) for every server with 'feature' enabled, at most GUILD_CONCURRENCY at a
+        time. A failure in one server is reported to that server's maintainer and doesn't stop the
+        others.
+        """
+        semaphore = asyncio.Semaphore(GUILD_CONCURRENCY)
+
+        async def run(context):
+            async with semaphore:
+                with tracing.span('guild', guild=context.name):
+                    try:
+                        await func(context)
+                    except Exception as e:
+                        self.log.exception(f'{feature} failed for server {context.name}')
+                        await notify_maintainer(context.bot_development_channel, context.maintainer, e)
+
+        await asyncio.gather(*(run(context) for context in self.serving(feature)))
 
     # Message handling: route bot commands to the commands module
     async def on_message(self, message):
         if message.author == self.user:
             return
         elif message.content.startswith(commands.PREFIX):
+            context = self.context_for(message.guild)
+            if context is None:
+                return  # DMs and servers we don't serve
+
             try:
-                await commands.handle(self, message)
+                await commands.handle(self, context, message)
             except Exception as e:
-                await notify_maintainer(self.bot_development_channel, self.maintainer, e)
+                await notify_maintainer(context.bot_development_channel, context.maintainer, e)
                 raise
 
-    # Vistani Market background task
-    @tasks.loop(time=vistani_market.REFRESH_TIME)
-    async def refresh_vistani_market(self):
-        self.log.debug('refresh_vistani_market: scheduled task has started')
-
-        if vistani_market.should_refresh_today():
-            self.log.info(f'Refreshing Vistani Market inventory in {self.vistani_inventory_channel.name}')
-            output = vistani_market.generate_inventory()
-            await vistani_market.post_inventory(output, self.vistani_inventory_channel, self.players_role)
-        else:
-            self.log.info(f'Not refreshing Vistani Market inventory for {self.vistani_inventory_channel.name} as it is not a scheduled day')
-
-    # Tattoo Parlor background task
-    @tasks.loop(time=tattoo_parlor.REFRESH_TIME)
-    async def refresh_tattoo_parlor(self):
-        self.log.debug('refresh_tattoo_parlor: scheduled task has started')
-
-        if tattoo_parlor.should_refresh_today():
-            self.log.info(f'Refreshing Tattoo Parlor inventory in {self.tattoo_inventory_channel.name}')
-            output = tattoo_parlor.generate_inventory()
-            await tattoo_parlor.post_inventory(output, self.tattoo_inventory_channel, self.players_role)
-        else:
-            self.log.info(f'Not refreshing Tattoo Parlor inventory for {self.tattoo_inventory_channel} as it is not a scheduled day')
-
-    # Cakeday Announcement background task
-    @tasks.loop(time=cakeday.CHECK_TIME)
-    async def announce_cakedays(self):
-        self.log.debug('announce_cakedays: scheduled task has started')
-
-        members = cakeday.get_members(self.guild)
-        if members:
-            self.log.info(f'Server {self.guild.name} has {len(members)} members with cakedays today!')
-            message = await cakeday.make_announcement(members, self.cakeday_announcement_channel)
+    # Member events: keep the cakeday index (and member store) current without rescanning the
+    # member list. Removals use the raw event, which is dispatched even for uncached members.
+    # Updates are only dispatched for cached members, i.e. never in low-memory mode, which is fine
+    # since what the index uses doesn't change (see member_store.py).
+    async def on_member_join(self, member):
+        context = self.context_for(member.guild)
+        if context:
+            context.cakeday_index.add(member)
+            if context.member_store:
+                context.member_store.add(member)
+
+    async def on_raw_member_remove(self, payload):
+        context = self.contexts.get(payload.guild_id)
+        if context:
+            context.cakeday_index.remove(payload.user)
+            if context.member_store:
+                context.member_store.remove(payload.user.id)
+
+    async def on_member_update(self, before, after):
+        context = self.context_for(after.guild)
+        if context:
+            context.cakeday_index.update(before, after)
+            if context.member_store:
+                context.member_store.add(after)
+
+    # Vistani Market background job. The inventory is generated once and posted to every server.
+    async def refresh_vistani_market(self, when):
+        if not self.serving('vistani_market'):
+            return
 
-            try:
-                add_role_success = await cakeday.add_role(members, self.year_one_player_role)
-            except discord.Forbidden | discord.HTTPException as e:
-                self.log.error(f'Exception while adding Year 1 Player role: {e}')
-                add_role_success = False
-            finally:
-                await cakeday.notify_staff(members, self.bot_notification_channel, self.mods_role, message.jump_url, add_role_success)
-        else:
-            self.log.info(f'Server {self.guild.name} has no members with cakedays today')
-
-    # Barovian Almanac background task
-    @tasks.loop(time=almanac.REFRESH_TIME)
-    async def refresh_almanac(self):
-        self.log.debug('refresh_almanac: scheduled task has started')
-
-        entry = almanac.generate_embed(self.almanac_gsheet_id)
-        await almanac.post_entry(entry, self.almanac_channel)
-
-    # Heartbeat background task
-    @tasks.loop(hours=1)
-    async def heartbeat(self):
-        self.log.debug('Heartbeat')
-
-    # Staff XP Reminder background task
-    @tasks.loop(time=staffxp_reminder.TIME)
-    async def remind_staffxp(self):
-        self.log.debug('remind_staffxp: scheduled task has started')
-
-        if staffxp_reminder.should_remind_today():
-            self.log.info(f'Reminding about Staff XP in {self.staffxp_reminder_channel.name}')
-            staffxp_reminder.send_reminder(self.staffxp_reminder_channel, self.helper_role)
-        else:
-            self.log.info(f'Not reminding about Staff XP in {self.staffxp_reminder_channel} as it is not a scheduled day')
-
-
-    # NOTE: If adding a new background task make sure you:
-    #   - add a new @taskname.before_loop decorator to `before_background_tasks`, below
-    #   - add a new @taskname.error decorator to `on_task_error`, below
-    #   - add a call to self.taskname.start() to `setup_hook`, above
-
-    @refresh_vistani_market.before_loop
-    @refresh_tattoo_parlor.before_loop
-    @announce_cakedays.before_loop
-    @refresh_almanac.before_loop
-    @heartbeat.before_loop
-    @remind_staffxp.before_loop
-    async def before_background_tasks(self):
-        self.log.debug('before_background_tasks: waiting for readiness')
-        await self.wait_until_ready()
-        self.log.debug('before_background_tasks: ready now')
-
-    @refresh_vistani_market.error
-    @refresh_tattoo_parlor.error
-    @announce_cakedays.error
-    @refresh_almanac.error
-    @heartbeat.error
-    @remind_staffxp.error
-    async def on_task_error(self, error):
-        self.log.exception(error)
+        output = self.pregenerated.take('vistani_market', when.date()) or await jobs.run('vistani_market')
+
+        async def post(context):
+            self.log.info(f'Refreshing Vistani Market inventory in {context.vistani_inventory_channel.name} of {context.name}')
+            await vistani_market.post_inventory(output, context.vistani_inventory_channel, context.players_role)
+
+        await self.fan_out('vistani_market', post)
 
-        await notify_maintainer(self.bot_development_channel, self.maintainer, error)
+    # Tattoo Parlor background job. The inventory is generated once and posted to every server.
+    async def refresh_tattoo_parlor(self, when):
+        if not self.serving('tattoo_parlor'):
+            return
+
+        output = self.pregenerated.take('tattoo_parlor', when.date()) or await jobs.run('tattoo_parlor')
+
+        async def post(context):
+            self.log.info(f'Refreshing Tattoo Parlor inventory in {context.tattoo_inventory_channel.name} of {context.name}')
+            await tattoo_parlor.post_inventory(output, context.tattoo_inventory_channel, context.players_role)
+
+        await self.fan_out('tattoo_parlor', post)
+
+    # Cakeday Announcement background job
+    async def announce_cakedays(self, when):
+        async def announce(context):
+            await context.members_ready.wait()
+            with tracing.span('find_members') as span:
+                members = cakeday.get_members(context.member_source, now=when, index=context.cakeday_index)
+                if span:
+                    span.set(found=len(members))
+            if members and context.member_store:
+                with tracing.span('resolve_members'):
+                    members = await context.member_store.resolve(members)
+            if members:
+                self.log.info(f'Server {context.name} has {len(members)} members with cakedays today!')
+                message = await cakeday.make_announcement(members, context.cakeday_announcement_channel, self.assets)
+
+                role_results = await cakeday.add_role(members, context.year_one_player_role)
+                await cakeday.notify_staff(members, context.bot_notification_channel, context.mods_role, message.jump_url, role_results)
+            else:
+                self.log.info(f'Server {context.name} has no members with cakedays today')
+
+        await self.fan_out('cakeday', announce)
+
+    # Barovian Almanac background job. Each entry is generated once per sheet, however many servers
+    # use that sheet.
+    async def refresh_almanac(self, when):
+        entries = {}  # sheet ID -> Task returning the Embed, shared by the servers using that sheet
+
+        async def generate(sheet_id):
+            payload = self.pregenerated.take(f'almanac:{sheet_id}', when.date())
+            if not payload:
+                payload = await jobs.run('almanac', sheet_id=sheet_id, timestamp=when.isoformat())
+            return discord.Embed.from_dict(payload)
+
+        async def post(context):
+            sheet_id = context.almanac_gsheet_id
+            if sheet_id not in entries:
+                entries[sheet_id] = asyncio.create_task(generate(sheet_id))
+            await almanac.post_entry(await entries[sheet_id], context.almanac_channel)
+
+        await self.fan_out('almanac', post)
+
+    # Pre-generation background jobs: these run pregen.LEAD_TIME before the midnight posts and
+    # prepare their payloads, so that at the deadline those jobs only have to send them
+    async def pregenerate_vistani_market(self, when):
+        if self.serving('vistani_market'):
+            await self.pregenerated.prepare('vistani_market', when + pregen.LEAD_TIME, lambda: jobs.run('vistani_market'))
+
+    async def pregenerate_tattoo_parlor(self, when):
+        if self.serving('tattoo_parlor'):
+            await self.pregenerated.prepare('tattoo_parlor', when + pregen.LEAD_TIME, lambda: jobs.run('tattoo_parlor'))
+
+    async def pregenerate_almanac(self, when):
+        deadline = when + pregen.LEAD_TIME
+
+        async def prepare(sheet_id):
+            generate = lambda: jobs.run('almanac', sheet_id=sheet_id, timestamp=deadline.isoformat())
+            await self.pregenerated.prepare(f'almanac:{sheet_id}', deadline, generate)
+
+        sheet_ids = {context.almanac_gsheet_id for context in self.serving('almanac')}
+        await asyncio.gather(*(prepare(sheet_id) for sheet_id in sheet_ids))
+
+    # Loop lag summary background job
+    async def log_loop_lag(self, when):
+        self.log.info(self.loop_monitor.summary().rstrip())
+
+    # Staff XP Reminder background job
+    async def remind_staffxp(self, when):
+        async def remind(context):
+            self.log.info(f'Reminding about Staff XP in {context.staffxp_reminder_channel.name} of {context.name}')
+            await staffxp_reminder.send_reminder(context.staffxp_reminder_channel, context.helper_role)
+
+        await self.fan_out('staffxp_reminder', remind)
+
+    async def on_loop_blocked(self, report):
+        if not self.primary or not self.primary.bot_development_channel:
+            return
+
+        await self.primary.bot_development_channel.send(
+            f'Event loop was blocked for {report.duration:.1f}s in {report.task}:\n'
+            f'```\n{report.stack[-1500:]}\n```'
+        )
+
+    async def on_task_error(self, error):
+        if self.primary:
+            await notify_maintainer(self.primary.bot_development_channel, self.primary.maintainer, error)
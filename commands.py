@@ -9,36 +9,64 @@ import re
 
 import almanac
 import cakeday
+import jobs
+import metrics
+import profiler
+import reloader
+import shop_generator
 import staffxp_reminder
 import tattoo_parlor
+import tracing
 import vistani_market
 
 from datetime import datetime
-from utils import embed_nickname_mention
+from discord import File
+from io import BytesIO
+from utils import embed_nickname_mention, partition, send_packed
 
 PREFIX = '$pw '
 
 CMD_HELLO_REGEX = re.compile(r'hello')
 CMD_HELP_REGEX = re.compile(r'help|-h|--help')
-CMD_REFRESH_REGEX = re.compile(r'refresh\s+(\w+)')
-CMD_CAKEDAY_REGEX = re.compile(r'cakeday\s*(\d{4}-\d{2}-\d{2})?')
-CMD_ALMANAC_REGEX = re.compile(r'almanac\s*(\d{4}-\d{2}-\d{2})?')
+CMD_REFRESH_REGEX = re.compile(r'refresh\s+(\w+)(?:\s+(\d+))?')
+CMD_CAKEDAY_REGEX = re.compile(r'cakeday(?:\s+(\d{4}-\d{2}-\d{2})(?:\.\.(\d{4}-\d{2}-\d{2}))?)?')
+CMD_ALMANAC_REGEX = re.compile(r'almanac(?:\s+(\d{4}-\d{2}-\d{2})(?:\.\.(\d{4}-\d{2}-\d{2}))?)?')
 CMD_STAFFXP_REGEX = re.compile(r'staffxp_reminder')
+CMD_LAG_REGEX = re.compile(r'lag')
+CMD_STATS_REGEX = re.compile(r'stats')
+CMD_TRACE_REGEX = re.compile(r'trace(?:\s+(\S+))?')
+CMD_PROFILE_REGEX = re.compile(r'profile\s+(\S+)(?:\s+(.+))?')
+CMD_RELOAD_REGEX = re.compile(r'reload(?:\s+(\w+))?')
+
+# Command names that metrics are recorded under, anything else counts as 'unknown'
+COMMAND_NAMES = frozenset(('hello', 'help', 'refresh', 'cakeday', 'almanac', 'staffxp_reminder', 'lag', 'stats', 'trace', 'profile', 'reload'))
 
 log = logging.getLogger('app.commands')
 
-async def handle(client, message):
+async def handle(client, context, message):
     """
-    Parse a bot command and route it to the correct handler along with any arguments. 
+    Parse a bot command and route it to the correct handler along with any arguments. 'context' is
+    the GuildContext of the server the command was sent in.
     """
     cmd = message.content.removeprefix(PREFIX).strip()
 
-    if message.author.get_role(client.staff_role.id):
-        log.debug(f'Handling: "{cmd}" from {message.author.display_name}')
+    if context.staff_role and message.author.get_role(context.staff_role.id):
+        log.debug('Handling: "%s" from %s', cmd, message.author.display_name)
     else:
-        log.debug(f'Ignoring command from a non-staff user: "{cmd}, {message.author.display_name}"')
+        log.debug('Ignoring command from a non-staff user: "%s", %s', cmd, message.author.display_name)
         return
 
+    name = re.match(r'[a-z_]*', cmd).group()
+    with metrics.track(f'command:{name if name in COMMAND_NAMES else "unknown"}'):
+        await _dispatch(client, context, message, cmd)
+
+    # TODO: enable this once the bot has been updated with 'manage messages' permissions
+    #await message.delete()
+
+async def _dispatch(client, context, message, cmd):
+    """
+    Route the command text to its handler.
+    """
     if match := CMD_HELLO_REGEX.fullmatch(cmd):
         await _handle_hello(message, match)
     elif match := CMD_HELP_REGEX.fullmatch(cmd):
@@ -46,17 +74,24 @@ async def handle(client, message):
     elif match := CMD_REFRESH_REGEX.fullmatch(cmd):
         await _handle_refresh(message, match)
     elif match := CMD_CAKEDAY_REGEX.fullmatch(cmd):
-        await _handle_cakeday(message, match)
+        await _handle_cakeday(context, message, match)
     elif match := CMD_ALMANAC_REGEX.fullmatch(cmd):
-        await _handle_almanac(client, message, match)
+        await _handle_almanac(context, message, match)
     elif match := CMD_STAFFXP_REGEX.fullmatch(cmd):
         await _handle_staffxp(message, match)
+    elif match := CMD_LAG_REGEX.fullmatch(cmd):
+        await _handle_lag(client, message, match)
+    elif match := CMD_STATS_REGEX.fullmatch(cmd):
+        await _handle_stats(message, match)
+    elif match := CMD_TRACE_REGEX.fullmatch(cmd):
+        await _handle_trace(message, match)
+    elif match := CMD_PROFILE_REGEX.fullmatch(cmd):
+        await _handle_profile(client, context, message, match)
+    elif match := CMD_RELOAD_REGEX.fullmatch(cmd):
+        await _handle_reload(client, message, match)
     else:
         await _handle_unknown_command(message)
 
-    # TODO: enable this once the bot has been updated with 'manage messages' permissions
-    #await message.delete()
-
 async def _handle_hello(message, _):
     await message.channel.send('*The creepy doll slowly gives you a thumbs up.*')
 
@@ -65,26 +100,44 @@ async def _handle_help(message, _):
 
 async def _handle_refresh(message, match):
     """
-    Refresh the inventory of a shop and post in the same channel as the command.
+    Refresh the inventory of a shop and post in the same channel as the command. An optional seed
+    reproduces a previously generated inventory (the seed is shown at the end of every inventory
+    generated from native tables).
     """
-    shop = match.group(1)
+    shop, seed = match.groups()
+    seed = int(seed) if seed else None
 
     match shop:
         case 'vistani':
-            output = vistani_market.generate_inventory()
-            await vistani_market.post_inventory(output, message.channel)
+            kind, module = 'vistani_market', vistani_market
         case 'tattoo':
-            output = tattoo_parlor.generate_inventory()
-            await tattoo_parlor.post_inventory(output, message.channel)
+            kind, module = 'tattoo_parlor', tattoo_parlor
         case _:
             await message.channel.send(f'Unrecognized argument to "refresh": "{shop}"')
+            return
+
+    if seed is not None and not shop_generator.has_tables(module.TABLES_PATH):
+        await message.channel.send(f'Seeds need native tables, and there are none at {module.TABLES_PATH}.')
+        return
+
+    output = await jobs.run(kind, seed=seed)
+    await module.post_inventory(output, message.channel)
 
-async def _handle_cakeday(message, match):
+async def _handle_cakeday(context, message, match):
     """
     Find the server members having their cakeday on the optional date (default 'today')
     and post them in the same channel as the command. The optional date date must be 
-    given in the format YYYY-MM-DD.
+    given in the format YYYY-MM-DD. A range of dates can be given as YYYY-MM-DD..YYYY-MM-DD
+    to get a report of every cakeday in the range.
     """
+    if not context.members_ready.is_set():
+        await message.channel.send('The member list is still loading, try again shortly.')
+        return
+
+    if match.group(2):
+        await _handle_cakeday_range(context, message, match)
+        return
+
     cakeday_members = []
     date_words = ''
 
@@ -92,13 +145,13 @@ async def _handle_cakeday(message, match):
     if given_date:
         try:
             given_date = datetime.fromisoformat(given_date)
-            cakeday_members = cakeday.get_members(message.guild, now=given_date)
+            cakeday_members = cakeday.get_members(context.member_source, now=given_date, index=context.cakeday_index)
             date_words = f'on {match.group(1)} (UTC)'
         except ValueError:
             await message.channel.send(f'Invalid date: "{given_date}" (must be YYYY-MM-DD)')
             return
     else:
-        cakeday_members = cakeday.get_members(message.guild)
+        cakeday_members = cakeday.get_members(context.member_source, index=context.cakeday_index)
         date_words = 'today'
 
     if cakeday_members:
@@ -113,21 +166,75 @@ async def _handle_cakeday(message, match):
     else:
         await message.channel.send(f'No members have their cakeday {date_words}.')
 
-async def _handle_almanac(client, message, match):
+async def _handle_cakeday_range(context, message, match):
+    """
+    Report every cakeday between two dates (inclusive), grouped by date and then by years.
+    """
+    start, end = match.groups()
+    try:
+        by_date = cakeday.get_members_in_range(
+            context.member_source,
+            datetime.fromisoformat(start),
+            datetime.fromisoformat(end),
+            index=context.cakeday_index,
+        )
+    except ValueError as e:
+        await message.channel.send(f'Invalid date range: "{start}..{end}" ({e})')
+        return
+
+    if not by_date:
+        await message.channel.send(f'No members have their cakeday between {start} and {end}.')
+        return
+
+    total = sum(len(members) for members in by_date.values())
+    cakeday_words = 'cakeday' if total == 1 else 'cakedays'
+    lines = [f'**{total} {cakeday_words} between {start} and {end} (UTC):**']
+
+    for day, members in by_date.items():
+        lines.append(f'**{day.isoformat()}**')
+
+        by_years = {}
+        for member, years in members:
+            by_years.setdefault(years, []).append(embed_nickname_mention(member.id))
+
+        for years, mentions in by_years.items():
+            year_words = 'year' if years == 1 else 'years'
+            # Keep each line well below the message limit, even for a very popular day
+            for batch in partition(mentions, 40):
+                lines.append(f'\t* {years} {year_words}: {", ".join(batch)}')
+
+    await send_packed(message.channel, lines)
+
+async def _handle_almanac(context, message, match):
     """
     Lookup the entry for the given date in the Barovian Almanac and display it as a
     Discord Embed. The date defaults to today but can also be given in YYYY-MM-DD format.
+    A range of dates can be given as YYYY-MM-DD..YYYY-MM-DD to get a multi-day forecast.
     """
-    given_date = match.group(1)
-    if given_date:
+    given_date, end_date = match.groups()
+    if given_date and end_date:
+        try:
+            start = datetime.fromisoformat(given_date)
+            end = datetime.fromisoformat(end_date)
+            generated = await almanac.generate_embeds(context.almanac_gsheet_id, start, end)
+        except ValueError as e:
+            await message.channel.send(f'Invalid date range: "{given_date}..{end_date}" ({e})')
+            return
+
+        if generated:
+            await almanac.post_entries(generated, message.channel)
+        else:
+            await message.channel.send(f'No almanac entries found for {given_date}..{end_date}.')
+        return
+    elif given_date:
         try:
             given_date = datetime.fromisoformat(given_date)
-            generated = almanac.generate_embed(client.almanac_gsheet_id, timestamp=given_date)
+            generated = await almanac.generate_embed(context.almanac_gsheet_id, timestamp=given_date)
         except ValueError:
             await message.channel.send(f'Invalid date: "{given_date}" (must be YYYY-MM-DD)')
             return
     else:
-        generated = almanac.generate_embed(client.almanac_gsheet_id)
+        generated = await almanac.generate_embed(context.almanac_gsheet_id)
 
     await almanac.post_entry(generated, message.channel)
 
@@ -137,6 +244,106 @@ async def _handle_staffxp(message, match):
     """
     await staffxp_reminder.send_reminder(message.channel)
 
+async def _handle_lag(client, message, match):
+    """
+    Post a summary of the event loop lag percentiles and of any recent blocked loops, along with
+    the stack captured for the most recent one.
+    """
+    monitor = client.loop_monitor
+    blocks = [monitor.summary()]
+    if monitor.blocks:
+        latest = monitor.blocks[-1]
+        blocks.append(f'Most recent blocked loop ({latest.task}):\n```\n{latest.stack[-1500:]}\n```')
+
+    await send_packed(message.channel, blocks)
+
+async def _handle_stats(message, _):
+    """
+    Post a summary of the latency of every command and background job, broken down by phase, and
+    how many jobs are queued for the job workers, if any.
+    """
+    blocks = ['**Latency since the last restart:**'] + metrics.summary()
+    if jobs.using_workers():
+        waiting, running = await jobs.queue_depth()
+        blocks.append(f'Job queue: {waiting} waiting, {running} running in {jobs.worker_count()} worker(s)')
+
+    await send_packed(message.channel, blocks)
+
+async def _handle_trace(message, match):
+    """
+    Show the most recent trace of the given background job as a tree of timed steps. Without a job,
+    list the recorded traces; with 'export', attach all of them as a JSON Lines file.
+    """
+    name = match.group(1)
+
+    if name == 'export':
+        traces = tracing.recent()
+        data = BytesIO(tracing.to_jsonl(reversed(traces)).encode('utf-8'))
+        await message.channel.send(f'{len(traces)} traces:', file=File(data, filename='traces.jsonl'))
+    elif name:
+        traces = tracing.recent(name)
+        if traces:
+            await send_packed(message.channel, [f'```\n{traces[0].format()}\n```'])
+        else:
+            await message.channel.send(f'No traces recorded for "{name}" since the last restart.')
+    else:
+        lines = ['**Recorded traces, most recent first:**']
+        for trace in tracing.recent():
+            status = 'FAILED' if trace.failed else 'ok'
+            lines.append(f'\t* {trace.name} at {trace.started_at:%Y-%m-%d %H:%M:%S} UTC - {trace.root.duration:.1f}s {status}')
+        await send_packed(message.channel, lines if len(lines) > 1 else ['No traces recorded since the last restart.'])
+
+async def _handle_profile(client, context, message, match):
+    """
+    Run a background job (by name, e.g. refresh_almanac) or another command (e.g. cakeday 2024-01-01)
+    once under the profiler and attach the report. Note that a job really runs and posts as usual.
+    """
+    target, arguments = match.groups()
+
+    if target in {job.name for job in client.scheduler.jobs()}:
+        name = f'job {target}'
+        func, args = client.scheduler.run_now, (target,)
+    elif target in COMMAND_NAMES and target != 'profile':
+        command = f'{target} {arguments}' if arguments else target
+        name = f'command "{command}"'
+        func, args = _dispatch, (client, context, message, command)
+    else:
+        await message.channel.send(f'Unrecognized job or command to profile: "{target}"')
+        return
+
+    await message.channel.send(f'Profiling {name}...')
+    try:
+        report = await profiler.profile(name, func, *args)
+    except profiler.ProfileInProgress as e:
+        await message.channel.send(str(e))
+        return
+
+    preview = '\n'.join(profiler.hotspots(report))[:1500]
+    await message.channel.send(
+        f'Profile of {name}, top functions by cumulative time:\n```\n{preview}\n```',
+        file=File(BytesIO(report.encode('utf-8')), filename=f'profile-{target}.txt'),
+    )
+
+async def _handle_reload(client, message, match):
+    """
+    Reload a feature module (e.g. almanac), or the configuration with 'config', without
+    reconnecting. Without an argument, reload every feature module and then the configuration.
+    """
+    target = match.group(1)
+
+    try:
+        if target == 'config':
+            results = [await reloader.reload_config(client)]
+        elif target:
+            results = [await reloader.reload_modules(client, (target,))]
+        else:
+            results = [await reloader.reload_modules(client), await reloader.reload_config(client)]
+    except reloader.ReloadError as e:
+        await message.channel.send(str(e))
+        return
+
+    await message.channel.send('\n'.join(results))
+
 async def _handle_unknown_command(message):
     command = message.content.removeprefix(PREFIX)
     await message.channel.send(f'Unrecognized command: "{command}"')
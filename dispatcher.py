@@ -0,0 +1,270 @@
+# dispatcher.py
+#
+# The central outbound message dispatcher, owned by the Client. Messages are queued with a priority
+# class so that player-facing posts go out before staff notifications and diagnostics, each channel
+# has a token bucket so that we stay within Discord's per-channel rate limit instead of bouncing off
+# it, and adjacent small text messages to the same channel are coalesced into one send.
+
+import asyncio
+import heapq
+import itertools
+import logging
+import metrics
+import time
+
+from utils import MESSAGE_LIMIT
+
+# Priority classes, lowest value is sent first
+PRIORITY_PLAYER = 0  # Public posts: shop inventories, almanac, cakeday announcements
+PRIORITY_STAFF = 1  # Staff notifications and reminders
+PRIORITY_DIAGNOSTIC = 2  # Error reports for the maintainer
+
+# Per-channel rate budget: Discord allows roughly 5 messages per 5 seconds in a channel
+CHANNEL_BURST = 5
+CHANNEL_RATE = 1.0  # Tokens per second
+
+# How many sends may be in flight across all channels at once. When this is exhausted, the queued
+# message with the best priority goes next regardless of channel.
+MAX_IN_FLIGHT = 4
+
+log = logging.getLogger('app.dispatcher')
+
+class TokenBucket:
+    """
+    A classic token bucket holding up to 'capacity' tokens, refilled at 'rate' tokens per second.
+    """
+
+    def __init__(self, capacity=CHANNEL_BURST, rate=CHANNEL_RATE):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def try_acquire(self):
+        """
+        Take a token if one is available and return 0, otherwise return the number of seconds
+        until one will be.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+class Dispatcher:
+    """
+    Queues outbound messages and sends them in priority order within each channel's rate budget.
+    `send` returns an awaitable handle (an asyncio.Future) resolving to the sent discord.Message.
+    """
+
+    def __init__(self, max_in_flight=MAX_IN_FLIGHT):
+        self.max_in_flight = max_in_flight
+
+        self._seq = itertools.count()  # Tie-breaker keeping FIFO order within a priority class
+        self._pending = {}  # channel ID -> heap of _Outbound
+        self._channels = {}  # channel ID -> channel
+        self._buckets = {}  # channel ID -> TokenBucket
+        self._busy = set()  # channel IDs with a send in flight, to keep each channel in order
+        self._sending = set()  # Tasks of the sends in flight, which asyncio only weakly references
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        """
+        Start the dispatcher's background task. Must be called from within the running event loop.
+        """
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name='dispatcher')
+
+    async def stop(self, timeout=5.0):
+        """
+        Give queued messages up to 'timeout' seconds to go out, then stop and cancel the rest.
+        """
+        deadline = time.monotonic() + timeout
+        while (self._pending or self._busy) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+        for task in self._sending:
+            task.cancel()
+        await asyncio.gather(*self._sending, return_exceptions=True)
+
+        for heap in self._pending.values():
+            for outbound in heap:
+                for future in outbound.futures:
+                    future.cancel()
+        self._pending.clear()
+
+    def send(self, channel, content=None, *, priority=PRIORITY_PLAYER, coalesce=True, **kwargs):
+        """
+        Queue a message for 'channel' and return a Future resolving to the sent Message. Plain text
+        messages may be coalesced with adjacent ones unless 'coalesce' is False; every coalesced
+        caller's Future resolves to the same Message.
+        """
+        future = asyncio.get_running_loop().create_future()
+
+        outbound = _Outbound(priority, next(self._seq), content, kwargs, coalesce and not kwargs, future)
+        heapq.heappush(self._pending.setdefault(channel.id, []), outbound)
+        self._channels[channel.id] = channel
+
+        self._wakeup.set()
+        return future
+
+    def channel(self, channel, priority=PRIORITY_PLAYER):
+        """
+        Wrap a channel so that its `send` goes through the dispatcher at the given priority.
+        Returns None if 'channel' is None so that "channel not found" checks keep working.
+        """
+        if channel is None:
+            return None
+        return OutboundChannel(self, channel, priority)
+
+    def pending(self):
+        """
+        The number of messages waiting to be sent.
+        """
+        return sum(len(heap) for heap in self._pending.values())
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            delay = self._dispatch_ready()
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def _dispatch_ready(self):
+        """
+        Start a send for each idle channel that has a message waiting and a token to spend, best
+        priority first. Returns the number of seconds until a waiting channel gets a token, or None
+        if nothing is waiting on a token.
+        """
+        next_token = None
+
+        waiting = [channel_id for channel_id in self._pending if channel_id not in self._busy]
+        waiting.sort(key=lambda channel_id: self._pending[channel_id][0].order)
+
+        for channel_id in waiting:
+            if len(self._busy) >= self.max_in_flight:
+                break
+
+            bucket = self._buckets.setdefault(channel_id, TokenBucket())
+            wait = bucket.try_acquire()
+            if wait:
+                next_token = wait if next_token is None else min(next_token, wait)
+                continue
+
+            outbound = self._pop(channel_id)
+            self._busy.add(channel_id)
+            task = asyncio.create_task(self._send(channel_id, outbound))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+        return next_token
+
+    def _pop(self, channel_id):
+        """
+        Take the next message for the channel, merging any adjacent plain text messages of the same
+        priority into it as long as the result fits in a single message.
+        """
+        heap = self._pending[channel_id]
+        outbound = heapq.heappop(heap)
+
+        while outbound.coalesce and heap:
+            following = heap[0]
+            if not following.coalesce or following.priority != outbound.priority:
+                break
+
+            merged = f'{outbound.content}\n{following.content}'
+            if len(merged) > MESSAGE_LIMIT:
+                break
+
+            heapq.heappop(heap)
+            outbound.content = merged
+            outbound.futures.extend(following.futures)
+
+        if not heap:
+            del self._pending[channel_id]
+
+        return outbound
+
+    async def _send(self, channel_id, outbound):
+        channel = self._channels[channel_id]
+        metrics.phase_seconds.observe(time.perf_counter() - outbound.queued_at, task=outbound.task, phase='queue')
+        try:
+            with metrics.phase('send', task=outbound.task):
+                message = await channel.send(outbound.content, **outbound.kwargs)
+        except asyncio.CancelledError:
+            for future in outbound.futures:
+                future.cancel()
+            raise
+        except Exception as e:
+            log.error(f'Failed to send message to {getattr(channel, "name", channel_id)}: {e!r}')
+            for future in outbound.futures:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for future in outbound.futures:
+                if not future.done():
+                    future.set_result(message)
+        finally:
+            self._busy.discard(channel_id)
+            self._wakeup.set()
+
+class OutboundChannel:
+    """
+    A stand-in for a discord channel whose `send` is queued through a Dispatcher. Everything else is
+    passed through to the real channel. Because `send` returns a Future rather than a coroutine,
+    callers can queue several messages before awaiting any of them.
+    """
+
+    def __init__(self, dispatcher, channel, priority):
+        self._dispatcher = dispatcher
+        self._channel = channel
+        self._priority = priority
+
+    def send(self, content=None, **kwargs):
+        return self._dispatcher.send(self._channel, content, priority=self._priority, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._channel, name)
+
+    def __eq__(self, other):
+        if isinstance(other, OutboundChannel):
+            other = other._channel
+        return self._channel == other
+
+    def __hash__(self):
+        return hash(self._channel)
+
+class _Outbound:
+    """
+    A queued message and the Futures of everyone waiting for it to be sent.
+    """
+
+    __slots__ = ('priority', 'seq', 'content', 'kwargs', 'coalesce', 'futures', 'task', 'queued_at')
+
+    def __init__(self, priority, seq, content, kwargs, coalesce, future):
+        self.priority = priority
+        self.seq = seq
+        self.content = content
+        self.kwargs = kwargs
+        self.coalesce = coalesce and content is not None
+        self.futures = [future]
+        self.task = metrics.current_task.get()  # Who to attribute the queue wait and send time to
+        self.queued_at = time.perf_counter()
+
+    @property
+    def order(self):
+        return (self.priority, self.seq)
+
+    def __lt__(self, other):
+        return self.order < other.order
@@ -0,0 +1,123 @@
+# error_digest.py
+#
+# Coalescing of error reports, so that a recurring failure (the sheet being down, a broken generator
+# script, ...) can't flood the maintainer's channel. Errors are fingerprinted by their type and the
+# stack they were raised from, separately for each channel they are reported to (i.e. each server's
+# maintainer). The first occurrence of a fingerprint is reported in full right away; repeats are
+# only counted, and reported together in a digest once every DIGEST_WINDOW. A fingerprint that
+# stays quiet for a whole window is forgotten, so if it comes back it's reported in full again.
+
+import asyncio
+import hashlib
+import logging
+import traceback
+
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+
+# How often repeated errors are summarized
+DIGEST_WINDOW = timedelta(minutes=10)
+
+log = logging.getLogger('app.error_digest')
+
+# One line of a digest: an error that repeated 'count' times during the window ('total' in all)
+DigestLine = namedtuple('DigestLine', ['summary', 'count', 'total', 'last_seen'])
+
+class ErrorEntry:
+    """
+    What we know about one fingerprint: a one-line summary, where to report it, and how many times
+    it has been seen since the last digest.
+    """
+
+    __slots__ = ('summary', 'first_seen', 'last_seen', 'count', 'total', 'channel', 'user')
+
+    def __init__(self, summary, now, channel, user):
+        self.summary = summary
+        self.first_seen = now
+        self.last_seen = now
+        self.count = 0  # Repeats since the last digest
+        self.total = 1  # Occurrences since it was first reported
+        self.channel = channel
+        self.user = user
+
+def fingerprint(error):
+    """
+    Return (fingerprint, summary) for an exception or error message. Exceptions with the same type
+    raised through the same stack get the same fingerprint, whatever their messages.
+    """
+    if not isinstance(error, BaseException):
+        text = str(error)
+        return hashlib.sha1(text.encode('utf-8')).hexdigest(), text.splitlines()[0][:200] if text else ''
+
+    frames = traceback.extract_tb(error.__traceback__)
+    key = type(error).__qualname__ + ''.join(f'|{frame.filename}:{frame.lineno}:{frame.name}' for frame in frames)
+
+    summary = f'{type(error).__name__}: {str(error)[:100]}'
+    if frames:
+        summary += f' at {frames[-1].filename.rsplit("/", 1)[-1]}:{frames[-1].lineno} in {frames[-1].name}'
+
+    return hashlib.sha1(key.encode('utf-8')).hexdigest(), summary
+
+class ErrorDigest:
+    """
+    Decides which errors are reported in full and periodically calls the coroutine function
+    on_digest(channel, user, lines) with a DigestLine for each error repeated during the window.
+    """
+
+    def __init__(self, on_digest, window=DIGEST_WINDOW):
+        self.on_digest = on_digest
+        self.window = window
+        self._entries = {}  # (channel ID, fingerprint) -> ErrorEntry
+        self._task = None
+
+    def record(self, error, channel, user):
+        """
+        Record an occurrence of 'error' to be reported to 'channel'. Returns True iff it should be
+        reported in full now, i.e. it's the first occurrence of its fingerprint in that channel.
+        """
+        error_key, summary = fingerprint(error)
+        key = (getattr(channel, 'id', None), error_key)
+        now = datetime.now(timezone.utc)
+
+        entry = self._entries.get(key)
+        if entry is None:
+            self._entries[key] = ErrorEntry(summary, now, channel, user)
+            if self._task is None or self._task.done():
+                self._task = asyncio.create_task(self._run(), name='error_digest')
+            return True
+
+        entry.count += 1
+        entry.total += 1
+        entry.last_seen = now
+        entry.user = user  # The maintainer may have changed with the configuration
+        log.debug('Suppressed repeat of %s (%d since the last digest)', summary, entry.count)
+        return False
+
+    async def flush(self):
+        """
+        Send a digest of the errors repeated since the last one, and forget the ones that haven't
+        been seen for a whole window (not just since the last digest, which may have been moments
+        after an error was first reported).
+        """
+        now = datetime.now(timezone.utc)
+        by_channel = {}  # channel -> (user, [DigestLine])
+        for key, entry in list(self._entries.items()):
+            if not entry.count:
+                if now - entry.last_seen >= self.window:
+                    del self._entries[key]
+                continue
+
+            line = DigestLine(entry.summary, entry.count, entry.total, entry.last_seen)
+            by_channel.setdefault(entry.channel, (entry.user, []))[1].append(line)
+            entry.count = 0
+
+        for channel, (user, lines) in by_channel.items():
+            try:
+                await self.on_digest(channel, user, lines)
+            except Exception:
+                log.exception('Unable to send error digest')
+
+    async def _run(self):
+        while self._entries:
+            await asyncio.sleep(self.window.total_seconds())
+            await self.flush()
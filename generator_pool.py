@@ -0,0 +1,261 @@
+# generator_pool.py
+#
+# A small pool of pre-started worker processes for running the shop generator scripts, so that a
+# slow or runaway script can never stall the gateway event loop. Each job has a wall-clock timeout
+# and the workers run with a memory limit; a job that times out, is cancelled or crashes takes its
+# worker down with it and a fresh one is started in its place. The script's stdout is streamed back
+# to the calling coroutine as it is printed.
+#
+# The workers are started with 'spawn', so each one imports this module and also the parent's main
+# module (as __mp_main__, i.e. app.py and everything it imports at the top level, discord.py
+# included) before _worker_main runs. The memory limit is applied after those imports, and
+# scripts run with a fresh globals dict, so they never see any of it.
+
+import asyncio
+import importlib
+import io
+import itertools
+import logging
+import marshal
+import multiprocessing
+import traceback
+
+from contextlib import redirect_stdout
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+# Number of worker processes. Generation is rare, so one warm worker is usually plenty.
+WORKERS = 1
+
+# Wall-clock limit for a single job, in seconds
+TIMEOUT = 30
+
+# Address space limit for each worker process, in bytes
+MEMORY_LIMIT = 512 * 1024 * 1024
+
+# Modules imported by each worker as it starts, so that scripts don't pay for them at run time
+PRELOAD = ('collections', 'math', 'random', 're', 'string')
+
+# Stdout is sent back to the parent in chunks of about this many characters
+CHUNK_SIZE = 1024
+
+log = logging.getLogger('app.generator_pool')
+
+class GeneratorError(Exception):
+    """
+    A generator script failed, or its worker process died.
+    """
+
+class GeneratorTimeout(GeneratorError):
+    """
+    A generator script took longer than its timeout and was killed.
+    """
+
+class GeneratorPool:
+    """
+    A pool of worker processes for running compiled generator scripts.
+    """
+
+    def __init__(self, workers=WORKERS, timeout=TIMEOUT, memory_limit=MEMORY_LIMIT):
+        self.workers = workers
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+
+        self._context = multiprocessing.get_context('spawn')
+        self._job_ids = itertools.count()
+        self._idle = None
+        self._all = []
+
+    def start(self):
+        """
+        Start the worker processes. Must be called from within the running event loop.
+        """
+        if self._idle is not None:
+            return
+
+        self._idle = asyncio.Queue()
+        for _ in range(self.workers):
+            self._idle.put_nowait(self._spawn())
+
+        log.info(f'Started {self.workers} generator worker process(es)')
+
+    async def shutdown(self):
+        """
+        Stop all the worker processes.
+        """
+        for worker in self._all:
+            worker.kill()
+        for worker in self._all:
+            await asyncio.to_thread(worker.process.join, 1)
+        self._all.clear()
+        self._idle = None
+
+    async def run(self, code, timeout=None, on_output=None):
+        """
+        Run a compiled script in a worker process and return everything it printed. 'on_output',
+        if given, is called with each chunk of output as it arrives. Raises GeneratorTimeout if the
+        script runs longer than 'timeout' seconds and GeneratorError if it fails.
+        """
+        self.start()
+
+        worker = await self._idle.get()
+        try:
+            return await asyncio.wait_for(
+                worker.run(next(self._job_ids), marshal.dumps(code), on_output),
+                timeout=timeout or self.timeout,
+            )
+        except asyncio.TimeoutError:
+            log.error(f'Generator job timed out after {timeout or self.timeout}s, restarting worker {worker.pid}')
+            worker = self._replace(worker)
+            raise GeneratorTimeout(f'Generator script took longer than {timeout or self.timeout}s') from None
+        except BaseException:
+            # Failed or cancelled: the worker may be in any state, so don't reuse it
+            worker = self._replace(worker)
+            raise
+        finally:
+            if self._idle is not None:
+                self._idle.put_nowait(worker)
+
+    def _spawn(self):
+        worker = _Worker(self._context, self.memory_limit)
+        self._all.append(worker)
+        return worker
+
+    def _replace(self, worker):
+        worker.kill()
+        self._all.remove(worker)
+        return self._spawn()
+
+class _Worker:
+    """
+    The parent's handle on one worker process.
+    """
+
+    def __init__(self, context, memory_limit):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_worker_main,
+            args=(child_conn, memory_limit, PRELOAD),
+            name='pidlwick-generator',
+            daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    def kill(self):
+        """
+        Kill the process without waiting for it to exit, which would block the loop. multiprocessing
+        reaps it the next time a process is started, e.g. its replacement.
+        """
+        self.process.kill()
+        self.conn.close()
+
+    async def run(self, job_id, code_bytes, on_output):
+        loop = asyncio.get_running_loop()
+        done = loop.create_future()
+        chunks = []
+
+        def on_readable():
+            try:
+                while not done.done() and self.conn.poll():
+                    message_id, kind, payload = self.conn.recv()
+                    if message_id != job_id:
+                        continue  # Left over from a previous job
+                    if kind == 'stdout':
+                        chunks.append(payload)
+                        if on_output:
+                            on_output(payload)
+                    elif kind == 'done':
+                        done.set_result(''.join(chunks))
+                    else:
+                        done.set_exception(GeneratorError(f'Generator script failed:\n{payload}'))
+            except (EOFError, OSError):
+                if not done.done():
+                    done.set_exception(GeneratorError(f'Generator worker {self.pid} exited unexpectedly'))
+
+        loop.add_reader(self.conn.fileno(), on_readable)
+        try:
+            self.conn.send((job_id, code_bytes))
+            return await done
+        finally:
+            loop.remove_reader(self.conn.fileno())
+
+_pool = GeneratorPool()
+
+def start():
+    """
+    Start the shared pool - see GeneratorPool.start.
+    """
+    _pool.start()
+
+async def shutdown():
+    """
+    Stop the shared pool - see GeneratorPool.shutdown.
+    """
+    await _pool.shutdown()
+
+async def run(code, timeout=None, on_output=None):
+    """
+    Run a compiled script using the shared pool - see GeneratorPool.run.
+    """
+    return await _pool.run(code, timeout=timeout, on_output=on_output)
+
+# Everything below runs in the worker processes
+
+class _PipeWriter(io.TextIOBase):
+    """
+    A stdout replacement that sends what is written back to the parent in chunks.
+    """
+
+    def __init__(self, conn, job_id):
+        self.conn = conn
+        self.job_id = job_id
+        self.buffer = []
+        self.size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, s):
+        self.buffer.append(s)
+        self.size += len(s)
+        if self.size >= CHUNK_SIZE:
+            self.flush()
+        return len(s)
+
+    def flush(self):
+        if self.buffer:
+            self.conn.send((self.job_id, 'stdout', ''.join(self.buffer)))
+            self.buffer = []
+            self.size = 0
+
+def _worker_main(conn, memory_limit, preload):
+    if resource and memory_limit:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+
+    for name in preload:
+        importlib.import_module(name)
+
+    while True:
+        try:
+            job_id, code_bytes = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+
+        writer = _PipeWriter(conn, job_id)
+        try:
+            code = marshal.loads(code_bytes)
+            with redirect_stdout(writer):
+                exec(code, {'__name__': '__generator__'})
+            writer.flush()
+            conn.send((job_id, 'done', None))
+        except BaseException:
+            writer.flush()
+            conn.send((job_id, 'error', traceback.format_exc()))
@@ -0,0 +1,106 @@
+# guild_config.py
+#
+# Per-server configuration, so that one bot process can serve several servers. Each server has its
+# own channels, roles, sheet IDs and set of enabled features. The configuration is read from the
+# YAML file named by the GUILDS_CONFIG environment variable (see guilds.example.yml); without one, a
+# single server is configured from the environment variables in .env as before.
+
+import logging
+import os
+
+import yaml
+
+# Every feature that can be enabled for a server, by the name used in the config
+FEATURES = frozenset(('vistani_market', 'tattoo_parlor', 'cakeday', 'almanac', 'staffxp_reminder'))
+
+# Channel and role names, each with the environment variable it is read from in single-server mode
+CHANNELS = {
+    'vistani_inventory': 'VISTANI_INVENTORY_CHANNEL',
+    'tattoo_inventory': 'TATTOO_INVENTORY_CHANNEL',
+    'cakeday_announcement': 'CAKEDAY_ANNOUNCEMENT_CHANNEL',
+    'almanac': 'ALMANAC_CHANNEL',
+    'bot_notification': 'BOT_NOTIFICATION_CHANNEL',
+    'bot_development': 'BOT_DEVELOPMENT_CHANNEL',
+    'staffxp_reminder': 'STAFFXP_REMINDER_CHANNEL',
+}
+ROLES = {
+    'players': 'PLAYERS_ROLE',
+    'staff': 'STAFF_ROLE',
+    'mods': 'MODS_ROLE',
+    'year_one_player': 'YEAR_ONE_PLAYER_ROLE',
+    'helper': 'HELPER_ROLE',
+}
+SHEETS = {
+    'almanac': 'ALMANAC_GSHEET_ID',
+}
+
+CONFIG_PATH = os.environ.get('GUILDS_CONFIG')
+
+log = logging.getLogger('app.guild_config')
+
+class GuildConfig:
+    """
+    The configuration of one server. Channel and role IDs are ints, missing ones are None.
+    """
+
+    def __init__(self, server, maintainer=None, name=None, channels=None, roles=None, sheets=None, features=FEATURES):
+        self.server = int(server)
+        self.maintainer = int(maintainer) if maintainer else None
+        self.name = name or str(server)
+        self.channels = {key: _id(channels, key) for key in CHANNELS}
+        self.roles = {key: _id(roles, key) for key in ROLES}
+        self.sheets = {key: (sheets or {}).get(key) for key in SHEETS}
+        self.features = frozenset(features)
+
+        unknown = self.features - FEATURES
+        if unknown:
+            raise ValueError(f'Unknown features for server {self.name}: {", ".join(sorted(unknown))}')
+
+    def enabled(self, feature):
+        return feature in self.features
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            data['server'],
+            maintainer=data.get('maintainer'),
+            name=data.get('name'),
+            channels=data.get('channels'),
+            roles=data.get('roles'),
+            sheets=data.get('sheets'),
+            features=data.get('features', FEATURES),
+        )
+
+    @classmethod
+    def from_env(cls):
+        """
+        The configuration of the single server described by the environment variables.
+        """
+        return cls(
+            os.environ['SERVER'],
+            maintainer=os.environ.get('MAINTAINER'),
+            channels={key: os.environ.get(var) for key, var in CHANNELS.items()},
+            roles={key: os.environ.get(var) for key, var in ROLES.items()},
+            sheets={key: os.environ.get(var) for key, var in SHEETS.items()},
+        )
+
+def load(path=CONFIG_PATH):
+    """
+    Return the list of GuildConfig for every server the bot should serve.
+    """
+    if not path:
+        return [GuildConfig.from_env()]
+
+    with open(path, 'r', encoding='utf-8') as f:
+        data = yaml.safe_load(f) or {}
+
+    configs = [GuildConfig.from_dict(guild) for guild in data.get('guilds', ())]
+    if not configs:
+        raise ValueError(f'No servers configured in {path}')
+
+    log.info(f'Loaded configuration for {len(configs)} server(s) from {path}')
+    return configs
+
+def _id(ids, key):
+    value = (ids or {}).get(key)
+    return int(value) if value else None
@@ -0,0 +1,156 @@
+# guild_context.py
+#
+# The runtime state of one server the bot serves: the discord.Guild itself and everything looked up
+# from its GuildConfig (channels, roles, the maintainer), plus the server's member index. Jobs and
+# commands get everything server-specific from here rather than from the Client.
+
+import asyncio
+import discord
+import logging
+
+import cakeday
+import dispatcher
+import member_store
+
+log = logging.getLogger('app.guild_context')
+
+class GuildContext:
+    """
+    A server the bot serves, with its configured entities resolved. Channels are wrapped by the
+    Client's dispatcher. Entities that are missing from the config or the server are None.
+    """
+
+    def __init__(self, config, guild, low_memory=False):
+        self.config = config
+        self.guild = guild
+        self.low_memory = low_memory
+
+        self.maintainer = None
+        self.member_store = None  # Only used in low-memory mode
+        self.members_ready = asyncio.Event()
+        self.cakeday_index = cakeday.AnniversaryIndex()
+        self._load_task = None
+
+    @property
+    def name(self):
+        return self.guild.name
+
+    def enabled(self, feature):
+        return self.config.enabled(feature)
+
+    async def resolve(self, client):
+        """
+        Look up the server's maintainer, channels and roles from its config.
+        """
+        log_result = lambda x, subject: log.info(f'[{self.name}] Found {subject} = {x.name}') if x else log.error(f'[{self.name}] Unable to find {subject}')
+        log_nameless = lambda x, subject: log.info(f'[{self.name}] Found {subject} = {x}') if x else log.error(f'[{self.name}] Unable to find {subject}')
+
+        self.maintainer = await self.find_member(self.config.maintainer)
+        log_result(self.maintainer, 'maintainer')
+
+        # Channels. Sends to these go through the dispatcher, so that player-facing posts take
+        # priority over staff notifications and diagnostics.
+        outbound = lambda key, priority: client.dispatcher.channel(self._channel(key), priority)
+
+        self.vistani_inventory_channel = outbound('vistani_inventory', dispatcher.PRIORITY_PLAYER)
+        log_result(self.vistani_inventory_channel, 'Vistani Market inventory channel')
+
+        self.tattoo_inventory_channel = outbound('tattoo_inventory', dispatcher.PRIORITY_PLAYER)
+        log_result(self.tattoo_inventory_channel, 'Tattoo Parlor inventory channel')
+
+        self.cakeday_announcement_channel = outbound('cakeday_announcement', dispatcher.PRIORITY_PLAYER)
+        log_result(self.cakeday_announcement_channel, 'cakeday announcement channel')
+
+        self.almanac_channel = outbound('almanac', dispatcher.PRIORITY_PLAYER)
+        log_result(self.almanac_channel, 'Barovian Almanac channel')
+
+        self.bot_notification_channel = outbound('bot_notification', dispatcher.PRIORITY_STAFF)
+        log_result(self.bot_notification_channel, 'bot notification channel')
+
+        self.bot_development_channel = outbound('bot_development', dispatcher.PRIORITY_DIAGNOSTIC)
+        log_result(self.bot_development_channel, 'bot development channel')
+
+        self.staffxp_reminder_channel = outbound('staffxp_reminder', dispatcher.PRIORITY_STAFF)
+        log_result(self.staffxp_reminder_channel, 'Staff XP reminder channel')
+
+        # Roles
+        self.players_role = self._role('players')
+        log_result(self.players_role, 'Players role')
+
+        self.staff_role = self._role('staff')
+        log_result(self.staff_role, 'Staff role')
+
+        self.mods_role = self._role('mods')
+        log_result(self.mods_role, 'Mods role')
+
+        self.year_one_player_role = self._role('year_one_player')
+        log_result(self.year_one_player_role, 'Year 1 Player role')
+
+        self.helper_role = self._role('helper')
+        log_result(self.helper_role, 'Helper role')
+
+        # Google Sheets
+        self.almanac_gsheet_id = self.config.sheets['almanac']
+        log_nameless(self.almanac_gsheet_id, 'Almanac Google Sheet ID')
+
+    async def load_members(self):
+        """
+        Build the cakeday index. In low-memory mode the members are first fetched into a compact
+        store instead of being cached by discord.py (see member_store.py). Until members_ready is
+        set, neither the store nor the index should be read.
+        """
+        if self.low_memory:
+            store = member_store.MemberStore(self.guild)
+            await store.load()
+            self.member_store = store  # Only once it's full
+        self.cakeday_index.build(self.member_source)
+        self.members_ready.set()
+
+    def start_loading_members(self):
+        """
+        Run load_members in a background task, which is kept until it's done.
+        """
+        self._load_task = asyncio.create_task(self.load_members(), name=f'load_members:{self.name}')
+        self._load_task.add_done_callback(self._log_load)
+
+    def _log_load(self, task):
+        if not task.cancelled() and task.exception():
+            log.error(f'[{self.name}] Unable to load the members: {task.exception()!r}')
+
+    def adopt_members(self, other):
+        """
+        Take over the member index (and store) of 'other', an older context for the same server.
+        """
+        self.member_store = other.member_store
+        self.members_ready = other.members_ready
+        self.cakeday_index = other.cakeday_index
+
+    @property
+    def member_source(self):
+        """
+        Where to look up the server's members: the guild, or the compact store in low-memory mode.
+        """
+        return self.member_store if self.low_memory else self.guild
+
+    async def find_member(self, member_id):
+        """
+        Look up a member of the server, asking Discord if it isn't cached (e.g. in low-memory mode).
+        """
+        if member_id is None:
+            return None
+
+        member = self.guild.get_member(member_id)
+        if member is None:
+            try:
+                member = await self.guild.fetch_member(member_id)
+            except discord.HTTPException as e:
+                log.error(f'[{self.name}] Unable to fetch member {member_id}: {e}')
+        return member
+
+    def _channel(self, key):
+        channel_id = self.config.channels[key]
+        return self.guild.get_channel(channel_id) if channel_id else None
+
+    def _role(self, key):
+        role_id = self.config.roles[key]
+        return self.guild.get_role(role_id) if role_id else None
@@ -0,0 +1,132 @@
+# http_client.py
+#
+# The shared asynchronous HTTP layer for the Pidlwick bot. Every outbound fetch (Google Sheets,
+# generator scripts, etc) goes through a single pooled keep-alive aiohttp session so that
+# network waits never block the gateway event loop.
+
+import asyncio
+import logging
+
+import aiohttp
+import metrics
+import tracing
+
+from collections import namedtuple
+
+# Timeouts in seconds. There is deliberately no overall timeout - a slow but steady download is fine.
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 20
+
+# Transient failures are retried with exponential backoff: 0.5s, 1s, 2s, ...
+MAX_RETRIES = 3
+RETRY_BACKOFF = 0.5
+RETRY_STATUSES = frozenset((408, 429, 500, 502, 503, 504))
+
+# Connection pool limits. We only talk to a handful of hosts, so these are generous.
+POOL_SIZE = 20
+POOL_SIZE_PER_HOST = 5
+KEEPALIVE_TIMEOUT = 60
+
+USER_AGENT = 'Pidlwick (+https://github.com/ItsQc/pidlwick)'
+
+log = logging.getLogger('app.http_client')
+
+# The result of a fetch. 'body' is the raw (already decompressed) response bytes.
+Response = namedtuple('Response', ['url', 'status', 'headers', 'body', 'charset'])
+
+_session = None
+
+async def open_session():
+    """
+    Create the shared session if it doesn't already exist and return it. Must be called from
+    within the running event loop, e.g. from Client.setup_hook.
+    """
+    global _session
+
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=POOL_SIZE,
+            limit_per_host=POOL_SIZE_PER_HOST,
+            keepalive_timeout=KEEPALIVE_TIMEOUT,
+        )
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT)
+        headers = {
+            'User-Agent': USER_AGENT,
+            'Accept-Encoding': 'gzip, deflate',
+        }
+        _session = aiohttp.ClientSession(connector=connector, timeout=timeout, headers=headers)
+        log.debug('Opened shared HTTP session')
+
+    return _session
+
+async def close_session():
+    """
+    Close the shared session and release its pooled connections.
+    """
+    global _session
+
+    if _session is not None and not _session.closed:
+        await _session.close()
+        log.debug('Closed shared HTTP session')
+    _session = None
+
+@metrics.timed('fetch')
+@tracing.traced('http_fetch')
+async def fetch(url, headers=None, retries=MAX_RETRIES):
+    """
+    GET 'url' using the shared session and return a Response. Connection errors, timeouts and
+    retryable statuses are retried up to 'retries' times. A 304 Not Modified is returned as-is so
+    callers can revalidate; any other 4xx/5xx status raises aiohttp.ClientResponseError.
+    """
+    session = await open_session()
+
+    attempt = 0
+    while True:
+        try:
+            async with session.get(url, headers=headers) as response:
+                if response.status in RETRY_STATUSES and attempt < retries:
+                    raise _RetryableStatus(response.status)
+
+                response.raise_for_status()
+                body = await response.read()
+
+                return Response(
+                    url=str(response.url),
+                    status=response.status,
+                    headers=response.headers,
+                    body=body,
+                    charset=response.charset or 'utf-8',
+                )
+        except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError, _RetryableStatus) as e:
+            if attempt >= retries:
+                raise
+
+            delay = RETRY_BACKOFF * (2 ** attempt)
+            attempt += 1
+            log.warning(f'Fetching {url} failed ({e!r}), retry {attempt}/{retries} in {delay}s')
+            await asyncio.sleep(delay)
+
+async def fetch_text(url, headers=None):
+    """
+    GET 'url' and return the response body decoded as text.
+    """
+    response = await fetch(url, headers=headers)
+    return response.body.decode(response.charset)
+
+async def head(url):
+    """
+    Send a HEAD request for 'url' (following redirects) and return the response status, e.g. to
+    check that a URL still works without downloading it. Connection errors are not retried.
+    """
+    session = await open_session()
+    async with session.head(url, allow_redirects=True) as response:
+        return response.status
+
+class _RetryableStatus(Exception):
+    """
+    Internal marker for a response status that is worth retrying (e.g. 503).
+    """
+
+    def __init__(self, status):
+        super().__init__(f'HTTP {status}')
+        self.status = status
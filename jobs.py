@@ -0,0 +1,232 @@
+# jobs.py
+#
+# The heavy, self-contained parts of the scheduled posts - shop inventory generation and almanac
+# rendering - as named jobs that take and return JSON. By default jobs.run() just runs a job on the
+# gateway's event loop. With JOB_WORKERS set, app.py starts that many worker processes and run()
+# hands each job to them through the local work queue (see work_queue.py) instead, so that script
+# exec, sheet fetching and CSV parsing use other cores and never delay the gateway.
+#
+# Each worker process has its own caches, generator pool, metrics and traces: `$pw stats` and
+# `$pw trace` on the gateway only see how long it waited for a job, not what happened inside it.
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import traceback
+
+import almanac
+import generator_pool
+import http_client
+import log_pipeline
+import tattoo_parlor
+import tracing
+import vistani_market
+
+from datetime import datetime
+from work_queue import QUEUE_PATH, WorkQueue
+
+# Number of job worker processes to start; 0 runs every job in the gateway process
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 0))
+
+# How long an idle worker waits before checking the queue again, in seconds. The wait doubles for
+# as long as the queue stays empty, up to MAX_IDLE_POLL_INTERVAL.
+IDLE_POLL_INTERVAL = 0.1
+MAX_IDLE_POLL_INTERVAL = 2
+
+# A worker that died is replaced at most this often, in seconds, so that one that crashes on
+# startup doesn't get respawned for every job
+RESPAWN_INTERVAL = 60
+
+# How long the gateway waits for the workers to exit on shutdown, in seconds
+STOP_TIMEOUT = 5
+
+log = logging.getLogger('app.jobs')
+
+_queue = None  # The work queue, once worker processes have been started
+_workers = []  # The worker processes
+_workers_lock = threading.Lock()  # Held while the worker processes are started, stopped or replaced
+_respawned_at = {}  # When each worker (by name) was last replaced, as a time.monotonic()
+
+# The jobs look their functions up on every call, so that they pick up modules reloaded by
+# `$pw reload` (see reloader.py)
+
+async def _vistani_market(seed=None):
+    return await vistani_market.generate_inventory(seed)
+
+async def _tattoo_parlor(seed=None):
+    return await tattoo_parlor.generate_inventory(seed)
+
+async def _almanac(sheet_id, timestamp=None):
+    entry = await almanac.generate_embed(sheet_id, timestamp=datetime.fromisoformat(timestamp) if timestamp else None)
+    return entry.to_dict()
+
+# Every job, by name. Each takes and returns JSON-serializable values.
+JOBS = {
+    'vistani_market': _vistani_market,
+    'tattoo_parlor': _tattoo_parlor,
+    'almanac': _almanac,
+}
+
+def using_workers():
+    """
+    True iff jobs are being run by worker processes.
+    """
+    return _queue is not None
+
+async def run(kind, **args):
+    """
+    Run the job 'kind' with keyword arguments 'args' and return its result, in a worker process if
+    they have been started. Workers that died are replaced first; if none are alive, the job is run
+    here instead.
+    """
+    if _queue is None or not await asyncio.to_thread(_revive_workers):
+        return await JOBS[kind](**args)
+
+    with tracing.span('work_queue', kind=kind):
+        return await _queue.submit(kind, args)
+
+async def queue_depth():
+    """
+    Return the number of jobs waiting for a worker and the number being run. Workers must have
+    been started.
+    """
+    return await asyncio.to_thread(_queue.pending)
+
+def worker_count():
+    """
+    The number of worker processes that are alive.
+    """
+    return sum(process.is_alive() for process in _workers)
+
+def start_workers(count=JOB_WORKERS, path=QUEUE_PATH):
+    """
+    Start 'count' worker processes sharing the queue at 'path', and send every job run from now
+    on to them. stop_workers should be called on shutdown.
+    """
+    global _queue
+
+    _queue = WorkQueue(path)
+    _queue.clear()  # Nobody is waiting for jobs left over from a previous run
+    _spawn_workers(count, path)
+
+def stop_workers():
+    """
+    Stop the worker processes started by start_workers. Jobs still running are abandoned.
+    """
+    with _workers_lock:
+        for process in _workers:
+            process.terminate()
+        for process in _workers:
+            process.join(timeout=STOP_TIMEOUT)
+            if process.is_alive():
+                process.kill()
+        _workers.clear()
+
+def restart_workers():
+    """
+    Replace the worker processes with fresh ones, which import the modules anew. Jobs that were
+    running are put back on the queue for the new workers. This blocks while the old workers exit.
+    """
+    if _queue is None:
+        return
+
+    count = len(_workers)
+    stop_workers()
+    requeued = _queue.requeue()
+    if requeued:
+        log.info(f'Requeued {requeued} job(s) interrupted by the restart')
+    _spawn_workers(count, _queue.path)
+
+def _revive_workers():
+    """
+    Replace the worker processes that have died, putting the jobs they were running back on the
+    queue. Returns the number of workers alive afterwards. This blocks while workers are started.
+    """
+    with _workers_lock:
+        now = time.monotonic()
+        for index, process in enumerate(_workers):
+            if process.is_alive():
+                continue
+
+            name = _worker_name(index + 1)
+            if now - _respawned_at.get(name, float('-inf')) < RESPAWN_INTERVAL:
+                continue  # It died again right after being replaced, leave it for now
+
+            requeued = _queue.requeue(worker=name)
+            log.warning(f'Job worker {name} died (exit code {process.exitcode}), replacing it; requeued {requeued} job(s)')
+            _respawned_at[name] = now
+            _workers[index] = _spawn_worker(index + 1, _queue.path)
+
+        alive = sum(process.is_alive() for process in _workers)
+        if not alive:
+            log.warning('No job worker is alive, running jobs in the gateway process')
+        return alive
+
+def _spawn_workers(count, path):
+    with _workers_lock:
+        for number in range(1, count + 1):
+            _workers.append(_spawn_worker(number, path))
+
+    log.info(f'Started {count} job worker process(es) using {path}')
+
+def _spawn_worker(number, path):
+    # Not a daemon, since a worker starts generator processes of its own
+    context = multiprocessing.get_context('spawn')
+    process = context.Process(target=_worker_main, args=(path, _worker_name(number)), name=f'pidlwick-{_worker_name(number)}')
+    process.start()
+    return process
+
+def _worker_name(number):
+    return f'jobs-{number}'
+
+# Everything below runs in the worker processes
+
+def _worker_main(path, name):
+    # The gateway owns the log file: rotating it from several processes isn't safe
+    log_listener = log_pipeline.configure('logging.yml', without=('file',))
+    try:
+        asyncio.run(serve(path, name))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        log_listener.stop()
+
+async def serve(path=QUEUE_PATH, name=None):
+    """
+    Run jobs from the queue at 'path', one at a time, forever.
+    """
+    name = name or f'jobs-{os.getpid()}'
+    queue = WorkQueue(path)
+
+    await http_client.open_session()
+    generator_pool.start()
+    log.info(f'Job worker {name} (PID {os.getpid()}) is ready')
+
+    try:
+        idle_wait = IDLE_POLL_INTERVAL
+        while True:
+            job = queue.claim(name)
+            if job is None:
+                await asyncio.sleep(idle_wait)
+                idle_wait = min(idle_wait * 2, MAX_IDLE_POLL_INTERVAL)
+            else:
+                await _execute(queue, job)
+                idle_wait = IDLE_POLL_INTERVAL
+    finally:
+        await http_client.close_session()
+        await generator_pool.shutdown()
+        queue.close()
+
+async def _execute(queue, job):
+    started = time.perf_counter()
+    try:
+        result = await JOBS[job.kind](**job.args)
+    except Exception:
+        log.exception(f'Job {job.kind} ({job.id}) failed')
+        queue.fail(job.id, traceback.format_exc())
+    else:
+        queue.complete(job.id, result)
+        log.info(f'Ran job {job.kind} ({job.id}) in {time.perf_counter() - started:.2f}s')
@@ -0,0 +1,143 @@
+# log_pipeline.py
+#
+# Asynchronous logging for the bot. logging.yml describes the handlers as usual, but once it has been
+# applied the handlers are moved off the event loop thread: loggers only put records on a queue, and
+# a background listener thread does the formatting and the file/stream I/O. Records are queued
+# unformatted, so a message's arguments are only rendered if a handler actually emits it, and the
+# log file is written as JSON Lines by JsonFormatter. RateLimitFilter caps how often any one noisy
+# call site can log.
+
+import json
+import logging
+import logging.config
+import queue
+import time
+
+import yaml
+
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+# The loggers whose handlers are moved to the background listener ('' is the root logger)
+QUEUED_LOGGERS = ('app', 'discord', '')
+
+# Attributes every LogRecord has; anything else on a record was passed in 'extra'
+_RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats each record as a single line of JSON with the time, level, logger and message, plus any
+    'extra' fields and the formatted exception if there is one.
+    """
+
+    def format(self, record):
+        data = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith('_'):
+                data[key] = value
+
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        if record.stack_info:
+            data['stack'] = self.formatStack(record.stack_info)
+
+        return json.dumps(data, default=str, ensure_ascii=False)
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets through at most 'limit' records per 'period' seconds from each call site (source line) at or
+    below 'max_level', dropping the rest. The first record let through after some were dropped gets
+    a 'suppressed' attribute with the number dropped.
+    """
+
+    def __init__(self, limit=20, period=60.0, max_level='DEBUG'):
+        super().__init__()
+        self.limit = limit
+        self.period = period
+        self.max_level = logging.getLevelName(max_level) if isinstance(max_level, str) else max_level
+        self._sites = {}  # (pathname, lineno) -> [window start, count, suppressed]
+
+    def filter(self, record):
+        if record.levelno > self.max_level:
+            return True
+
+        now = time.monotonic()
+        site = self._sites.get((record.pathname, record.lineno))
+        if site is None or now - site[0] >= self.period:
+            suppressed = site[2] if site else 0
+            self._sites[(record.pathname, record.lineno)] = [now, 1, 0]
+            if suppressed:
+                record.suppressed = suppressed
+            return True
+
+        if site[1] < self.limit:
+            site[1] += 1
+            return True
+
+        site[2] += 1
+        return False
+
+class _QueueHandler(QueueHandler):
+    """
+    Puts records on the queue as they are, tagged with the logger whose handlers should emit them.
+    Unlike the standard QueueHandler it doesn't format them first: the listener will.
+    """
+
+    def __init__(self, queue, route):
+        super().__init__(queue)
+        self.route = route
+
+    def prepare(self, record):
+        record._route = self.route
+        return record
+
+class _Listener(QueueListener):
+    """
+    Emits each queued record through the handlers of the logger it was logged to.
+    """
+
+    def __init__(self, queue, routes):
+        super().__init__(queue, respect_handler_level=True)
+        self.routes = routes
+
+    def handle(self, record):
+        for handler in self.routes.get(record._route, ()):
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+def configure(path='logging.yml', without=()):
+    """
+    Configure logging from the YAML file at 'path', then move the handlers of QUEUED_LOGGERS to a
+    background listener thread. Filters configured on those loggers are moved to their queue
+    handlers, so that they also apply to records from child loggers (e.g. 'app.cakeday') and run
+    before a record is queued. Handlers named in 'without' are closed and dropped. Returns the
+    listener, which should be stopped on shutdown to flush any records still queued.
+    """
+    with open(path, 'r') as f:
+        logging.config.dictConfig(yaml.safe_load(f))
+
+    records = queue.SimpleQueue()
+    routes = {}
+
+    for name in QUEUED_LOGGERS:
+        logger = logging.getLogger(name)
+        routes[name] = [handler for handler in logger.handlers if handler.name not in without]
+        for handler in logger.handlers:
+            if handler.name in without:
+                handler.close()
+
+        handler = _QueueHandler(records, name)
+        for record_filter in logger.filters:
+            handler.addFilter(record_filter)
+        logger.filters = []
+        logger.handlers = [handler]
+
+    listener = _Listener(records, routes)
+    listener.start()
+    return listener
@@ -0,0 +1,177 @@
+# loop_monitor.py
+#
+# Visibility into how responsive the event loop is. A sampler task sleeps for a short interval over
+# and over and records how late it wakes up (the loop lag). Meanwhile a watchdog thread checks that
+# the sampler keeps ticking; if the loop is blocked for longer than BLOCK_THRESHOLD, the watchdog
+# captures the loop thread's stack so we can see which code (refresh_almanac, a generator, ...)
+# is hogging it.
+
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+
+from collections import deque, namedtuple
+from datetime import datetime, timedelta, timezone
+
+# How often the loop lag is sampled, in seconds
+SAMPLE_INTERVAL = 0.25
+
+# How many samples to keep for percentiles (one hour's worth)
+SAMPLE_HISTORY = int(60 * 60 / SAMPLE_INTERVAL)
+
+# A loop that hasn't ticked for this many seconds is considered blocked
+BLOCK_THRESHOLD = 1.0
+
+# How many blocked-loop reports to keep
+BLOCK_HISTORY = 20
+
+log = logging.getLogger('app.loop_monitor')
+
+# A blocked loop: when it started, how long it lasted, the task that was running, the innermost
+# frame ('where') and the full stack
+BlockReport = namedtuple('BlockReport', ['started_at', 'duration', 'task', 'where', 'stack'])
+
+class LoopMonitor:
+    """
+    Samples event loop lag and detects a blocked loop. 'on_block', if given, is called on the loop
+    with the BlockReport once a blocked loop recovers.
+    """
+
+    def __init__(self, on_block=None):
+        self.on_block = on_block
+
+        self.samples = deque(maxlen=SAMPLE_HISTORY)
+        self.blocks = deque(maxlen=BLOCK_HISTORY)
+
+        self._loop = None
+        self._loop_thread_id = None
+        self._last_tick = time.monotonic()
+        self._task = None
+        self._watchdog = None
+        self._stopping = threading.Event()
+        self._reporting = set()  # Tasks running on_block, which asyncio only weakly references
+
+    def start(self):
+        """
+        Start the sampler task and the watchdog thread. Must be called from within the running loop.
+        """
+        if self._task is not None:
+            return
+
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._last_tick = time.monotonic()
+        self._stopping.clear()
+
+        self._task = asyncio.create_task(self._sample(), name='loop_monitor')
+        self._watchdog = threading.Thread(target=self._watch, name='loop-watchdog', daemon=True)
+        self._watchdog.start()
+
+    async def stop(self):
+        self._stopping.set()
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    def percentiles(self, *quantiles):
+        """
+        Return the loop lag in seconds at each of the given quantiles (0-1) over the sample history.
+        """
+        if not self.samples:
+            return tuple(0.0 for _ in quantiles)
+
+        ordered = sorted(self.samples)
+        last = len(ordered) - 1
+        return tuple(ordered[min(last, int(q * len(ordered)))] for q in quantiles)
+
+    def summary(self):
+        """
+        A short human-readable summary of the loop lag and recent blocks.
+        """
+        p50, p95, p99, worst = self.percentiles(0.5, 0.95, 0.99, 1.0)
+        minutes = len(self.samples) * SAMPLE_INTERVAL / 60
+
+        text = (f'Loop lag over the last {minutes:.0f} min: p50 {p50 * 1000:.1f}ms, p95 {p95 * 1000:.1f}ms, '
+                f'p99 {p99 * 1000:.1f}ms, max {worst * 1000:.1f}ms\n')
+
+        if self.blocks:
+            text += f'{len(self.blocks)} blocked loop(s) recorded, most recent first:\n'
+            for block in reversed(self.blocks):
+                text += f'\t{block.started_at:%Y-%m-%d %H:%M:%S} UTC - {block.duration:.1f}s in {block.task} at {block.where}\n'
+        else:
+            text += 'No blocked loops recorded.\n'
+
+        return text
+
+    async def _sample(self):
+        while True:
+            expected = time.monotonic() + SAMPLE_INTERVAL
+            await asyncio.sleep(SAMPLE_INTERVAL)
+            now = time.monotonic()
+            self._last_tick = now
+            self.samples.append(max(0.0, now - expected))
+
+    def _watch(self):
+        """
+        The watchdog thread: capture the loop thread's stack once per blocked period and report
+        the block once the loop recovers.
+        """
+        blocked_since = None
+        started_at = stack = task = where = None
+
+        while not self._stopping.wait(BLOCK_THRESHOLD / 4):
+            last_tick = self._last_tick
+            stalled = time.monotonic() - last_tick
+
+            if blocked_since is None:
+                if stalled > BLOCK_THRESHOLD + SAMPLE_INTERVAL:
+                    blocked_since = last_tick
+                    started_at = datetime.now(timezone.utc) - timedelta(seconds=stalled)
+                    task, where, stack = self._capture()
+                    log.warning(f'Event loop blocked for {stalled:.1f}s so far in {task}:\n{stack}')
+            elif last_tick > blocked_since:
+                duration = last_tick - blocked_since - SAMPLE_INTERVAL
+                report = BlockReport(started_at, duration, task, where, stack)
+                blocked_since = None
+
+                log.warning(f'Event loop was blocked for {duration:.1f}s in {task}')
+                if not self._loop.is_closed():
+                    # Recorded on the loop, since that's where the history is read
+                    self._loop.call_soon_threadsafe(self._record, report)
+
+    def _capture(self):
+        frame = sys._current_frames().get(self._loop_thread_id)
+        frames = traceback.extract_stack(frame) if frame else []
+        stack = ''.join(frames.format()) if frames else ''
+        where = f'{frames[-1].filename}:{frames[-1].lineno} in {frames[-1].name}' if frames else 'unknown'
+
+        try:
+            current = asyncio.current_task(self._loop)
+            task = current.get_name() if current else 'a callback'
+        except RuntimeError:
+            task = 'unknown'
+
+        return task, where, stack
+
+    def _record(self, report):
+        self.blocks.append(report)
+        if self.on_block:
+            self._report(report)
+
+    def _report(self, report):
+        try:
+            result = self.on_block(report)
+            if asyncio.iscoroutine(result):
+                task = self._loop.create_task(result, name='report_blocked_loop')
+                self._reporting.add(task)
+                task.add_done_callback(self._reported)
+        except Exception:
+            log.exception('Error reporting a blocked loop')
+
+    def _reported(self, task):
+        self._reporting.discard(task)
+        if not task.cancelled() and task.exception():
+            log.error('Error reporting a blocked loop', exc_info=task.exception())
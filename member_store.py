@@ -0,0 +1,130 @@
+# member_store.py
+#
+# A compact stand-in for the guild member cache, for running with discord.py's member cache and
+# startup chunking turned off (LOW_MEMORY_MEMBERS=1). The only thing the bot needs to know about
+# every member is what cakeday.py reads: the ID, join date, display name and whether it's a bot.
+# The store keeps just that for each human member in a small __slots__ record, fills itself with a
+# paged member fetch after startup and is kept current from the Client's join and leave events. It
+# has the parts of the discord.Guild interface that cakeday.py uses (name, members, get_member), so
+# it can be passed in place of the guild.
+#
+# discord.py only dispatches member updates for cached members, so with the cache off nickname
+# changes never reach the store. Join dates and bot flags don't change, so the cakeday index stays
+# correct; display names are refreshed whenever members are resolved for the daily cakeday post.
+
+import asyncio
+import logging
+import os
+import time
+
+from datetime import datetime, timezone
+
+# Whether the Client should run in low-memory mode
+LOW_MEMORY = os.environ.get('LOW_MEMORY_MEMBERS', '').lower() in ('1', 'true', 'yes')
+
+# Members are fetched in pages of this size (Discord's maximum), yielding to the loop in between
+PAGE_SIZE = 1000
+
+# How many members can be resolved to full discord.Member objects in one gateway request
+QUERY_LIMIT = 100
+
+log = logging.getLogger('app.member_store')
+
+class MemberRecord:
+    """
+    The little we keep about a member. Bots are never stored, so 'bot' is always False.
+    """
+
+    __slots__ = ('id', '_joined', 'display_name')
+
+    bot = False
+
+    def __init__(self, id, joined_at, display_name):
+        self.id = id
+        self._joined = int(joined_at.timestamp())  # An int is a lot smaller than a datetime
+        self.display_name = display_name
+
+    @property
+    def joined_at(self):
+        return datetime.fromtimestamp(self._joined, timezone.utc)
+
+    def __repr__(self):
+        return f'<MemberRecord id={self.id} display_name={self.display_name!r}>'
+
+class MemberStore:
+    """
+    The human members of a guild, as MemberRecords keyed by ID.
+    """
+
+    def __init__(self, guild):
+        self.guild = guild
+        self._records = {}
+        self.loaded = asyncio.Event()
+
+    @property
+    def name(self):
+        return self.guild.name
+
+    @property
+    def members(self):
+        return list(self._records.values())
+
+    def __len__(self):
+        return len(self._records)
+
+    def get_member(self, member_id):
+        return self._records.get(member_id)
+
+    def add(self, member):
+        """
+        Add or update a member from a discord.Member. Bots and members without a join date are ignored.
+        """
+        if member.bot or member.joined_at is None:
+            self._records.pop(member.id, None)
+            return
+
+        self._records[member.id] = MemberRecord(member.id, member.joined_at, member.display_name)
+
+    def remove(self, member_id):
+        self._records.pop(member_id, None)
+
+    async def load(self):
+        """
+        (Re)fill the store by fetching every member of the guild over HTTP, a page at a time.
+        """
+        started = time.perf_counter()
+        records = {}
+
+        count = 0
+        async for member in self.guild.fetch_members(limit=None):
+            count += 1
+            if not member.bot and member.joined_at is not None:
+                records[member.id] = MemberRecord(member.id, member.joined_at, member.display_name)
+            if count % PAGE_SIZE == 0:
+                await asyncio.sleep(0)  # Let the gateway breathe between pages
+
+        self._records = records
+        self.loaded.set()
+        log.info(f'Loaded {len(records)} of {count} members of server {self.name} in {time.perf_counter() - started:.1f}s')
+
+    async def resolve(self, members):
+        """
+        Turn a list of (MemberRecord, years) into a list of (discord.Member, years) for the members
+        that are still in the guild, e.g. so that roles can be added to them.
+        """
+        years_by_id = {record.id: years for record, years in members}
+        ids = list(years_by_id)
+
+        resolved = {}
+        for i in range(0, len(ids), QUERY_LIMIT):
+            batch = ids[i:i + QUERY_LIMIT]
+            for member in await self.guild.query_members(user_ids=batch, limit=len(batch), cache=False):
+                resolved[member.id] = member
+                self.add(member)  # Pick up any change of name since the store was loaded
+
+        missing = len(ids) - len(resolved)
+        if missing:
+            log.warning(f'{missing} cakeday member(s) are no longer in server {self.name}')
+
+        # Keep the original order
+        return [(resolved[record.id], years) for record, years in members if record.id in resolved]
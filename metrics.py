@@ -0,0 +1,276 @@
+# metrics.py
+#
+# A lightweight in-process metrics registry: counters and latency histograms, labelled per command
+# and per background job ("task") and per phase of the work (fetch, generate, chunk, send). The
+# current task is tracked in a context variable, so the low-level code timing a phase doesn't need
+# to know who it is working for. Summaries are available through `$pw stats`, and when the
+# METRICS_PORT environment variable is set the registry is also served on localhost in the
+# Prometheus text exposition format.
+
+import asyncio
+import functools
+import logging
+import os
+import time
+
+from aiohttp import web
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Histogram bucket upper bounds, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Prefix for every metric name in the exposition format
+NAMESPACE = 'pidlwick'
+
+# The localhost port for the Prometheus endpoint, or None to disable it
+PORT = int(os.environ['METRICS_PORT']) if os.environ.get('METRICS_PORT') else None
+
+log = logging.getLogger('app.metrics')
+
+# The command or background job the current coroutine is working for
+current_task = ContextVar('current_task', default='other')
+
+class Counter:
+    """
+    A monotonically increasing count for each combination of label values.
+    """
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}  # label values -> count
+
+    def inc(self, amount=1, **labels):
+        key = _key(self, labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in sorted(self.values.items()):
+            yield self.name, key, (), value
+
+class Histogram:
+    """
+    Observed durations (in seconds) for each combination of label values, counted into BUCKETS.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.series = {}  # label values -> _Series
+
+    def observe(self, value, **labels):
+        key = _key(self, labels)
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = _Series(len(self.buckets))
+
+        series.counts[bisect_left(self.buckets, value)] += 1
+        series.count += 1
+        series.sum += value
+        series.max = max(series.max, value)
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observe the time taken by the body of a `with` block.
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def quantile(self, q, **labels):
+        """
+        Estimate the q-quantile (0-1) of a series as the upper bound of the bucket it falls in,
+        capped by the largest value observed.
+        """
+        series = self.series.get(_key(self, labels))
+        return series.quantile(q, self.buckets) if series else 0.0
+
+    def samples(self):
+        for key, series in sorted(self.series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), series.counts):
+                cumulative += count
+                yield f'{self.name}_bucket', key, (('le', _format_bound(bound)),), cumulative
+            yield f'{self.name}_sum', key, (), series.sum
+            yield f'{self.name}_count', key, (), series.count
+
+class _Series:
+    __slots__ = ('counts', 'count', 'sum', 'max')
+
+    def __init__(self, buckets):
+        self.counts = [0] * (buckets + 1)  # The last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def quantile(self, q, bounds):
+        target = q * self.count
+        cumulative = 0
+        for bound, count in zip(bounds, self.counts):
+            cumulative += count
+            if cumulative >= target and cumulative:
+                return min(bound, self.max)
+        return self.max
+
+class Registry:
+    """
+    All the metrics of the process, by name.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+
+    def counter(self, name, help, labels=()):
+        return self._get_or_create(Counter, name, help, labels)
+
+    def histogram(self, name, help, labels=()):
+        return self._get_or_create(Histogram, name, help, labels)
+
+    def exposition(self):
+        """
+        Render every metric in the Prometheus text exposition format.
+        """
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, key, extra, value in metric.samples():
+                pairs = tuple(zip(metric.labels, key)) + extra
+                labels = ','.join(f'{label}="{_escape(value)}"' for label, value in pairs)
+                lines.append(f'{name}{{{labels}}} {value}' if labels else f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def _get_or_create(self, cls, name, help, labels):
+        name = f'{NAMESPACE}_{name}'
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = cls(name, help, labels)
+        elif not isinstance(metric, cls):
+            raise ValueError(f'Metric {name} is already registered as a {metric.kind}')
+        return metric
+
+registry = Registry()
+
+# The metrics recorded by the bot itself
+task_seconds = registry.histogram('task_seconds', 'Time taken by commands and background jobs', ('task',))
+task_total = registry.counter('task_total', 'Commands and background jobs run, by outcome', ('task', 'outcome'))
+phase_seconds = registry.histogram('phase_seconds', 'Time taken by each phase of a command or job', ('task', 'phase'))
+script_cache_total = registry.counter('script_cache_total', 'Generator script lookups, by outcome (hit, compile or fallback)', ('outcome',))
+script_cache_saved_seconds = registry.counter('script_cache_saved_seconds_total', 'Download and compile time saved by generator script cache hits')
+
+@contextmanager
+def track(task):
+    """
+    Time the body of a `with` block as the command or job 'task' and count its outcome. Phases
+    timed within the block (in this coroutine or tasks it creates) are attributed to 'task'.
+    """
+    token = current_task.set(task)
+    started = time.perf_counter()
+    outcome = 'error'
+    try:
+        yield
+        outcome = 'ok'
+    finally:
+        task_seconds.observe(time.perf_counter() - started, task=task)
+        task_total.inc(task=task, outcome=outcome)
+        current_task.reset(token)
+
+def phase(name, task=None):
+    """
+    Time the body of a `with` block as phase 'name' of 'task', by default the current task.
+    """
+    return phase_seconds.time(task=task or current_task.get(), phase=name)
+
+def timed(name):
+    """
+    Decorate a function or coroutine function so that every call is timed as phase 'name' of the
+    task it is called for.
+    """
+    def decorate(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with phase(name):
+                    return await func(*args, **kwargs)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with phase(name):
+                    return func(*args, **kwargs)
+        return wrapper
+
+    return decorate
+
+def summary():
+    """
+    A human-readable summary of the task and phase latencies, one line per series.
+    """
+    lines = []
+    for key, series in sorted(task_seconds.series.items()):
+        task = key[0]
+        errors = task_total.values.get((task, 'error'), 0)
+        lines.append(f'**{task}**: {_describe(series, task_seconds.buckets)}, {errors} failed')
+
+        for (phase_task, phase_name), phase_series in sorted(phase_seconds.series.items()):
+            if phase_task == task:
+                lines.append(f'\t* {phase_name}: {_describe(phase_series, phase_seconds.buckets)}')
+
+    # Phases of work not done on behalf of a tracked task, e.g. sends queued outside of one
+    for (phase_task, phase_name), phase_series in sorted(phase_seconds.series.items()):
+        if (phase_task,) not in task_seconds.series:
+            lines.append(f'{phase_task} {phase_name}: {_describe(phase_series, phase_seconds.buckets)}')
+
+    if script_cache_total.values:
+        count = lambda outcome: script_cache_total.values.get((outcome,), 0)
+        saved = script_cache_saved_seconds.values.get((), 0.0)
+        lines.append(f'Script cache: {count("hit")} hits ({_ms(saved)} saved), {count("compile")} compiles, {count("fallback")} fallbacks')
+
+    return lines or ['No metrics recorded yet.']
+
+async def start_server(port=PORT):
+    """
+    Serve the registry in the Prometheus text format at http://127.0.0.1:<port>/metrics. Returns the
+    runner to clean up on shutdown, or None if no port is configured.
+    """
+    if not port:
+        return None
+
+    async def handle(request):
+        return web.Response(text=registry.exposition(), content_type='text/plain', charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', port).start()
+    log.info(f'Serving metrics on http://127.0.0.1:{port}/metrics')
+    return runner
+
+def _describe(series, buckets):
+    return (f'{series.count} runs, p50 {_ms(series.quantile(0.5, buckets))}, '
+            f'p95 {_ms(series.quantile(0.95, buckets))}, max {_ms(series.max)}')
+
+def _ms(seconds):
+    return f'{seconds * 1000:.0f}ms' if seconds < 10 else f'{seconds:.1f}s'
+
+def _key(metric, labels):
+    return tuple(str(labels.get(label, '')) for label in metric.labels)
+
+def _format_bound(bound):
+    return '+Inf' if bound == float('inf') else repr(bound)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
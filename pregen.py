@@ -0,0 +1,104 @@
+# pregen.py
+#
+# Pre-generation of scheduled content. Shortly before a post is due (LEAD_TIME), its payload (shop
+# inventory text, almanac embed, ...) is generated and held in a queue that is persisted to disk.
+# At the deadline the scheduled task only has to send it. If generation fails it is retried every
+# RETRY_INTERVAL until the deadline; after that the task falls back to generating on the spot.
+
+import asyncio
+import json
+import logging
+import os
+
+from datetime import datetime, timedelta, timezone
+
+# How long before the deadline pre-generation starts
+LEAD_TIME = timedelta(minutes=int(os.environ.get('PREGEN_LEAD_MINUTES', 30)))
+
+# How long to wait between pre-generation attempts
+RETRY_INTERVAL = timedelta(minutes=5)
+
+QUEUE_PATH = os.path.join(os.environ.get('PIDLWICK_CACHE_DIR', '.cache'), 'pregenerated.json')
+
+log = logging.getLogger('app.pregen')
+
+class PregenQueue:
+    """
+    Payloads generated ahead of time, keyed by job name and the date they are due. Payloads must be
+    JSON serializable. The queue is saved to disk after every change so it survives a restart.
+    """
+
+    def __init__(self, path=QUEUE_PATH):
+        self.path = path
+        self._payloads = self._load()
+
+    def __contains__(self, key):
+        return key in self._payloads
+
+    def put(self, key, due, payload):
+        """
+        Hold 'payload' for the job 'key' due on the date 'due', replacing anything already held.
+        """
+        self._payloads[key] = {'due': due.isoformat(), 'payload': payload}
+        self._save()
+
+    def take(self, key, due):
+        """
+        Remove and return the payload held for the job 'key' if it is for the date 'due', else None.
+        """
+        held = self._payloads.pop(key, None)
+        if held is None:
+            return None
+
+        self._save()
+        if held['due'] != due.isoformat():
+            log.warning(f'Discarding pre-generated {key} for {held["due"]}, wanted {due}')
+            return None
+
+        log.info(f'Using pre-generated {key} for {due}')
+        return held['payload']
+
+    async def prepare(self, key, deadline, generate):
+        """
+        Run the coroutine function 'generate' and hold its result for the job 'key' due at 'deadline'
+        (a datetime). Failures are retried every RETRY_INTERVAL for as long as there is time before
+        the deadline. Returns True iff a payload is now held.
+        """
+        attempt = 1
+        while True:
+            try:
+                payload = await generate()
+            except Exception as e:
+                retry_at = datetime.now(timezone.utc) + RETRY_INTERVAL
+                if retry_at >= deadline:
+                    log.error(f'Pre-generating {key} failed on attempt {attempt}, giving up before the deadline: {e!r}')
+                    return False
+
+                log.warning(f'Pre-generating {key} failed on attempt {attempt}, retrying at {retry_at:%H:%M}: {e!r}')
+                attempt += 1
+                await asyncio.sleep(RETRY_INTERVAL.total_seconds())
+                continue
+
+            self.put(key, deadline.date(), payload)
+            log.info(f'Pre-generated {key} for {deadline.date()} on attempt {attempt}')
+            return True
+
+    def _load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            log.warning(f'Ignoring unreadable pre-generation queue {self.path}: {e!r}')
+            return {}
+
+    def _save(self):
+        try:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            temp_path = f'{self.path}.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(self._payloads, f)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            log.warning(f'Unable to save pre-generation queue to {self.path}: {e!r}')
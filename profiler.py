@@ -0,0 +1,105 @@
+# profiler.py
+#
+# On-demand profiling of a single command or background job run in production, for `$pw profile`.
+# The run is profiled with cProfile for CPU hotspots and with tracemalloc for allocations, and the
+# result is a plain text report meant to be attached to a message. cProfile sees everything that
+# runs on the event loop thread while the profile is active, so other work happening at the same
+# time shows up in the report too.
+
+import asyncio
+import cProfile
+import io
+import logging
+import pstats
+import time
+import tracemalloc
+
+# How many functions to list in each of the CPU sections of the report
+TOP_FUNCTIONS = 30
+
+# How many source lines to list in the allocation section of the report
+TOP_ALLOCATIONS = 20
+
+# How many frames of traceback tracemalloc keeps per allocation
+TRACEMALLOC_FRAMES = 1
+
+log = logging.getLogger('app.profiler')
+
+_lock = asyncio.Lock()
+
+class ProfileInProgress(Exception):
+    """
+    Only one profile can run at a time.
+    """
+
+async def profile(name, func, *args, **kwargs):
+    """
+    Await func(*args, **kwargs) under cProfile and tracemalloc and return a text report of the run
+    called 'name'. The report is returned even if the call raises, with the error at the top.
+    Raises ProfileInProgress if another profile is already running.
+    """
+    if _lock.locked():
+        raise ProfileInProgress('Another profile is already running')
+
+    async with _lock:
+        already_tracing = tracemalloc.is_tracing()
+        if not already_tracing:
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        tracemalloc.reset_peak()
+
+        before = tracemalloc.take_snapshot()
+        profiler = cProfile.Profile()
+        error = None
+
+        started = time.perf_counter()
+        profiler.enable()
+        try:
+            await func(*args, **kwargs)
+        except Exception as e:
+            error = e
+            log.exception(f'Profiled run of {name} failed')
+        finally:
+            profiler.disable()
+            elapsed = time.perf_counter() - started
+
+            after = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            if not already_tracing:
+                tracemalloc.stop()
+
+        log.info(f'Profiled {name} in {elapsed:.2f}s')
+        return _report(name, elapsed, error, profiler, before, after, current, peak)
+
+def _report(name, elapsed, error, profiler, before, after, current, peak):
+    out = io.StringIO()
+
+    out.write(f'Profile of {name}: {elapsed:.3f}s wall time\n')
+    if error is not None:
+        out.write(f'Run failed: {error!r}\n')
+    out.write(f'Traced memory: {current / 1024:.1f} KiB at the end, {peak / 1024:.1f} KiB peak\n')
+
+    stats = pstats.Stats(profiler, stream=out)
+    stats.strip_dirs()
+
+    out.write(f'\n=== Top {TOP_FUNCTIONS} functions by cumulative time ===\n')
+    stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(TOP_FUNCTIONS)
+
+    out.write(f'\n=== Top {TOP_FUNCTIONS} functions by own time ===\n')
+    stats.sort_stats(pstats.SortKey.TIME).print_stats(TOP_FUNCTIONS)
+
+    out.write(f'\n=== Top {TOP_ALLOCATIONS} lines by memory allocated during the run ===\n')
+    for difference in after.compare_to(before, 'lineno')[:TOP_ALLOCATIONS]:
+        out.write(f'{difference}\n')
+
+    return out.getvalue()
+
+def hotspots(report, count=5):
+    """
+    Pick the first 'count' rows of the cumulative time section out of a report, for a short preview.
+    """
+    lines = report.splitlines()
+    try:
+        start = next(i for i, line in enumerate(lines) if line.lstrip().startswith('ncalls')) + 1
+    except StopIteration:
+        return []
+    return [line for line in lines[start:start + count] if line.strip()]
@@ -0,0 +1,143 @@
+# reloader.py
+#
+# Hot reload for `$pw reload`, so that a change to a feature module or to the configuration doesn't
+# need a restart (which means reconnecting to the gateway and loading every member again). Feature
+# modules are reloaded in place with importlib, so everything that uses them through the module
+# picks up the new code, and the scheduler is given the jobs' new rules. The configuration (.env and
+# GUILDS_CONFIG) is read again and every server's channels and roles are looked up anew, keeping
+# the member indexes. Either kind of reload is all or nothing: if anything fails, the old modules,
+# environment and configuration are put back as they were.
+#
+# Job worker processes (see jobs.py) always run the code that is on disk: they are restarted after a
+# successful module reload, but a worker that is replaced after dying imports whatever is there, even
+# if a reload of it failed or was never asked for.
+
+import asyncio
+import importlib
+import logging
+import os
+import sys
+
+import guild_config
+import jobs
+
+from dotenv import dotenv_values, load_dotenv
+
+# The modules that can be reloaded, in dependency order
+MODULES = ('shop_generator', 'vistani_market', 'tattoo_parlor', 'almanac', 'cakeday', 'staffxp_reminder')
+
+log = logging.getLogger('app.reloader')
+
+_lock = asyncio.Lock()
+
+# The variables defined by .env when it was last read, so that ones since deleted from it can be
+# removed. This module is imported before app.py reads .env, but the file is the same.
+_dotenv_keys = set(dotenv_values())
+
+class ReloadError(Exception):
+    """
+    A reload failed and was rolled back.
+    """
+
+async def reload_modules(client, names=MODULES):
+    """
+    Reload the given feature modules and reschedule the client's jobs with their new rules. Returns
+    a line describing what was done. Raises ReloadError, having restored the old modules, if a
+    module fails to load or no longer provides what the client needs.
+    """
+    unknown = [name for name in names if name not in MODULES]
+    if unknown:
+        raise ReloadError(f'Not a reloadable module: {", ".join(unknown)} (try one of {", ".join(MODULES)})')
+
+    async with _exclusive(client):
+        # reload() re-executes a module in its existing namespace, so that's what to restore
+        saved = {name: dict(vars(sys.modules[name])) for name in names}
+        try:
+            for name in names:
+                importlib.reload(sys.modules[name])
+            rules = client.job_rules()  # Before changing anything, so that a failure can be rolled back
+        except Exception as e:
+            for name, namespace in saved.items():
+                module_vars = vars(sys.modules[name])
+                module_vars.clear()
+                module_vars.update(namespace)
+            log.exception(f'Reloading {", ".join(names)} failed, rolled back')
+            raise ReloadError(f'Reloading {", ".join(names)} failed, nothing was changed: {e!r}') from e
+
+        for name, rule, _, _ in rules:
+            client.scheduler.reschedule(name, rule)
+
+        # Worker processes can't be reloaded in place, but fresh ones import the new code. Only
+        # once the reload has succeeded, since they can't be rolled back.
+        if jobs.using_workers():
+            await asyncio.to_thread(jobs.restart_workers)
+
+    log.info(f'Reloaded {", ".join(names)}')
+    return f'Reloaded {", ".join(names)} and rescheduled {len(rules)} jobs.'
+
+async def reload_config(client):
+    """
+    Read .env and the server configuration again and switch the client over to freshly resolved
+    GuildContexts. Variables deleted from .env are removed from the environment. Returns a line
+    describing what was done. Raises ReloadError, having restored the old environment, if the
+    configuration can't be loaded or names a server the bot isn't in.
+    """
+    global _dotenv_keys
+
+    async with _exclusive(client):
+        # A context still loading its members would hand a half-built index to its replacement
+        loading = [context.name for context in client.contexts.values() if not context.members_ready.is_set()]
+        if loading:
+            raise ReloadError(f'Members are still loading, try again when they are done: {", ".join(loading)}')
+
+        environment = dict(os.environ)
+        try:
+            dotenv = dotenv_values()
+            for key in _dotenv_keys - dotenv.keys():
+                os.environ.pop(key, None)
+            load_dotenv(override=True)
+            configs = guild_config.load(os.environ.get('GUILDS_CONFIG'))
+            contexts = await client.resolve_contexts(configs, previous=client.contexts)
+
+            missing = [config.name for config in configs if config.server not in contexts]
+            if missing:
+                raise ReloadError(f'Unable to find server(s): {", ".join(missing)}')
+        except Exception as e:
+            os.environ.clear()
+            os.environ.update(environment)
+            log.exception('Reloading the configuration failed, rolled back')
+            raise ReloadError(f'Reloading the configuration failed, nothing was changed: {e}') from e
+
+        _dotenv_keys = set(dotenv)
+        added = [context for guild_id, context in contexts.items() if guild_id not in client.contexts]
+        client.guild_configs = configs
+        client.use_contexts(contexts)
+
+    # Servers that weren't served before need their members loaded
+    for context in added:
+        context.start_loading_members()
+
+    log.info(f'Reloaded the configuration of {len(contexts)} server(s)')
+    return f'Reloaded the configuration of {len(contexts)} server(s), {len(added)} new.'
+
+class _exclusive:
+    """
+    Hold the reload lock, refusing while another reload or any background job is running: a job
+    could otherwise see half of the old code or configuration and half of the new.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    async def __aenter__(self):
+        if _lock.locked():
+            raise ReloadError('Another reload is in progress')
+
+        running = [job.name for job in self.client.scheduler.jobs() if job.running]
+        if running:
+            raise ReloadError(f'Jobs are running, try again when they are done: {", ".join(running)}')
+
+        await _lock.acquire()
+
+    async def __aexit__(self, *exc_info):
+        _lock.release()
@@ -0,0 +1,321 @@
+# scheduler.py
+#
+# A single scheduler for all of the bot's background jobs. Each job has a declarative rule (daily,
+# weekly, every N days from an epoch, ...) evaluated in UTC, and the scheduler keeps a min-heap of
+# next fire times so that it only wakes up when there is real work to do. The time of each job's
+# last run is persisted, so a run missed while the bot was down (e.g. a dyno restart) can be caught
+# up when it comes back.
+
+import asyncio
+import heapq
+import itertools
+import json
+import logging
+import metrics
+import os
+import tracing
+
+from datetime import datetime, timedelta, timezone
+
+# Missed runs older than this are skipped rather than caught up, e.g. yesterday's almanac
+CATCH_UP_WINDOW = timedelta(hours=6)
+
+# Upper bound on a single sleep, so that wall-clock adjustments are noticed eventually
+MAX_SLEEP = 60 * 60
+
+STATE_PATH = os.path.join(os.environ.get('PIDLWICK_CACHE_DIR', '.cache'), 'scheduler.json')
+
+log = logging.getLogger('app.scheduler')
+
+def utcnow():
+    return datetime.now(timezone.utc)
+
+class Rule:
+    """
+    Fires at a time of day (UTC unless the time says otherwise) on every day that `fires_on` accepts.
+    """
+
+    def __init__(self, at):
+        self.at = at
+
+    def fires_on(self, day):
+        return True
+
+    def next_after(self, moment):
+        """
+        Return the first fire time strictly after 'moment'.
+        """
+        day = moment.date() - timedelta(days=1)  # The time zone of 'at' may put today's fire yesterday
+        while True:
+            candidate = datetime.combine(day, self.at.replace(tzinfo=None), tzinfo=self.at.tzinfo or timezone.utc)
+            if candidate > moment and self.fires_on(candidate.date()):
+                return candidate
+            day += timedelta(days=1)
+
+class Daily(Rule):
+    """
+    Fires every day at the given time.
+    """
+
+class Weekly(Rule):
+    """
+    Fires at the given time on the given weekdays (0-Monday, 6-Sunday).
+    """
+
+    def __init__(self, at, weekdays):
+        super().__init__(at)
+        self.weekdays = frozenset(weekdays)
+
+    def fires_on(self, day):
+        return day.weekday() in self.weekdays
+
+class EveryNDays(Rule):
+    """
+    Fires at the given time every 'days' days, counting from the date 'epoch'.
+    """
+
+    def __init__(self, at, days, epoch):
+        super().__init__(at)
+        self.days = days
+        self.epoch = epoch
+
+    def fires_on(self, day):
+        return (day - self.epoch).days % self.days == 0
+
+class Interval:
+    """
+    Fires every 'period' (a timedelta), starting one period after the scheduler starts.
+    """
+
+    def __init__(self, period):
+        self.period = period
+
+    def next_after(self, moment):
+        return moment + self.period
+
+class Lead:
+    """
+    Fires 'lead' (a timedelta) before every fire of another rule, e.g. to prepare for it.
+    """
+
+    def __init__(self, rule, lead):
+        self.rule = rule
+        self.lead = lead
+
+    def next_after(self, moment):
+        return self.rule.next_after(moment + self.lead) - self.lead
+
+class Job:
+    """
+    A coroutine function that is called with the time it was scheduled for, according to a rule.
+    """
+
+    def __init__(self, name, rule, func, catch_up):
+        self.name = name
+        self.rule = rule
+        self.func = func
+        self.catch_up = catch_up
+        self.next_run = None
+        self.running = False
+
+class Scheduler:
+    """
+    Runs jobs at the times given by their rules. 'before' is awaited once before any job runs (e.g.
+    to wait for the client to be ready) and 'on_error' is awaited with any exception a job raises.
+    """
+
+    def __init__(self, before=None, on_error=None, state_path=STATE_PATH):
+        self.before = before
+        self.on_error = on_error
+        self.state_path = state_path
+
+        self._jobs = {}
+        self._heap = []  # (next run, tie-breaker, job name)
+        self._seq = itertools.count()
+        self._last_runs = self._load_state()
+        self._wakeup = asyncio.Event()
+        self._save_lock = asyncio.Lock()  # One write of the state file at a time
+        self._task = None
+        self._running = set()  # Tasks of the job runs in progress, which asyncio only weakly references
+        self._started = False
+
+    def add(self, name, rule, func, catch_up=False):
+        """
+        Schedule the coroutine function 'func' to be called as func(when) at every fire time of
+        'rule'. If 'catch_up' is set, a run missed within CATCH_UP_WINDOW is made up on start.
+        """
+        if name in self._jobs:
+            raise ValueError(f'A job named {name!r} is already scheduled')
+
+        job = self._jobs[name] = Job(name, rule, func, catch_up)
+        if self._started:
+            self._schedule(job, utcnow())
+            self._wakeup.set()
+
+    def reschedule(self, name, rule):
+        """
+        Give a job a new rule, e.g. after its module was reloaded. Its next run is recomputed from now.
+        """
+        job = self._jobs[name]
+        job.rule = rule
+        if self._started:
+            self._schedule(job, utcnow())
+            self._wakeup.set()
+
+    def remove(self, name):
+        """
+        Unschedule a job. A run that is already in progress is not interrupted.
+        """
+        self._jobs.pop(name, None)
+        self._wakeup.set()
+
+    def jobs(self):
+        """
+        Return the scheduled jobs, soonest first.
+        """
+        return sorted(self._jobs.values(), key=lambda job: job.next_run or datetime.max.replace(tzinfo=timezone.utc))
+
+    def start(self):
+        """
+        Start the scheduler's background task. Must be called from within the running event loop.
+        """
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name='scheduler')
+
+    async def stop(self):
+        """
+        Stop the scheduler, cancelling any job runs in progress.
+        """
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+        for task in self._running:
+            task.cancel()
+        await asyncio.gather(*self._running, return_exceptions=True)
+
+    async def run_now(self, name):
+        """
+        Run a job immediately (e.g. from a command), as if it were scheduled for now.
+        """
+        await self._invoke(self._jobs[name], utcnow())
+
+    async def _run(self):
+        if self.before:
+            await self.before()
+
+        now = utcnow()
+        self._started = True
+        for job in self._jobs.values():
+            self._schedule(job, now, catch_up=job.catch_up)
+            self._last_runs.setdefault(job.name, now)  # Baseline for catching up after a restart
+        await self._persist()
+
+        while True:
+            self._wakeup.clear()
+
+            # Drop entries for jobs that were removed or rescheduled
+            while self._heap and self._is_stale(self._heap[0]):
+                heapq.heappop(self._heap)
+
+            if not self._heap:
+                await self._wakeup.wait()
+                continue
+
+            when, _, name = self._heap[0]
+            delay = (when - utcnow()).total_seconds()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=min(delay, MAX_SLEEP))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            heapq.heappop(self._heap)
+            job = self._jobs[name]
+            task = asyncio.create_task(self._invoke(job, when), name=f'job:{name}')
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+            self._schedule(job, when)
+
+    def _is_stale(self, entry):
+        when, _, name = entry
+        job = self._jobs.get(name)
+        return job is None or job.next_run != when
+
+    def _schedule(self, job, after, catch_up=False):
+        """
+        Push the job's next run after 'after' onto the heap, or its most recent missed run if
+        catching up.
+        """
+        when = job.rule.next_after(after)
+
+        if catch_up:
+            missed = self._last_missed(job, after)
+            if missed:
+                log.info(f'Catching up on {job.name}, which was missed at {missed:%Y-%m-%d %H:%M} UTC')
+                when = missed
+
+        job.next_run = when
+        heapq.heappush(self._heap, (when, next(self._seq), job.name))
+
+    def _last_missed(self, job, now):
+        last_run = self._last_runs.get(job.name)
+        if last_run is None:
+            return None
+
+        missed = None
+        fire = job.rule.next_after(last_run)
+        while fire <= now:
+            missed = fire
+            fire = job.rule.next_after(fire)
+
+        return missed if missed and now - missed <= CATCH_UP_WINDOW else None
+
+    async def _invoke(self, job, when):
+        if job.running:
+            log.warning(f'Skipping {job.name} for {when:%Y-%m-%d %H:%M}, the previous run is still going')
+            return
+
+        log.debug('%s: scheduled job has started', job.name)
+        job.running = True
+        try:
+            with metrics.track(job.name), tracing.trace(job.name):
+                await job.func(when)
+        except Exception as e:
+            log.exception(f'{job.name} failed')
+            if self.on_error:
+                await self.on_error(e)
+        finally:
+            job.running = False
+            self._last_runs[job.name] = when
+            await self._persist()
+
+    def _load_state(self):
+        try:
+            with open(self.state_path, 'r', encoding='utf-8') as f:
+                return {name: datetime.fromisoformat(when) for name, when in json.load(f).items()}
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            log.warning(f'Ignoring unreadable scheduler state {self.state_path}: {e!r}')
+            return {}
+
+    async def _persist(self):
+        """
+        Save the last run times. The snapshot is taken on the loop, since jobs keep updating them,
+        and several jobs finishing at once (e.g. at midnight) take turns writing the file.
+        """
+        state = {name: when.isoformat() for name, when in self._last_runs.items()}
+        async with self._save_lock:
+            await asyncio.to_thread(self._save_state, state)
+
+    def _save_state(self, state):
+        try:
+            os.makedirs(os.path.dirname(self.state_path) or '.', exist_ok=True)
+            temp_path = f'{self.state_path}.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(state, f)
+            os.replace(temp_path, self.state_path)
+        except OSError as e:
+            log.warning(f'Unable to save scheduler state to {self.state_path}: {e!r}')
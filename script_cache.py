@@ -0,0 +1,219 @@
+# script_cache.py
+#
+# A content-addressed cache of compiled generator scripts for `utils.run_script`. Compiled code
+# objects are kept in memory keyed by the SHA-256 of their source, and the source is saved to disk.
+# Scripts are revalidated with a conditional GET (ETag/Last-Modified), so an unchanged script costs
+# a 304 and no recompilation. If the fetch fails, the last good version is used instead.
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import metrics
+import time
+
+from http_client import fetch
+
+# How long a script is trusted before it is revalidated upstream, in seconds.
+MAX_AGE = 60 * 60
+
+# Where the source of every script version we've seen is persisted, named by its hash.
+CACHE_DIR = os.path.join(os.environ.get('PIDLWICK_CACHE_DIR', '.cache'), 'scripts')
+INDEX_PATH = os.path.join(CACHE_DIR, 'index.json')
+
+log = logging.getLogger('app.script_cache')
+
+class _Entry:
+    """
+    What we know about the current version of the script at a URL.
+    """
+
+    __slots__ = ('digest', 'etag', 'last_modified', 'fetched_at', 'cost')
+
+    def __init__(self, digest, etag=None, last_modified=None, fetched_at=0.0, cost=0.0):
+        self.digest = digest
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched_at = fetched_at
+        self.cost = cost  # Seconds it took to download and compile, i.e. what a cache hit saves
+
+class CacheStats:
+    """
+    Counters for how well the cache is doing, for the log. The same counts are kept in metrics.py
+    for `$pw stats` and the metrics endpoint.
+    """
+
+    def __init__(self):
+        self.hits = 0  # Served without downloading or compiling (fresh, 304, or same content)
+        self.misses = 0  # Had to compile new source
+        self.fallbacks = 0  # Fetch failed, served the last good version
+        self.seconds_saved = 0.0
+
+    @property
+    def calls(self):
+        return self.hits + self.misses + self.fallbacks
+
+    @property
+    def hit_rate(self):
+        return self.hits / self.calls if self.calls else 0.0
+
+    def __str__(self):
+        saved_per_call = self.seconds_saved / self.calls if self.calls else 0.0
+        return (f'{self.calls} calls, {self.hit_rate:.0%} hit rate, {self.fallbacks} fallbacks, '
+                f'{saved_per_call * 1000:.1f}ms saved per call')
+
+stats = CacheStats()
+
+_entries = {}  # URL -> _Entry
+_code = {}  # SHA-256 hex digest -> code object
+_index_loaded = False
+_lock = asyncio.Lock()
+
+async def get_code(url):
+    """
+    Return the compiled code object for the script at 'url', fetching and compiling it only if its
+    content has changed. Raises only if the fetch fails and no previous version is available.
+    """
+    async with _lock:
+        await _load_index()
+
+        entry = _entries.get(url)
+        if entry and entry.digest in _code and time.time() - entry.fetched_at < MAX_AGE:
+            return _hit(url, entry, entry.cost)
+
+        started = time.perf_counter()
+        try:
+            response = await _conditional_fetch(url, entry)
+        except Exception as e:
+            return await _fallback(url, entry, e)
+        fetch_seconds = time.perf_counter() - started
+
+        if response.status == 304 and entry:
+            entry.fetched_at = time.time()
+            code = await _code_for(entry.digest)
+            if code:
+                return _hit(url, entry, entry.cost - fetch_seconds)
+
+            # We've lost the source for the version upstream says we have, so download it again
+            try:
+                response = await fetch(url)
+            except Exception as e:
+                return await _fallback(url, None, e)
+
+        source = response.body
+        digest = hashlib.sha256(source).hexdigest()
+        new_entry = _Entry(
+            digest,
+            etag=response.headers.get('ETag'),
+            last_modified=response.headers.get('Last-Modified'),
+            fetched_at=time.time(),
+            cost=entry.cost if entry else 0.0,
+        )
+        _entries[url] = new_entry
+
+        if digest in _code:
+            # Changed validators but identical content - nothing to recompile
+            await asyncio.to_thread(_save_index)
+            return _hit(url, new_entry, new_entry.cost - fetch_seconds)
+
+        code = compile(source, url, 'exec')
+        _code[digest] = code
+        new_entry.cost = time.perf_counter() - started
+
+        await asyncio.to_thread(_save_source, digest, source)
+        await asyncio.to_thread(_save_index)
+
+        stats.misses += 1
+        metrics.script_cache_total.inc(outcome='compile')
+        log.info(f'Compiled new version {digest[:12]} of {url} in {new_entry.cost * 1000:.1f}ms ({stats})')
+        return code
+
+def _hit(url, entry, saved):
+    stats.hits += 1
+    stats.seconds_saved += max(saved, 0.0)
+    metrics.script_cache_total.inc(outcome='hit')
+    metrics.script_cache_saved_seconds.inc(max(saved, 0.0))
+    log.info(f'Using cached version {entry.digest[:12]} of {url} ({stats})')
+    return _code[entry.digest]
+
+async def _fallback(url, entry, error):
+    """
+    Serve the last good version of the script after a failed fetch, or re-raise if there isn't one.
+    """
+    code = await _code_for(entry.digest) if entry else None
+    if code is None:
+        raise error
+
+    stats.fallbacks += 1
+    metrics.script_cache_total.inc(outcome='fallback')
+    log.warning(f'Unable to fetch {url}, using last good version {entry.digest[:12]}: {error!r} ({stats})')
+    return code
+
+async def _conditional_fetch(url, entry):
+    headers = {}
+    if entry and entry.etag:
+        headers['If-None-Match'] = entry.etag
+    if entry and entry.last_modified:
+        headers['If-Modified-Since'] = entry.last_modified
+
+    return await fetch(url, headers=headers)
+
+async def _code_for(digest):
+    """
+    Return the compiled code for 'digest' from memory, or compile it from the source on disk.
+    """
+    code = _code.get(digest)
+    if code is None:
+        source = await asyncio.to_thread(_load_source, digest)
+        if source is not None:
+            code = _code[digest] = compile(source, digest, 'exec')
+    return code
+
+async def _load_index():
+    global _index_loaded
+
+    if not _index_loaded:
+        _index_loaded = True
+        for url, data in (await asyncio.to_thread(_read_index)).items():
+            _entries.setdefault(url, _Entry(data['digest'], data.get('etag'), data.get('last_modified')))
+
+def _read_index():
+    try:
+        with open(INDEX_PATH, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        log.warning(f'Ignoring unreadable script cache index {INDEX_PATH}: {e!r}')
+        return {}
+
+def _save_index():
+    index = {
+        url: {'digest': entry.digest, 'etag': entry.etag, 'last_modified': entry.last_modified}
+        for url, entry in _entries.items()
+    }
+    _write_atomically(INDEX_PATH, json.dumps(index).encode('utf-8'))
+
+def _load_source(digest):
+    try:
+        with open(os.path.join(CACHE_DIR, f'{digest}.py'), 'rb') as f:
+            source = f.read()
+    except OSError:
+        return None
+
+    # Content-addressed, so a corrupted file is easy to spot
+    return source if hashlib.sha256(source).hexdigest() == digest else None
+
+def _save_source(digest, source):
+    _write_atomically(os.path.join(CACHE_DIR, f'{digest}.py'), source)
+
+def _write_atomically(path, data):
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        temp_path = f'{path}.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    except OSError as e:
+        log.warning(f'Unable to write {path}: {e!r}')
@@ -0,0 +1,155 @@
+# sheet_cache.py
+#
+# An in-memory snapshot cache for Google Sheets that rarely change (e.g. the Barovian Almanac).
+# Snapshots are held for MAX_AGE, then conditionally revalidated using ETag/Last-Modified where
+# the endpoint supports it. The last good snapshot is saved to disk so that a cold start or an
+# upstream outage can still be served from the local copy.
+
+import asyncio
+import json
+import logging
+import os
+import time
+
+from http_client import fetch
+from utils import google_sheet_url, parse_csv
+
+# How long a snapshot is served from memory before it is revalidated upstream, in seconds.
+MAX_AGE = 6 * 60 * 60
+
+# Where the last good snapshot of each sheet is persisted.
+CACHE_DIR = os.environ.get('PIDLWICK_CACHE_DIR', '.cache')
+
+log = logging.getLogger('app.sheet_cache')
+
+class Snapshot:
+    """
+    The parsed rows of a sheet along with the validators needed to revalidate them.
+    """
+
+    def __init__(self, rows, etag=None, last_modified=None, fetched_at=0.0):
+        self.rows = rows
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched_at = fetched_at  # Wall-clock time of the last successful (re)validation
+        self._derived = {}
+
+    def derive(self, key, builder):
+        """
+        Return builder(rows), computing it only once per snapshot. Useful for indexes over the rows,
+        which are then rebuilt automatically whenever the sheet actually changes.
+        """
+        if key not in self._derived:
+            self._derived[key] = builder(self.rows)
+        return self._derived[key]
+
+    def age(self):
+        return time.time() - self.fetched_at
+
+    def to_json(self):
+        return {
+            'rows': self.rows,
+            'etag': self.etag,
+            'last_modified': self.last_modified,
+            'fetched_at': self.fetched_at,
+        }
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data['rows'], data.get('etag'), data.get('last_modified'), data.get('fetched_at', 0.0))
+
+_snapshots = {}
+_locks = {}
+
+async def get_snapshot(sheet_id, max_age=MAX_AGE):
+    """
+    Return the current Snapshot for 'sheet_id', revalidating it upstream if it is older than
+    'max_age' seconds. If the upstream fetch fails, the last good snapshot (from memory or disk)
+    is returned instead; the error is only raised if there is nothing to fall back on.
+    """
+    lock = _locks.setdefault(sheet_id, asyncio.Lock())
+
+    # Serialize refreshes so that concurrent callers share a single upstream round trip
+    async with lock:
+        snapshot = _snapshots.get(sheet_id)
+        if snapshot is None:
+            snapshot = await asyncio.to_thread(_load_from_disk, sheet_id)
+            if snapshot:
+                _snapshots[sheet_id] = snapshot
+
+        if snapshot and snapshot.age() < max_age:
+            return snapshot
+
+        try:
+            snapshot = await _revalidate(sheet_id, snapshot)
+        except Exception as e:
+            if snapshot is None:
+                raise
+            log.warning(f'Unable to refresh sheet {sheet_id}, serving snapshot from {snapshot.age():.0f}s ago: {e!r}')
+            return snapshot
+
+        _snapshots[sheet_id] = snapshot
+        return snapshot
+
+async def _revalidate(sheet_id, snapshot):
+    """
+    Conditionally fetch the sheet, returning either the refreshed 'snapshot' (304 Not Modified)
+    or a new Snapshot parsed from the response. Either way it's saved to disk, so that after a
+    restart it's only revalidated once it's really stale.
+    """
+    headers = {}
+    if snapshot and snapshot.etag:
+        headers['If-None-Match'] = snapshot.etag
+    if snapshot and snapshot.last_modified:
+        headers['If-Modified-Since'] = snapshot.last_modified
+
+    response = await fetch(google_sheet_url(sheet_id), headers=headers)
+
+    if response.status == 304 and snapshot:
+        log.debug('Sheet %s is not modified', sheet_id)
+        snapshot.fetched_at = time.time()
+        await asyncio.to_thread(_save_to_disk, sheet_id, snapshot)
+        return snapshot
+
+    rows = parse_csv(response.body.decode(response.charset))
+    log.info(f'Retrieved {len(rows)} rows for sheet {sheet_id}')
+
+    snapshot = Snapshot(
+        rows,
+        etag=response.headers.get('ETag'),
+        last_modified=response.headers.get('Last-Modified'),
+        fetched_at=time.time(),
+    )
+    await asyncio.to_thread(_save_to_disk, sheet_id, snapshot)
+
+    return snapshot
+
+def _cache_path(sheet_id):
+    return os.path.join(CACHE_DIR, f'sheet-{sheet_id}.json')
+
+def _load_from_disk(sheet_id):
+    path = _cache_path(sheet_id)
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            snapshot = Snapshot.from_json(json.load(f))
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError) as e:
+        log.warning(f'Ignoring unreadable sheet snapshot {path}: {e!r}')
+        return None
+
+    log.info(f'Loaded snapshot of sheet {sheet_id} from disk ({len(snapshot.rows)} rows)')
+    return snapshot
+
+def _save_to_disk(sheet_id, snapshot):
+    path = _cache_path(sheet_id)
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+
+        # Write to a temporary file first so a crash never leaves a truncated snapshot behind
+        temp_path = f'{path}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(snapshot.to_json(), f)
+        os.replace(temp_path, path)
+    except OSError as e:
+        log.warning(f'Unable to save snapshot of sheet {sheet_id} to {path}: {e!r}')
@@ -0,0 +1,175 @@
+# shop_generator.py
+#
+# A native, in-process engine for generating randomized shop inventories, meant to replace the
+# remote generator scripts run by `utils.run_script` once their item tables have been transcribed.
+# No table files ship yet, so for now the shops still run the scripts. Each shop's item tables are
+# read from a YAML file once and kept in compact in-memory structures (parallel tuples plus
+# cumulative weights), so generating an inventory is a handful of weighted samples from a seedable RNG.
+#
+# A table file looks like this:
+#
+#   title: '**Vistani Market**'
+#   sections:
+#     - heading: '**Magic Items**'
+#       count: [6, 8]          # A fixed number, or an inclusive [min, max] range
+#       unique: true           # Sample without replacement (default true)
+#       items:
+#         - {name: Potion of Healing, price: 50 gp, weight: 10}
+#         - {name: Bag of Holding, price: 400 gp}   # weight defaults to 1
+#   footer: '@Players The market has new stock!'
+
+import bisect
+import heapq
+import logging
+import os
+import random
+import yaml
+
+from itertools import accumulate
+
+log = logging.getLogger('app.shop_generator')
+
+class Item:
+    """
+    A single line of a generated inventory.
+    """
+
+    __slots__ = ('name', 'price')
+
+    def __init__(self, name, price):
+        self.name = name
+        self.price = price
+
+    def render(self):
+        return f'- {self.name} ({self.price})' if self.price else f'- {self.name}'
+
+class Section:
+    """
+    A heading along with the items generated for it.
+    """
+
+    __slots__ = ('heading', 'items')
+
+    def __init__(self, heading, items):
+        self.heading = heading
+        self.items = items
+
+    def render(self):
+        return '\n'.join([self.heading, *(item.render() for item in self.items)])
+
+class Inventory:
+    """
+    A generated shop inventory. 'seed' is the seed that reproduces it.
+    """
+
+    def __init__(self, title, sections, footer, seed):
+        self.title = title
+        self.sections = sections
+        self.footer = footer
+        self.seed = seed
+
+    def render(self):
+        """
+        Format the inventory as text, one paragraph per section, ending with the seed so that staff
+        can reproduce it with `$pw refresh`.
+        """
+        paragraphs = [self.title] if self.title else []
+        paragraphs.extend(section.render() for section in self.sections)
+        if self.footer:
+            paragraphs.append(self.footer)
+        paragraphs.append(f'*Seed {self.seed}*')
+        return '\n\n'.join(paragraphs)
+
+class _SectionTable:
+    """
+    The items of one section, stored as parallel tuples with cumulative weights for sampling.
+    """
+
+    __slots__ = ('heading', 'count', 'unique', 'names', 'prices', 'weights', 'cum_weights')
+
+    def __init__(self, spec):
+        self.heading = spec['heading']
+
+        count = spec['count']
+        self.count = (count, count) if isinstance(count, int) else (count[0], count[1])
+        self.unique = spec.get('unique', True)
+
+        items = spec['items']
+        self.names = tuple(str(item['name']) for item in items)
+        self.prices = tuple(str(item.get('price', '')) for item in items)
+        self.weights = tuple(float(item.get('weight', 1)) for item in items)
+        self.cum_weights = tuple(accumulate(self.weights))
+
+        if not self.names or self.cum_weights[-1] <= 0:
+            raise ValueError(f'Section {self.heading!r} has no items with a positive weight')
+
+    def sample(self, rng):
+        """
+        Draw a weighted sample of item indexes, in table order.
+        """
+        k = rng.randint(*self.count)
+
+        if self.unique:
+            # Weighted sampling without replacement (Efraimidis-Spirakis): keep the k items with
+            # the largest random keys u^(1/w).
+            k = min(k, sum(1 for weight in self.weights if weight > 0))
+            keyed = ((rng.random() ** (1 / weight), i) for i, weight in enumerate(self.weights) if weight > 0)
+            indexes = [i for _, i in heapq.nlargest(k, keyed)]
+        else:
+            total = self.cum_weights[-1]
+            indexes = [bisect.bisect_right(self.cum_weights, rng.random() * total) for _ in range(k)]
+
+        indexes.sort()
+        return indexes
+
+class ShopTables:
+    """
+    The parsed item tables for one shop.
+    """
+
+    def __init__(self, spec):
+        self.title = spec.get('title', '')
+        self.footer = spec.get('footer', '')
+        self.sections = tuple(_SectionTable(section) for section in spec['sections'])
+
+    def generate(self, seed=None):
+        """
+        Generate an Inventory. The same seed always generates the same inventory.
+        """
+        if seed is None:
+            seed = random.randrange(2 ** 32)
+        rng = random.Random(seed)
+
+        sections = []
+        for table in self.sections:
+            items = [Item(table.names[i], table.prices[i]) for i in table.sample(rng)]
+            sections.append(Section(table.heading, items))
+
+        return Inventory(self.title, sections, self.footer, seed)
+
+_tables = {}
+
+def has_tables(path):
+    """
+    True iff a table file exists at 'path'.
+    """
+    return path in _tables or os.path.exists(path)
+
+def load_tables(path):
+    """
+    Return the ShopTables for the table file at 'path', reading it only the first time.
+    """
+    tables = _tables.get(path)
+    if tables is None:
+        with open(path, 'r', encoding='utf-8') as f:
+            tables = ShopTables(yaml.safe_load(f))
+        _tables[path] = tables
+        log.info(f'Loaded {sum(len(section.names) for section in tables.sections)} items from {path}')
+
+    return tables
+
+def generate(path, seed=None):
+    """
+    Generate an Inventory from the table file at 'path' - see ShopTables.generate.
+    """
+    return load_tables(path).generate(seed)
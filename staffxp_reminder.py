@@ -4,23 +4,17 @@
 
 import logging
 
-from datetime import datetime, time
+from datetime import time
 from discord import Embed
+from scheduler import Weekly
 from utils import embed_role_mention, random_preset_colour
 
 log = logging.getLogger('app.staffxp_reminder')
 
 # The Staff XP reminder is given every Saturday at 17:00 UTC.
-# The remind() method is called every day and checks if it is a Saturday
 TIME = time(hour=17)
 WEEKDAYS = (5,)  # 0-Monday, 6-Sunday
-
-def should_remind_today():
-    """
-    True iff it is a day in WEEKDAYS.
-    """
-    now = datetime.now()
-    return now.weekday() in WEEKDAYS
+SCHEDULE = Weekly(TIME, WEEKDAYS)
 
 async def send_reminder(channel, mention_role=None):
     """
@@ -3,59 +3,59 @@
 # Holds the logic for randomly regenerating the White Gold Hana Den's
 # list of available tattoos and posting the update to OUTPUT_CHANNEL.
 # 
-# At present, this is just a wrapper around Quincy's tattooGenerator.py
-# script which does all the heavy lifting of randomizing content and 
-# formatting the output.
+# The inventory is generated by running Quincy's tattooGenerator.py script,
+# which does all the heavy lifting of randomizing content and formatting the
+# output. Once its item tables have been ported to TABLES_PATH (none ship
+# yet), shop_generator.py generates the inventory natively instead.
 
 import logging
+import metrics
+import shop_generator
+import tracing
 
-from datetime import datetime, time
-from utils import run_script, embed_role_mention
+from datetime import time
+from scheduler import Weekly
+from utils import run_script, pack_inventory
 
-# Run Quincy's script exactly as-is to generate the random inventory
+# The item tables for generating the inventory natively (see shop_generator.py). Not written yet:
+# until they have been ported from Ravenloft-Tables, Quincy's script is run exactly as-is.
+TABLES_PATH = 'tables/tattoo_parlor.yml'
 SCRIPT_URL = 'https://raw.githubusercontent.com/ItsQc/Ravenloft-Tables/main/tattooGenerator.py'
 
 # The tattoo parlor refreshes at midnight UTC on Mondays.
-# The refresh() method is called daily and checks if it is a Monday.
 REFRESH_TIME = time()
 REFRESH_WEEKDAYS = (0,)  # 0-Monday, 6-Sunday
+SCHEDULE = Weekly(REFRESH_TIME, REFRESH_WEEKDAYS)
 
 log = logging.getLogger('app.tattoo_parlor')
 
-def should_refresh_today():
+@metrics.timed('generate')
+async def generate_inventory(seed=None):
     """
-    True iff it is a day in REFRESH_WEEKDAYS.
+    Generate the randomized inventory by running Quincy's script, or from the native item tables
+    once they exist. The 'seed' only applies to native generation.
     """
-    now = datetime.now()
-    return now.weekday() in REFRESH_WEEKDAYS
+    if shop_generator.has_tables(TABLES_PATH):
+        with tracing.span('generate', source=TABLES_PATH) as span:
+            inventory = shop_generator.generate(TABLES_PATH, seed)
+            if span:
+                span.set(seed=inventory.seed)
+        log.info(f'Generated inventory from {TABLES_PATH} with seed {inventory.seed}')
+        output = inventory.render()
+    else:
+        with tracing.span('generate', source='script'):
+            output = await run_script(SCRIPT_URL)
 
-def generate_inventory():
-    """
-    Run Quincy's script to generate the randomized inventory.
-    """
-    output = run_script(SCRIPT_URL)
     log.debug(output)
     return output
 
 async def post_inventory(inventory, channel, mention_role=None):
     """
-    Post the content of 'inventory' to 'channel', breaking it into smaller fragments.
-    """
-    messages = _chunk_output(inventory, mention_role)
-    for message in messages:
-        await channel.send(message)
-
-def _chunk_output(output, mention_role):
+    Post the content of 'inventory' to 'channel', packed into as few messages as possible.
     """
-    Break the script output into smaller messages to stay below Discord API's 2000 character limit.
-    This is brittle, relying on the exact format of tattooGenerator.py's output.
-    """
-    announcement_index = output.index('@Players')
-
-    tattoos = output[:announcement_index]
-    announcement = output[announcement_index:]
-
-    if mention_role:
-        announcement = announcement.replace('@Players', embed_role_mention(mention_role.id))
+    with tracing.span('chunk'):
+        messages = pack_inventory(inventory, mention_role)
 
-    return (tattoos, announcement)
+    for number, message in enumerate(messages, 1):
+        with tracing.span('send', message=number, length=len(message)):
+            await channel.send(message)
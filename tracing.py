@@ -0,0 +1,258 @@
+# tracing.py
+#
+# A flight recorder for background jobs. Each run of a job is a trace made of nested spans around
+# its steps (fetch, exec, chunk, each send, ...), with the duration and outcome of every step. The
+# last TRACE_HISTORY traces are kept in a ring buffer for `$pw trace <job>`, and can be exported as
+# JSON Lines for post-mortems. Outside of a trace, opening a span costs one context variable lookup.
+
+import asyncio
+import functools
+import itertools
+import json
+import logging
+import os
+import time
+
+from collections import deque
+from contextlib import nullcontext
+from contextvars import ContextVar
+from datetime import datetime, timezone
+
+# How many finished traces to keep in memory
+TRACE_HISTORY = 50
+
+# Spans beyond this many in one trace are counted but not recorded, e.g. for a huge cakeday
+MAX_SPANS = 500
+
+# If set, every finished trace is also appended to this JSON Lines file
+EXPORT_PATH = os.environ.get('TRACE_EXPORT_PATH')
+
+log = logging.getLogger('app.tracing')
+
+_current_trace = ContextVar('current_trace', default=None)
+_current_span = ContextVar('current_span', default=None)
+
+_traces = deque(maxlen=TRACE_HISTORY)
+_trace_ids = itertools.count(1)
+_idle = nullcontext()
+
+class Span:
+    """
+    One timed step of a trace. 'start' is in seconds since the start of the trace.
+    """
+
+    __slots__ = ('id', 'parent', 'name', 'start', 'duration', 'error', 'attributes')
+
+    def __init__(self, id, parent, name, start, attributes):
+        self.id = id
+        self.parent = parent
+        self.name = name
+        self.start = start
+        self.duration = None
+        self.error = None
+        self.attributes = attributes
+
+    def set(self, **attributes):
+        """
+        Add attributes to the span, e.g. a count that is only known once the step is done.
+        """
+        self.attributes.update(attributes)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'parent': self.parent,
+            'name': self.name,
+            'start': round(self.start, 6),
+            'duration': None if self.duration is None else round(self.duration, 6),
+            'error': self.error,
+            'attributes': self.attributes,
+        }
+
+class Trace:
+    """
+    The spans recorded during one run of a job. The root span (id 0) covers the whole run.
+    """
+
+    def __init__(self, name):
+        self.id = next(_trace_ids)
+        self.name = name
+        self.started_at = datetime.now(timezone.utc)
+        self.origin = time.perf_counter()
+        self.spans = []
+        self.dropped = 0
+        self._span_ids = itertools.count()
+
+    @property
+    def root(self):
+        return self.spans[0]
+
+    @property
+    def failed(self):
+        return any(span.error for span in self.spans)
+
+    def to_dict(self):
+        return {
+            'trace_id': self.id,
+            'name': self.name,
+            'started_at': self.started_at.isoformat(),
+            'duration': self.root.duration,
+            'failed': self.failed,
+            'dropped_spans': self.dropped,
+            'spans': [span.to_dict() for span in self.spans],
+        }
+
+    def format(self):
+        """
+        Render the trace as an indented tree of spans with their durations.
+        """
+        status = 'FAILED' if self.failed else 'ok'
+        lines = [f'{self.name} at {self.started_at:%Y-%m-%d %H:%M:%S} UTC - {_seconds(self.root.duration)} {status}']
+
+        children = {}
+        for span in self.spans[1:]:
+            children.setdefault(span.parent, []).append(span)
+
+        def walk(parent, depth):
+            for span in children.get(parent, ()):
+                attributes = ' '.join(f'{key}={value}' for key, value in span.attributes.items())
+                line = f'{"  " * depth}{span.name} +{_seconds(span.start)} {_seconds(span.duration)}'
+                if attributes:
+                    line += f' ({attributes})'
+                if span.error:
+                    line += f' ERROR {span.error}'
+                lines.append(line)
+                walk(span.id, depth + 1)
+
+        walk(self.root.id, 1)
+        if self.dropped:
+            lines.append(f'  ... {self.dropped} more spans not recorded')
+        return '\n'.join(lines)
+
+class _SpanContext:
+    """
+    Opens a span on entry and closes it on exit, recording any exception that escapes it.
+    """
+
+    __slots__ = ('trace', 'name', 'attributes', 'span', 'token')
+
+    def __init__(self, trace, name, attributes):
+        self.trace = trace
+        self.name = name
+        self.attributes = attributes
+        self.span = None
+        self.token = None
+
+    def __enter__(self):
+        trace = self.trace
+        if len(trace.spans) >= MAX_SPANS:
+            trace.dropped += 1
+            return None
+
+        parent = _current_span.get()
+        self.span = Span(
+            next(trace._span_ids),
+            parent.id if parent else None,
+            self.name,
+            time.perf_counter() - trace.origin,
+            self.attributes,
+        )
+        trace.spans.append(self.span)
+        self.token = _current_span.set(self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.span is None:
+            return False
+
+        self.span.duration = time.perf_counter() - self.trace.origin - self.span.start
+        if exc_type is not None and not issubclass(exc_type, asyncio.CancelledError):
+            self.span.error = f'{exc_type.__name__}: {exc}'
+        _current_span.reset(self.token)
+        return False
+
+class _TraceContext:
+    """
+    Starts a new trace with its root span, and files it in the ring buffer when done.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.trace = None
+        self.root = None
+        self.token = None
+
+    def __enter__(self):
+        self.trace = Trace(self.name)
+        self.token = _current_trace.set(self.trace)
+        self.root = _SpanContext(self.trace, self.name, {})
+        return self.root.__enter__()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.root.__exit__(exc_type, exc, tb)
+        _current_trace.reset(self.token)
+
+        _traces.append(self.trace)
+        if EXPORT_PATH:
+            _append(EXPORT_PATH, [self.trace])
+        return False
+
+def trace(name):
+    """
+    Record the body of a `with` block as a new trace called 'name' (usually a job name).
+    """
+    return _TraceContext(name)
+
+def span(name, **attributes):
+    """
+    Record the body of a `with` block as a span of the current trace. Does nothing (and yields None)
+    if there is no current trace, so it's cheap to leave in code that also runs outside of jobs.
+    """
+    current = _current_trace.get()
+    if current is None:
+        return _idle
+    return _SpanContext(current, name, attributes)
+
+def traced(name):
+    """
+    Decorate a function or coroutine function so that every call is recorded as span 'name'.
+    """
+    def decorate(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with span(name):
+                    return await func(*args, **kwargs)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with span(name):
+                    return func(*args, **kwargs)
+        return wrapper
+
+    return decorate
+
+def recent(name=None):
+    """
+    Return the traces in the ring buffer, optionally only those called 'name', most recent first.
+    """
+    return [trace for trace in reversed(_traces) if name is None or trace.name == name]
+
+def to_jsonl(traces):
+    """
+    Serialize traces as JSON Lines, one trace per line.
+    """
+    return ''.join(json.dumps(trace.to_dict(), default=str) + '\n' for trace in traces)
+
+def _append(path, traces):
+    try:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(to_jsonl(traces))
+    except OSError as e:
+        log.warning(f'Unable to export traces to {path}: {e!r}')
+
+def _seconds(seconds):
+    if seconds is None:
+        return '(unfinished)'
+    return f'{seconds * 1000:.0f}ms' if seconds < 10 else f'{seconds:.1f}s'
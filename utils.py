@@ -2,31 +2,38 @@
 #
 # Misc utilities for the Pidlwick bot.
 
-import urllib.request
 import csv
+import error_digest
+import generator_pool
+import metrics
+import tracing
 
 from io import StringIO
-from contextlib import redirect_stdout
 from discord import Colour
 from traceback import format_exception
 from random import choice as random_choice
+from http_client import fetch_text
+from script_cache import get_code
 
-# TODO: Make this async (or ideally remove it after porting shop scripts into Pidlwick)
-def run_script(script_url):
+# Discord API limits on the content of a single message
+MESSAGE_LIMIT = 2000
+EMBEDS_PER_MESSAGE = 10
+EMBED_CHARS_PER_MESSAGE = 6000
+
+CODE_FENCE = '```'
+
+# TODO: Remove this after porting shop scripts into Pidlwick
+async def run_script(script_url, timeout=None, on_output=None):
     """
     Retrieves content from `script_url` and runs it as a Python script using `exec`, returning
     the stdout output. Brittle? Yes. Unsafe? Oh yeah. Temporary hack only, to be removed once
-    the content generation logic is brought into Pidlwick.
+    the content generation logic is brought into Pidlwick. The compiled script is cached (see
+    script_cache.py) and runs in a worker process with a timeout (see generator_pool.py).
     """
-    f = urllib.request.urlopen(script_url)
-    script_content = f.read()
-
-    s = StringIO()
-    with redirect_stdout(s):
-        exec(script_content, globals())
-    script_stdout = s.getvalue()
-
-    return script_stdout
+    with tracing.span('fetch_script'):
+        script_content = await get_code(script_url)
+    with tracing.span('exec'):
+        return await generator_pool.run(script_content, timeout=timeout, on_output=on_output)
 
 def partition(l, n):
     """
@@ -35,6 +42,148 @@ def partition(l, n):
     for i in range(0, len(l), n):
         yield l[i:i + n]
 
+@metrics.timed('chunk')
+def pack_messages(blocks, separator='\n', limit=MESSAGE_LIMIT):
+    """
+    Greedily pack an ordered stream of text blocks into as few messages as possible, each no longer
+    than 'limit'. Blocks are joined with 'separator' and are only split if a single block is itself
+    too long, in which case it is split between lines and any open code fence is closed and reopened.
+    Filling each message before starting the next is optimal when the order must be preserved.
+    """
+    messages = []
+    current = ''
+
+    for block in blocks:
+        if not block:
+            continue
+
+        candidate = current + separator + block if current else block
+        if len(candidate) <= limit:
+            current = candidate
+            continue
+
+        if current:
+            messages.append(current)
+
+        if len(block) <= limit:
+            current = block
+        else:
+            pieces = _split_block(block, limit)
+            messages.extend(pieces[:-1])
+            current = pieces[-1]
+
+    if current:
+        messages.append(current)
+
+    return messages
+
+@metrics.timed('chunk')
+def pack_embeds(embeds):
+    """
+    Pack a list of Embeds into as few groups as possible that can each be sent in a single message.
+    """
+    pages = []
+    page = []
+    page_chars = 0
+
+    for embed in embeds:
+        if page and (len(page) == EMBEDS_PER_MESSAGE or page_chars + len(embed) > EMBED_CHARS_PER_MESSAGE):
+            pages.append(page)
+            page = []
+            page_chars = 0
+        page.append(embed)
+        page_chars += len(embed)
+
+    if page:
+        pages.append(page)
+
+    return pages
+
+async def send_packed(channel, blocks, separator='\n'):
+    """
+    Send the text blocks to the channel using as few messages as possible (see pack_messages).
+    Returns the list of messages that were sent.
+    """
+    return [await channel.send(message) for message in pack_messages(blocks, separator)]
+
+def split_paragraphs(text):
+    """
+    Split text into paragraphs at blank lines, never inside a code fence.
+    """
+    paragraphs = []
+    current = []
+    fence = None
+
+    for line in text.splitlines():
+        if not line.strip() and not fence:
+            if current:
+                paragraphs.append('\n'.join(current))
+                current = []
+            continue
+
+        current.append(line)
+        fence = _fence_after(line, fence)
+
+    if current:
+        paragraphs.append('\n'.join(current))
+
+    return paragraphs
+
+def pack_inventory(output, mention_role=None):
+    """
+    Pack a shop inventory (the generator script's output or a rendered native inventory) into as few
+    messages as possible, keeping its paragraphs together where possible. Its '@Players' is turned
+    into a mention of 'mention_role', if given.
+    """
+    if mention_role:
+        output = output.replace('@Players', embed_role_mention(mention_role.id))
+
+    return pack_messages(split_paragraphs(output), separator='\n\n')
+
+def _split_block(block, limit):
+    """
+    Split a block that is too long for one message between lines, closing any open code fence at
+    the end of a piece and reopening it at the start of the next. Lines that are too long on their
+    own are split as a last resort.
+    """
+    max_line = limit - 32  # Leave room to close and reopen a code fence around the line
+
+    lines = []
+    for line in block.splitlines(keepends=True):
+        lines.extend(line[i:i + max_line] for i in range(0, len(line), max_line))
+
+    pieces = []
+    current = ''
+    fence = None  # The line that opened the code fence we are inside of, if any
+
+    for line in lines:
+        next_fence = _fence_after(line, fence)
+        reserve = len(CODE_FENCE) + 1 if next_fence else 0
+
+        if current and len(current) + len(line) + reserve > limit:
+            if fence:
+                current += ('' if current.endswith('\n') else '\n') + CODE_FENCE
+            pieces.append(current)
+            current = f'{fence}\n' if fence else ''
+
+        current += line
+        fence = next_fence
+
+    pieces.append(current)
+    return pieces
+
+def _fence_after(line, fence):
+    """
+    Return the code fence that is open after 'line', given the fence that was open before it.
+    """
+    if line.count(CODE_FENCE) % 2 == 0:
+        return fence
+    if fence:
+        return None
+
+    stripped = line.strip()
+    return stripped if stripped.startswith(CODE_FENCE) and stripped.count(CODE_FENCE) == 1 else CODE_FENCE
+
 def embed_role_mention(role_id):
     """
     Returns an embedding suitable for a role mention, e.g. '@Players'.
@@ -90,16 +239,25 @@ def random_colour():
     """
     return Colour.random()
 
-def load_google_sheet(sheet_id):
+async def load_google_sheet(sheet_id):
     """
     Loads a Google Spreadsheet formatted as a list of dictionaries.
     This looks at only the first sheet if there are multiple and interprets the first row as a header
     with field names for all of the subsequent rows.
     """
-    url = f'https://docs.google.com/spreadsheets/d/{sheet_id}/gviz/tq?tqx=out:csv'
+    csv_data = await fetch_text(google_sheet_url(sheet_id))
+    return parse_csv(csv_data)
+
+def google_sheet_url(sheet_id):
+    """
+    Returns the URL for downloading the first sheet of a Google Spreadsheet as CSV.
+    """
+    return f'https://docs.google.com/spreadsheets/d/{sheet_id}/gviz/tq?tqx=out:csv'
 
-    response = urllib.request.urlopen(url)
-    csv_data = response.read().decode(response.headers.get_content_charset())
+def parse_csv(csv_data):
+    """
+    Parses CSV text into a list of dictionaries, using the first row as the field names.
+    """
     s = StringIO(csv_data, newline='')
 
     reader = csv.DictReader(s)
@@ -111,11 +269,16 @@ def load_google_sheet(sheet_id):
 
 async def notify_maintainer(channel, user, error):
     """
-    Attempts to @mention a user in the given channel to inform them of an error.
+    Attempts to @mention a user in the given channel to inform them of an error. Only the first
+    occurrence of an error is reported in full; repeats are summarized in a periodic digest (see
+    error_digest.py).
     """
     if not channel:
         return  # (shrug)
 
+    if not _error_digest.record(error, channel, user):
+        return  # A repeat, which will be in the next digest
+
     maintainer = embed_nickname_mention(user.id) if user else 'Boss'
 
     msg = f'Uh-oh, something went wrong. Hey {maintainer}, take a look at this:\n'
@@ -123,4 +286,19 @@ async def notify_maintainer(channel, user, error):
     msg += ''.join(format_exception(error)) if isinstance(error, Exception) else f'{error}\n'
     msg += '```'
 
-    await channel.send(msg)
+    await send_packed(channel, [msg])
+
+async def _send_error_digest(channel, user, lines):
+    """
+    Summarize the errors that repeated during the last digest window, one line per error.
+    """
+    maintainer = embed_nickname_mention(user.id) if user else 'Boss'
+    minutes = int(error_digest.DIGEST_WINDOW.total_seconds() // 60)
+
+    blocks = [f'Hey {maintainer}, these errors kept happening in the last {minutes} minutes:']
+    for line in lines:
+        blocks.append(f'\t* {line.count}x (total {line.total}, last at {line.last_seen:%H:%M:%S} UTC) `{line.summary}`')
+
+    await send_packed(channel, blocks)
+
+_error_digest = error_digest.ErrorDigest(_send_error_digest)
@@ -3,66 +3,61 @@
 # Holds the logic for randomly regenerating the Vistani Market inventory
 # and posting the update to OUTPUT_CHANNEL.
 # 
-# At present, this is just a wrapper around Quincy's marketGenerator.py
-# script which does all the heavy lifting of randomizing content and 
-# formatting the output.
+# The inventory is generated by running Quincy's marketGenerator.py script,
+# which does all the heavy lifting of randomizing content and formatting the
+# output. Once its item tables have been ported to TABLES_PATH (none ship
+# yet), shop_generator.py generates the inventory natively instead.
 
 import logging
+import metrics
+import shop_generator
+import tracing
 
 from datetime import date, time
-from utils import run_script, embed_role_mention
+from scheduler import EveryNDays
+from utils import run_script, pack_inventory
 
-# Run Quincy's script exactly as-is to generate the random inventory
+# The item tables for generating the inventory natively (see shop_generator.py). Not written yet:
+# until they have been ported from Ravenloft-Tables, Quincy's script is run exactly as-is.
+TABLES_PATH = 'tables/vistani_market.yml'
 SCRIPT_URL = 'https://raw.githubusercontent.com/ItsQc/Ravenloft-Tables/main/marketGenerator.py'
 
-# The Vistani Market refreshes at midnight UTC every 3 days.
-# The refresh() method is called daily and checks if it has been a multiple
-# of 3 days since an authoritative start date ("epoch").
+# The Vistani Market refreshes at midnight UTC every 3 days, counting from an
+# authoritative start date ("epoch").
 REFRESH_TIME = time()
 REFRESH_EPOCH = date(2022, 12, 12)
 REFRESH_INTERVAL_DAYS = 3
+SCHEDULE = EveryNDays(REFRESH_TIME, REFRESH_INTERVAL_DAYS, REFRESH_EPOCH)
 
 log = logging.getLogger('app.vistani_market')
 
-def should_refresh_today():
+@metrics.timed('generate')
+async def generate_inventory(seed=None):
     """
-    True iff it has been a multiple of REFRESH_INTERVAL_DAYS since REFRESH_EPOCH.
+    Generate the randomized inventory by running Quincy's script, or from the native item tables
+    once they exist. The 'seed' only applies to native generation.
     """
-    today = date.today()
-    delta = today - REFRESH_EPOCH
-    return delta.days % REFRESH_INTERVAL_DAYS == 0
+    if shop_generator.has_tables(TABLES_PATH):
+        with tracing.span('generate', source=TABLES_PATH) as span:
+            inventory = shop_generator.generate(TABLES_PATH, seed)
+            if span:
+                span.set(seed=inventory.seed)
+        log.info(f'Generated inventory from {TABLES_PATH} with seed {inventory.seed}')
+        output = inventory.render()
+    else:
+        with tracing.span('generate', source='script'):
+            output = await run_script(SCRIPT_URL)
 
-def generate_inventory():
-    """
-    Run Quincy's script to generate the randomized inventory.
-    """
-    output = run_script(SCRIPT_URL)
     log.debug(output)
     return output
 
 async def post_inventory(inventory, channel, mention_role=None):
     """
-    Post the content of 'inventory' to 'channel', breaking it into smaller fragments.
-    """
-    messages = _chunk_output(inventory, mention_role)
-    for message in messages:
-        await channel.send(message)
-
-def _chunk_output(output, mention_role):
+    Post the content of 'inventory' to 'channel', packed into as few messages as possible.
     """
-    Break the script output into smaller messages to stay below Discord API's 2000 character limit.
-    This is brittle, relying on the exact format of marketGenerator.py's output.
-    """
-    scroll_index = output.index('**Spell Scrolls**')
-    materials_index = output.index('**Special Materials**')
-    announcement_index = output.index('@Players')
-
-    items = output[:scroll_index]
-    scrolls = output[scroll_index:materials_index]
-    materials = output[materials_index:announcement_index]
-    announcement = output[announcement_index:]
-
-    if mention_role:
-        announcement = announcement.replace('@Players', embed_role_mention(mention_role.id))
+    with tracing.span('chunk'):
+        messages = pack_inventory(inventory, mention_role)
 
-    return (items, scrolls, materials, announcement)
+    for number, message in enumerate(messages, 1):
+        with tracing.span('send', message=number, length=len(message)):
+            await channel.send(message)
@@ -0,0 +1,197 @@
+# work_queue.py
+#
+# A local, SQLite-backed queue of jobs shared by the gateway process and the job worker processes
+# (see jobs.py). The gateway submits a job by name with JSON arguments and waits for its JSON
+# result; workers claim pending jobs one at a time, run them and store the result or the error.
+# SQLite does the locking, so any number of workers on the same machine can share one queue file.
+# Every call blocks on disk I/O, so coroutines run them in a thread (see submit).
+
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from collections import namedtuple
+
+QUEUE_PATH = os.path.join(os.environ.get('PIDLWICK_CACHE_DIR', '.cache'), 'jobs.sqlite3')
+
+# How often the gateway checks whether a submitted job has finished, in seconds
+RESULT_POLL_INTERVAL = 0.05
+
+# How long the gateway waits for a job to finish before giving up on it, in seconds
+JOB_TIMEOUT = 120
+
+# How long to wait for another process to release the database lock, in seconds
+LOCK_TIMEOUT = 10
+
+# A job claimed by a worker
+Job = namedtuple('Job', ['id', 'kind', 'args'])
+
+class JobError(Exception):
+    """
+    A job failed in the worker, or no worker finished it in time.
+    """
+
+class WorkQueue:
+    """
+    A handle on the queue file at 'path'. Each process should use its own handle; within a process
+    the calls are serialized, so the async wrappers can use it from several threads.
+    """
+
+    def __init__(self, path=QUEUE_PATH):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            # Autocommit mode: transactions are begun explicitly where they matter
+            self._conn = sqlite3.connect(self.path, timeout=LOCK_TIMEOUT, isolation_level=None, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')  # Readers don't block the writer
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    kind TEXT NOT NULL,
+                    args TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    result TEXT,
+                    error TEXT,
+                    worker TEXT,
+                    submitted_at REAL NOT NULL,
+                    claimed_at REAL,
+                    finished_at REAL
+                )
+            ''')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id)')
+        return self._conn
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    # Gateway side
+
+    def clear(self):
+        """
+        Drop every job, e.g. ones left over from before a restart whose submitter is gone.
+        """
+        with self._lock:
+            self.conn.execute('DELETE FROM jobs')
+
+    def put(self, kind, args):
+        """
+        Add a job and return its ID.
+        """
+        with self._lock:
+            cursor = self.conn.execute(
+                'INSERT INTO jobs (kind, args, submitted_at) VALUES (?, ?, ?)',
+                (kind, json.dumps(args), time.time()),
+            )
+            return cursor.lastrowid
+
+    def requeue(self, worker=None):
+        """
+        Put the jobs being worked on (by 'worker', or by anyone) back on the queue, e.g. after their
+        workers were stopped. Returns how many there were.
+        """
+        query = "UPDATE jobs SET status = 'pending', worker = NULL, claimed_at = NULL WHERE status = 'running'"
+        with self._lock:
+            if worker is None:
+                cursor = self.conn.execute(query)
+            else:
+                cursor = self.conn.execute(f'{query} AND worker = ?', (worker,))
+            return cursor.rowcount
+
+    def poll(self, job_id):
+        """
+        Return (status, result, error) of a job; the result is decoded from JSON.
+        """
+        with self._lock:
+            row = self.conn.execute('SELECT status, result, error FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None:
+            return 'missing', None, None
+
+        status, result, error = row
+        return status, json.loads(result) if result is not None else None, error
+
+    def forget(self, job_id):
+        with self._lock:
+            self.conn.execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+
+    def pending(self):
+        """
+        Return the number of jobs waiting for a worker and the number being worked on.
+        """
+        with self._lock:
+            counts = dict(self.conn.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+        return counts.get('pending', 0), counts.get('running', 0)
+
+    async def submit(self, kind, args, timeout=JOB_TIMEOUT):
+        """
+        Queue the job 'kind' with the JSON-serializable dict 'args', wait for a worker to run it and
+        return its result. Raises JobError if it fails or isn't done within 'timeout' seconds.
+        """
+        job_id = await asyncio.to_thread(self.put, kind, args)
+        deadline = time.monotonic() + timeout
+        try:
+            while True:
+                status, result, error = await asyncio.to_thread(self.poll, job_id)
+                if status == 'done':
+                    return result
+                elif status == 'failed':
+                    raise JobError(f'Job {kind} failed in a worker:\n{error}')
+                elif status == 'missing':
+                    raise JobError(f'Job {kind} disappeared from the queue')
+                elif time.monotonic() >= deadline:
+                    raise JobError(f'Job {kind} was not done after {timeout}s ({status})')
+
+                await asyncio.sleep(RESULT_POLL_INTERVAL)
+        finally:
+            await asyncio.to_thread(self.forget, job_id)
+
+    # Worker side
+
+    def claim(self, worker):
+        """
+        Mark the oldest pending job as being run by 'worker' and return it, or None if there are none.
+        """
+        with self._lock:
+            conn = self.conn
+            # Only take the write lock when there is something to claim, since idle workers keep asking
+            if conn.execute("SELECT 1 FROM jobs WHERE status = 'pending' LIMIT 1").fetchone() is None:
+                return None
+
+            conn.execute('BEGIN IMMEDIATE')  # Take the write lock first, so no other worker claims the same job
+            try:
+                row = conn.execute("SELECT id, kind, args FROM jobs WHERE status = 'pending' ORDER BY id LIMIT 1").fetchone()
+                if row is not None:
+                    conn.execute(
+                        "UPDATE jobs SET status = 'running', worker = ?, claimed_at = ? WHERE id = ?",
+                        (worker, time.time(), row[0]),
+                    )
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+
+        return Job(row[0], row[1], json.loads(row[2])) if row else None
+
+    def complete(self, job_id, result):
+        with self._lock:
+            self.conn.execute(
+                "UPDATE jobs SET status = 'done', result = ?, finished_at = ? WHERE id = ?",
+                (json.dumps(result), time.time(), job_id),
+            )
+
+    def fail(self, job_id, error):
+        with self._lock:
+            self.conn.execute(
+                "UPDATE jobs SET status = 'failed', error = ?, finished_at = ? WHERE id = ?",
+                (error, time.time(), job_id),
+            )